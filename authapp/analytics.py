@@ -0,0 +1,137 @@
+# analytics.py
+"""
+Rollups behind the admin stats endpoint.
+
+`python manage.py roll_up_analytics` folds new messages into per-day and
+per-chat counters in primary key order, ANALYTICS_BATCH_SIZE at a time,
+and resumes from `RollupProgress`. Messages younger than ANALYTICS_LAG
+seconds are left for the next pass so a write that commits late is not
+skipped. Each pass also samples the live WebSocket leases into the day's
+peak. The first run backfills the whole table the same way.
+
+The stats endpoint only reads these tables, so its cost depends on the
+number of days asked for, not on the number of messages.
+"""
+
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import ChatDailyStats, DailyActiveUser, DailyStats, Message, RollupProgress
+from .presence import get_lease_store
+
+PROGRESS_NAME = 'messages'
+
+
+def roll_up(batch_size=None, now=None):
+    """Fold the next batch of messages into the rollups. Returns how many were folded."""
+    batch_size = batch_size or settings.ANALYTICS_BATCH_SIZE
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=settings.ANALYTICS_LAG)
+    RollupProgress.objects.get_or_create(name=PROGRESS_NAME)
+    with transaction.atomic():
+        # One aggregator at a time, a second one waits here
+        progress = RollupProgress.objects.select_for_update().get(name=PROGRESS_NAME)
+        pks = list(
+            Message.objects.filter(id__gt=progress.last_pk, timestamp__lte=cutoff)
+            .order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not pks:
+            return 0
+        batch = (
+            Message.objects.filter(id__gt=progress.last_pk, id__lte=pks[-1])
+            .annotate(day=TruncDate('timestamp'))
+        )
+        per_chat = {
+            (row['chat_id'], row['day']): row['n']
+            for row in batch.values('chat_id', 'day').annotate(n=Count('id')).order_by()
+        }
+        senders = set(batch.values_list('day', 'sender_id').distinct().order_by())
+
+        messages, new_chats, new_users = Counter(), Counter(), Counter()
+        for (_, day), n in per_chat.items():
+            messages[day] += n
+        _add_chat_counts(per_chat, new_chats)
+        _add_active_users(senders, new_users)
+        for day in messages:
+            DailyStats.objects.get_or_create(day=day)
+            DailyStats.objects.filter(day=day).update(
+                messages=F('messages') + messages[day],
+                active_chats=F('active_chats') + new_chats[day],
+                active_users=F('active_users') + new_users[day],
+            )
+        progress.last_pk = pks[-1]
+        progress.save(update_fields=['last_pk', 'updated_at'])
+    return sum(messages.values())
+
+
+def _add_chat_counts(per_chat, new_chats):
+    """Add `per_chat` {(chat_id, day): n} to the chat rows, counting chats new to a day."""
+    days = {day for _, day in per_chat}
+    existing = {
+        (row.chat_id, row.day): row
+        for row in ChatDailyStats.objects.filter(day__in=days, chat_id__in={chat_id for chat_id, _ in per_chat})
+    }
+    created = []
+    for (chat_id, day), n in per_chat.items():
+        row = existing.get((chat_id, day))
+        if row is None:
+            created.append(ChatDailyStats(chat_id=chat_id, day=day, messages=n))
+            new_chats[day] += 1
+        else:
+            row.messages += n
+    ChatDailyStats.objects.bulk_update(
+        [row for key, row in existing.items() if key in per_chat], ['messages'], batch_size=500,
+    )
+    ChatDailyStats.objects.bulk_create(created, batch_size=500)
+
+
+def _add_active_users(senders, new_users):
+    """Record `senders` {(day, user_id)}, counting users new to a day."""
+    days = {day for day, _ in senders}
+    seen = set(
+        DailyActiveUser.objects.filter(day__in=days, user_id__in={user_id for _, user_id in senders})
+        .values_list('day', 'user_id')
+    )
+    new = senders - seen
+    DailyActiveUser.objects.bulk_create(
+        [DailyActiveUser(day=day, user_id=user_id) for day, user_id in new], batch_size=500,
+    )
+    for day, _ in new:
+        new_users[day] += 1
+
+
+def sample_sockets(now=None):
+    """Raise today's socket peak to the live lease count if it is higher. Returns the count."""
+    now = now or timezone.now()
+    live = get_lease_store().count_live(now)
+    day = now.date()
+    DailyStats.objects.get_or_create(day=day)
+    DailyStats.objects.filter(day=day, peak_sockets__lt=live).update(peak_sockets=live)
+    return live
+
+
+def stats(days=30, top_chats=10, today=None):
+    """The last `days` days of totals and the busiest chats of the newest one."""
+    today = today or timezone.now().date()
+    rows = list(
+        DailyStats.objects.filter(day__gt=today - timedelta(days=days), day__lte=today)
+        .order_by('-day').values('day', 'messages', 'active_chats', 'active_users', 'peak_sockets')
+    )
+    busiest = []
+    if rows:
+        busiest = list(
+            ChatDailyStats.objects.filter(day=rows[0]['day']).order_by('-messages', 'chat_id')
+            .values('chat_id', 'messages')[:top_chats]
+        )
+    progress = RollupProgress.objects.filter(name=PROGRESS_NAME).values('last_pk', 'updated_at').first()
+    return {
+        'days': rows,
+        'busiest_chats': busiest,
+        'rolled_up_to': progress,
+    }
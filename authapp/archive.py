@@ -0,0 +1,139 @@
+# archive.py
+"""
+Tiered message storage.
+
+Messages older than MESSAGE_ARCHIVE_AFTER_DAYS are moved out of the
+`Message` table into one append-only segment file per chat. A segment is a
+sequence of zlib-compressed blocks, each holding up to
+MESSAGE_ARCHIVE_BLOCK_SIZE messages already serialized in the history
+format. `ArchivedBlock` rows are the offset index; blocks are read back
+through mmap so only the requested block is paged in. Each block is
+written with the chat row locked, so overlapping runs (say, a cron job
+still going when the next one starts) never archive a message twice.
+
+Archived messages keep their ids, so history pages move from hot rows to
+archived blocks without the client noticing.
+"""
+
+import json
+import mmap
+import os
+import zlib
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ArchivedBlock, Chat, Message
+from .serializers import MessageSerializer
+
+
+def archive_dir():
+    return Path(getattr(settings, 'MESSAGE_ARCHIVE_DIR', Path(settings.BASE_DIR) / 'archive'))
+
+
+def segment_name(chat_id):
+    # Fan out over 256 directories so no single directory grows unbounded
+    return f"{chat_id % 256:02x}/chat_{chat_id}.seg"
+
+
+def append_block(chat_id, rows):
+    """Append `rows` as one compressed block, returns (segment, offset, length)."""
+    segment = segment_name(chat_id)
+    path = archive_dir() / segment
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 6)
+    with open(path, 'ab') as f:
+        offset = f.seek(0, os.SEEK_END)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return segment, offset, len(data)
+
+
+def read_block(block):
+    with open(archive_dir() / block.segment, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[block.offset:block.offset + block.length]
+    return json.loads(zlib.decompress(data))
+
+
+def archive_chat(chat_id, cutoff, block_size):
+    """Move messages of one chat older than `cutoff` into its segment."""
+    archived = 0
+    while True:
+        with transaction.atomic():
+            # Held for the whole block: an overlapping run waits here and
+            # then finds these messages gone and archived_through past them
+            archived_through = Chat.objects.select_for_update().filter(id=chat_id).values_list(
+                'archived_through', flat=True
+            ).first()
+            messages = list(
+                Message.objects.filter(chat_id=chat_id, timestamp__lt=cutoff, id__gt=archived_through or 0)
+                .select_related('sender').prefetch_related('attachments__file').order_by('id')[:block_size]
+            )
+            if not messages:
+                return archived
+            rows = MessageSerializer(messages, many=True).data
+            # The segment is written first: a crash before commit leaves
+            # unreferenced bytes at the end of the file, never a lost message.
+            segment, offset, length = append_block(chat_id, rows)
+            ArchivedBlock.objects.create(
+                chat_id=chat_id, segment=segment, offset=offset, length=length, count=len(messages),
+                first_message_id=messages[0].id, last_message_id=messages[-1].id,
+                first_timestamp=messages[0].timestamp, last_timestamp=messages[-1].timestamp,
+            )
+            Message.objects.filter(id__in=[m.id for m in messages]).delete()
+            Chat.objects.filter(id=chat_id).update(archived_through=messages[-1].id)
+        archived += len(messages)
+
+
+def archive_messages(older_than=None, block_size=None):
+    """Archive every chat's cold messages. Returns the number moved."""
+    if older_than is None:
+        older_than = timedelta(days=getattr(settings, 'MESSAGE_ARCHIVE_AFTER_DAYS', 180))
+    block_size = block_size or getattr(settings, 'MESSAGE_ARCHIVE_BLOCK_SIZE', 500)
+    cutoff = timezone.now() - older_than
+    chat_ids = (
+        Message.objects.filter(timestamp__lt=cutoff)
+        .order_by('chat_id').values_list('chat_id', flat=True).distinct()
+    )
+    return sum(archive_chat(chat_id, cutoff, block_size) for chat_id in list(chat_ids))
+
+
+def archived_messages(chat_id, before_id=None, limit=None):
+    """
+    Archived messages of a chat, oldest first: all of them, or the `limit`
+    newest ones older than `before_id`. Only the blocks needed are read.
+    """
+    blocks = ArchivedBlock.objects.filter(chat_id=chat_id).order_by('-first_message_id')
+    if before_id is not None:
+        blocks = blocks.filter(first_message_id__lt=before_id)
+
+    rows = []
+    for block in blocks:
+        block_rows = read_block(block)
+        if before_id is not None:
+            block_rows = [row for row in block_rows if row['id'] < before_id]
+        rows = block_rows + rows
+        if limit is not None and len(rows) >= limit:
+            return rows[-limit:]
+    return rows
+
+
+def iter_chat_history(chat_id, chunk_size=1000):
+    """Every message of a chat, oldest first, across archive and hot rows."""
+    for block in ArchivedBlock.objects.filter(chat_id=chat_id).order_by('first_message_id'):
+        yield from read_block(block)
+    last_id = 0
+    while True:
+        chunk = list(
+            Message.objects.filter(chat_id=chat_id, id__gt=last_id)
+            .select_related('sender').prefetch_related('attachments__file').order_by('id')[:chunk_size]
+        )
+        if not chunk:
+            return
+        yield from MessageSerializer(chunk, many=True).data
+        last_id = chunk[-1].id
@@ -0,0 +1,220 @@
+# attachments.py
+"""
+Message attachments.
+
+A client opens an `UploadSession` with the file's name, type and size,
+then PUTs the bytes in chunks with a Content-Range header. Chunks are
+streamed to the storage backend in ATTACHMENT_COPY_BUFFER sized pieces,
+so no upload is ever held in memory, and an interrupted upload resumes
+from the `received` offset. Chunks of one upload are written one at a
+time under a lock on its session row. The finished file is hashed and
+stored once per content; every upload of it gets its own `Attachment`,
+which is then sent along with a chat message.
+
+`python manage.py clean_attachments` discards abandoned uploads and the
+files no attachment refers to any more.
+"""
+
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Attachment, Chat, StoredFile, UploadSession
+from .storage import get_storage
+
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadConflict(UploadError):
+    """The chunk does not start where the upload currently ends."""
+
+
+def start_upload(owner, filename, content_type, size):
+    if size < 1 or size > settings.ATTACHMENT_MAX_SIZE:
+        raise UploadError(f"File size must be between 1 and {settings.ATTACHMENT_MAX_SIZE} bytes.")
+    return UploadSession.objects.create(
+        owner=owner, filename=filename[:255], content_type=content_type[:255] or 'application/octet-stream',
+        size=size,
+    )
+
+
+def parse_content_range(header, session):
+    """(start, length) of a chunk from its Content-Range header."""
+    match = CONTENT_RANGE_RE.match(header or "")
+    if not match:
+        raise UploadError("Content-Range: bytes <start>-<end>/<size> is required.")
+    start, end, total = map(int, match.groups())
+    if total != session.size or end < start or end >= total:
+        raise UploadError("Content-Range does not match the upload.")
+    length = end - start + 1
+    if length > settings.ATTACHMENT_MAX_CHUNK_SIZE:
+        raise UploadError(f"Chunks may be at most {settings.ATTACHMENT_MAX_CHUNK_SIZE} bytes.")
+    if start != session.received:
+        raise UploadConflict(f"Upload continues at byte {session.received}.")
+    return start, length
+
+
+def read_stream(stream, length):
+    buffer_size = settings.ATTACHMENT_COPY_BUFFER
+    remaining = length
+    while remaining:
+        block = stream.read(min(buffer_size, remaining))
+        if not block:
+            raise UploadError("Request body is shorter than its Content-Range.")
+        remaining -= len(block)
+        yield block
+
+
+def write_chunk(session, start, length, stream):
+    """Append one chunk; returns the `Attachment` once the upload is complete."""
+    storage = get_storage()
+    with transaction.atomic():
+        # Held while the chunk is written: a concurrent PUT to the same
+        # upload waits, then is checked against the offset this one leaves
+        received = UploadSession.objects.select_for_update().filter(id=session.id).values_list(
+            'received', flat=True
+        ).first()
+        if received is None:
+            raise UploadConflict("Upload is already complete.")
+        session.received = received
+        if start != received:
+            raise UploadConflict(f"Upload continues at byte {received}.")
+        try:
+            received = storage.append(session.id, start, read_stream(stream, length))
+        except UploadError:
+            # Drop whatever part of the chunk made it to disk
+            storage.append(session.id, start, [])
+            raise
+        session.received = received
+        session.save(update_fields=['received', 'updated_at'])
+        if received == session.size:
+            return finish_upload(session)
+    return None
+
+
+def finish_upload(session):
+    storage = get_storage()
+    digest = storage.hash_partial(session.id)
+    with transaction.atomic():
+        # Locked so delete_orphaned_files cannot remove the file while it
+        # gains this attachment; once it has, the upload commits a new copy
+        stored = StoredFile.objects.select_for_update().filter(sha256=digest).first()
+        if stored is None:
+            name = storage.commit(session.id, digest)
+            stored, _ = StoredFile.objects.get_or_create(sha256=digest, defaults={'size': session.size, 'name': name})
+        else:
+            storage.discard(session.id)
+        attachment = Attachment.objects.create(
+            uploader_id=session.owner_id, file=stored,
+            filename=session.filename, content_type=session.content_type,
+        )
+        session.delete()
+    return attachment
+
+
+def expire_uploads(older_than):
+    """Discard uploads nothing was written to for `older_than`; returns (uploads, bytes) freed."""
+    storage = get_storage()
+    cutoff = timezone.now() - older_than
+    expired = freed = 0
+    for upload_id in list(UploadSession.objects.filter(updated_at__lt=cutoff).values_list('id', flat=True)):
+        with transaction.atomic():
+            # Skipped if a chunk arrived since it was listed
+            if not UploadSession.objects.select_for_update().filter(id=upload_id, updated_at__lt=cutoff).exists():
+                continue
+            freed += storage.partial_size(upload_id)
+            storage.discard(upload_id)
+            UploadSession.objects.filter(id=upload_id).delete()
+        expired += 1
+    return expired, freed
+
+
+def delete_orphaned_files(older_than):
+    """
+    Delete stored files older than `older_than` that no attachment refers
+    to (theirs went with deleted chats or users); returns (files, bytes).
+    """
+    storage = get_storage()
+    cutoff = timezone.now() - older_than
+    deleted = freed = 0
+    orphans = StoredFile.objects.filter(attachments__isnull=True, created_at__lt=cutoff)
+    for stored_id in list(orphans.values_list('id', flat=True)):
+        with transaction.atomic():
+            # Rechecked under the lock finish_upload takes to reuse the file
+            stored = StoredFile.objects.select_for_update().filter(id=stored_id).first()
+            if stored is None or stored.attachments.exists():
+                continue
+            stored.delete()
+            storage.delete(stored.name)
+        deleted += 1
+        freed += stored.size
+    return deleted, freed
+
+
+def attach(message, attachment_ids):
+    """Link the sender's unsent attachments to `message`; returns them."""
+    if not attachment_ids:
+        return []
+    Attachment.objects.filter(
+        id__in=attachment_ids, uploader_id=message.sender_id, chat__isnull=True
+    ).update(chat_id=message.chat_id, message=message)
+    return list(Attachment.objects.filter(message=message).select_related('file'))
+
+
+def attachment_payload(attachment):
+    return {
+        'id': attachment.id,
+        'filename': attachment.filename,
+        'content_type': attachment.content_type,
+        'size': attachment.file.size,
+        'url': reverse('attachment', args=[attachment.id]),
+    }
+
+
+def readable_attachments(user):
+    """Attachments `user` uploaded or received in one of their chats."""
+    chats = Chat.objects.filter(Q(user1=user) | Q(user2=user)).values('id')
+    return Attachment.objects.filter(Q(uploader=user) | Q(chat__in=chats))
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single-range Range header, None to send the whole
+    file; raises ValueError when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header or "")
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def iter_range(f, start, end):
+    buffer_size = settings.ATTACHMENT_COPY_BUFFER
+    f.seek(start)
+    remaining = end - start + 1
+    try:
+        while remaining:
+            block = f.read(min(buffer_size, remaining))
+            if not block:
+                return
+            remaining -= len(block)
+            yield block
+    finally:
+        f.close()
@@ -0,0 +1,180 @@
+# bot.py
+"""
+Background delivery of Langflow bot replies.
+
+Requests are stored as `BotJob` rows and answered by a bounded pool of
+asyncio workers (`python manage.py run_bot_workers`). Each worker claims
+one job at a time, runs the flow in a thread with BOT_REQUEST_TIMEOUT,
+and retries failures with exponential backoff until BOT_MAX_ATTEMPTS or
+the job's deadline. Replies are saved as messages from the bot user and
+pushed over the chat's WebSocket group, so the bot is just another chat
+participant.
+"""
+
+import asyncio
+import logging
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import langflow, messaging
+from .db import db_sync_to_async
+from .models import BotJob, User
+
+logger = logging.getLogger(__name__)
+
+
+def get_bot_user():
+    """The bot's account, flagged `is_bot` and without a usable password."""
+    user = User.objects.filter(is_bot=True).order_by('id').first()
+    if user is not None:
+        return user
+    user = User(username=settings.BOT_USERNAME, is_bot=True)
+    user.set_unusable_password()
+    try:
+        with transaction.atomic():
+            user.save()
+    except IntegrityError:
+        # Another worker created it first, or a person holds the name
+        user = User.objects.filter(is_bot=True).order_by('id').first()
+        if user is None:
+            raise ImproperlyConfigured(
+                f"BOT_USERNAME {settings.BOT_USERNAME!r} belongs to a regular account, pick another name"
+            )
+    return user
+
+
+def is_bot(user_id):
+    return User.objects.filter(id=user_id, is_bot=True).exists()
+
+
+def enqueue(requester, message, tweaks=None, chat=None):
+    now = timezone.now()
+    return BotJob.objects.create(
+        requester=requester, chat=chat, message=message, tweaks=tweaks,
+        available_at=now, deadline=now + timedelta(seconds=settings.BOT_JOB_DEADLINE),
+    )
+
+
+def claim_job(now=None):
+    """Mark the next due job as running and return it, or None."""
+    now = now or timezone.now()
+    with transaction.atomic():
+        job = (
+            BotJob.objects.select_for_update(skip_locked=True)
+            .filter(status='queued', available_at__lte=now)
+            .order_by('available_at', 'id')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = 'running'
+        job.attempts += 1
+        job.save(update_fields=['status', 'attempts', 'updated_at'])
+    return job
+
+
+def requeue_stale_jobs(now=None):
+    """Put back jobs whose worker died mid-request."""
+    now = now or timezone.now()
+    stale = now - timedelta(seconds=2 * settings.BOT_REQUEST_TIMEOUT)
+    return BotJob.objects.filter(status='running', updated_at__lt=stale).update(status='queued', available_at=now)
+
+
+def backoff(attempts):
+    return settings.BOT_RETRY_BACKOFF * 2 ** (attempts - 1)
+
+
+def fail_job(job, error, now=None):
+    """Schedule a retry, or give up once out of attempts or time."""
+    now = now or timezone.now()
+    retry_at = now + timedelta(seconds=backoff(job.attempts))
+    job.error = error
+    if job.attempts < settings.BOT_MAX_ATTEMPTS and retry_at < job.deadline:
+        job.status = 'queued'
+        job.available_at = retry_at
+    else:
+        job.status = 'failed'
+    job.save(update_fields=['status', 'available_at', 'error', 'updated_at'])
+
+
+def complete_job(job, response):
+    """Store the flow's response; returns the reply message, if the job has a chat."""
+    if "error" in response:
+        fail_job(job, response["error"])
+        return None
+    with transaction.atomic():
+        if job.chat_id:
+            job.reply = messaging.save_message(job.chat, get_bot_user(), langflow.extract_reply(response))
+        job.result = response
+        job.status = 'done'
+        job.error = ''
+        job.save(update_fields=['reply', 'result', 'status', 'error', 'updated_at'])
+    return job.reply
+
+
+def run_job(job):
+    """Run one claimed job synchronously. Returns the reply message or None."""
+    remaining = (job.deadline - timezone.now()).total_seconds()
+    if remaining <= 0:
+        fail_job(job, "Deadline exceeded.")
+        return None
+    response = langflow.run_langflow(
+        job.message, job.tweaks, timeout=min(settings.BOT_REQUEST_TIMEOUT, remaining)
+    )
+    return complete_job(job, response)
+
+
+async def push_reply(reply):
+    await get_channel_layer().group_send(messaging.chat_group(reply.chat), messaging.chat_message_event(reply))
+
+
+class BotWorkerPool:
+    """`concurrency` workers, each handling one job at a time."""
+
+    def __init__(self, concurrency=None, poll_interval=None):
+        self.concurrency = concurrency or settings.BOT_WORKERS
+        self.poll_interval = poll_interval or settings.BOT_POLL_INTERVAL
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def run(self):
+        await asyncio.gather(self._requeuer(), *(self._worker() for _ in range(self.concurrency)))
+
+    async def _requeuer(self):
+        """Every BOT_REQUEST_TIMEOUT, put back jobs left running by a dead or failed worker."""
+        while not self._stopping.is_set():
+            try:
+                await db_sync_to_async(requeue_stale_jobs)()
+            except Exception:
+                logger.exception("Bot requeue error")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), settings.BOT_REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while not self._stopping.is_set():
+            try:
+                job = await db_sync_to_async(claim_job)()
+                if job is None:
+                    await self._idle()
+                    continue
+                reply = await db_sync_to_async(run_job)(job)
+                if reply is not None:
+                    await push_reply(reply)
+            except Exception:
+                logger.exception("Bot worker error")
+                await self._idle()
+
+    async def _idle(self):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,107 @@
+# changes.py
+"""
+Fan-out of changes into the per-user `ChangeEvent` feed read by the sync
+endpoint. Writers call these helpers right after the change is saved, in
+the same transaction when there is one.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .attachments import attachment_payload
+from .models import ChangeEvent
+
+
+def record_changes(events):
+    """`events` is an iterable of (user_id, kind, payload) tuples."""
+    ChangeEvent.objects.bulk_create([
+        ChangeEvent(user_id=user_id, kind=kind, payload=payload)
+        for user_id, kind, payload in events
+    ])
+
+
+def message_payload(message):
+    payload = {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'sender': message.sender_id,
+        'sender_username': message.sender.username,
+        'message': message.message,
+        'timestamp': message.timestamp.isoformat(),
+    }
+    # Set by messaging.save_message when files were sent along
+    if getattr(message, 'attachment_list', None):
+        payload['attachments'] = [attachment_payload(a) for a in message.attachment_list]
+    return payload
+
+
+def messages_changed(chat, messages):
+    record_changes(
+        (user_id, 'message', message_payload(message))
+        for message in messages
+        for user_id in (chat.user1_id, chat.user2_id)
+    )
+
+
+def mutation_payload(message):
+    """Compact delta of an edited or deleted message, for the feed and the chat group."""
+    payload = {'id': message.id, 'chat_id': message.chat_id, 'version': message.version}
+    if message.deleted_at is None:
+        payload['message'] = message.message
+        payload['edited_at'] = message.edited_at.isoformat()
+    return payload
+
+
+def mutation_kind(message):
+    return 'message_edited' if message.deleted_at is None else 'message_deleted'
+
+
+def message_mutated(chat, message):
+    payload = mutation_payload(message)
+    record_changes(
+        (user_id, mutation_kind(message), payload) for user_id in (chat.user1_id, chat.user2_id)
+    )
+
+
+def chats_created(chats):
+    record_changes(
+        (user_id, 'chat', {'chat_id': chat.id, 'user_ids': [chat.user1_id, chat.user2_id]})
+        for chat in chats
+        for user_id in (chat.user1_id, chat.user2_id)
+    )
+
+
+def friend_requests_changed(rows):
+    """`rows` is an iterable of (id, from_user_id, to_user_id, status)."""
+    record_changes(
+        (user_id, 'friend_request', {
+            'id': pk, 'from_user': from_user_id, 'to_user': to_user_id, 'status': request_status,
+        })
+        for pk, from_user_id, to_user_id, request_status in rows
+        for user_id in (from_user_id, to_user_id)
+    )
+
+
+def settled_events(user):
+    """
+    The user's events old enough to be committed, see SYNC_COMMIT_WINDOW.
+    Newer ones may still have neighbours with lower ids in flight.
+    """
+    horizon = timezone.now() - timedelta(seconds=settings.SYNC_COMMIT_WINDOW)
+    return ChangeEvent.objects.filter(user=user, created_at__lte=horizon)
+
+
+def changes_since(user, cursor, limit):
+    """Up to `limit` settled events after `cursor`, and whether more are waiting."""
+    events = list(
+        settled_events(user).filter(id__gt=cursor)
+        .order_by('id')
+        .values('id', 'kind', 'payload', 'created_at')[:limit + 1]
+    )
+    return events[:limit], len(events) > limit
+
+
+def latest_cursor(user):
+    return settled_events(user).order_by('-id').values_list('id', flat=True).first() or 0
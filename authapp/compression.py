@@ -0,0 +1,123 @@
+# compression.py
+"""
+Negotiated compression of large REST responses and WebSocket frames.
+
+`CompressionMiddleware` compresses response bodies of at least
+COMPRESSION_MIN_BYTES with the best encoding the client accepts: Brotli
+when the optional `brotli` package is installed, otherwise gzip. Small
+bodies, streamed files and responses that are already encoded are sent
+as they are.
+
+WebSocket servers don't all negotiate permessage-deflate (Daphne does
+not), so sockets opened with `?compress=deflate` get frames of at least
+WS_COMPRESSION_MIN_BYTES as binary zlib data instead of text. Each frame
+is compressed on its own: no per-socket compressor state to keep in
+memory, and a client can inflate any frame with DecompressionStream
+('deflate').
+"""
+
+import gzip
+import re
+import zlib
+from urllib.parse import parse_qs
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies that are already compressed or not worth it
+SKIP_CONTENT_TYPES = re.compile(r'^(image|video|audio)/|^application/(zip|gzip|x-brotli|octet-stream)')
+
+
+def accepted_encodings(header):
+    """Encodings named in an Accept-Encoding header, without those refused with q=0."""
+    encodings = set()
+    for part in header.split(','):
+        name, *params = [p.strip() for p in part.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if name and q > 0:
+            encodings.add(name.lower())
+    return encodings
+
+
+def choose_encoding(header):
+    encodings = accepted_encodings(header)
+    if brotli is not None and 'br' in encodings:
+        return 'br'
+    if 'gzip' in encodings:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """Brotli or gzip for response bodies of at least COMPRESSION_MIN_BYTES."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        if (
+            response.streaming
+            or response.has_header('Content-Encoding')
+            or len(response.content) < settings.COMPRESSION_MIN_BYTES
+            or SKIP_CONTENT_TYPES.match(response.get('Content-Type', ''))
+        ):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        compressed = compress(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The bytes differ per encoding, so a strong validator must not be shared
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+
+def wants_compressed_frames(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('compress', [None])[0] == 'deflate'
+
+
+def encode_frame(text, compressed_frames):
+    """send() kwargs for `text`: binary zlib data when the socket opted in and it is large enough."""
+    if compressed_frames and len(text) >= settings.WS_COMPRESSION_MIN_BYTES:
+        return {'bytes_data': zlib.compress(text.encode(), settings.WS_COMPRESSION_LEVEL)}
+    return {'text_data': text}
@@ -2,17 +2,25 @@
 
 import json
 from datetime import datetime
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model
 from django.db.models import Q, F
 from .models import Chat, Message
+from . import bot, messaging, tracing
+from .profiling import profiled
+from .compression import encode_frame, wants_compressed_frames
+from .db import db_sync_to_async
+from .presence import acquire_lease, renew_lease, release_lease, lease_keeper, presence_lock
+from backend.db_router import pin_token_to_primary
 
 User = get_user_model()
 
 class PrivateChatConsumer(AsyncWebsocketConsumer):
+    @profiled
     async def connect(self):
+        self.compressed_frames = wants_compressed_frames(self.scope)
         try:
             query_params = self.scope["query_string"].decode().split("&")
             token = next((param.split("=")[1] for param in query_params if param.startswith("token=")), None)
@@ -25,6 +33,7 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
             if not self.user:
                 await self.close()
                 return
+            self.token = token
 
             self.other_user_id = int(self.scope["url_route"]["kwargs"]["other_user_id"])
             user_ids = sorted([self.user.id, self.other_user_id])
@@ -35,6 +44,7 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
 
             # Update user presence
             status_changed = await self.user_connect()
+            lease_keeper.ensure_running()
             if status_changed:
                 await self.broadcast_status()
         except Exception as e:
@@ -49,33 +59,112 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
             if status_changed:
                 await self.broadcast_status()
 
+    @profiled
     async def receive(self, text_data):
+        trace = tracing.start()
         data = json.loads(text_data)
+        if data.get('type') == 'heartbeat':
+            await self.handle_heartbeat()
+            return
         if data.get('type') == 'typing':
             await self.handle_typing_event(data)
             return
+        if data.get('type') in ('edit', 'delete'):
+            await self.handle_mutation(data)
+            return
+        tracing.stamp(trace, 'parse')
+        if data.get('type') == 'batch':
+            await self.handle_batch(data.get('messages') or [], trace)
+            return
 
         message = data.get("message", "").strip()
-        if not message:
+        attachment_ids = [i for i in data.get("attachments") or [] if isinstance(i, int)]
+        if not message and not attachment_ids:
             return
 
         chat_obj = await self.get_or_create_chat()
-        saved_message = await self.save_message(chat_obj, message)
+        tracing.stamp(trace, 'chat')
+        saved_message = await self.save_message(chat_obj, message, attachment_ids)
+        tracing.stamp(trace, 'persist')
 
         await self.channel_layer.group_send(
             self.room_name,
-            {
-                "type": "chat_message",
-                "message": saved_message.message,
-                "sender_id": str(self.user.id),
-                "sender_username": self.user.username,
-                "timestamp": saved_message.timestamp.isoformat(),
-            },
+            tracing.traced(messaging.chat_message_event(saved_message), trace),
         )
+        tracing.stamp(trace, 'publish')
+        if await self.other_user_is_bot():
+            await self.enqueue_bot_reply(chat_obj, message)
 
     async def chat_message(self, event):
+        await self.send(**encode_frame(json.dumps(self.delivered(event)), self.compressed_frames))
+
+    async def chat_messages(self, event):
+        await self.send(**encode_frame(json.dumps(self.delivered(event)), self.compressed_frames))
+
+    def delivered(self, event):
+        # The sender's own echo is loopback, not delivery to the peer
+        return tracing.delivered(event, record=event.get('sender_id') != str(self.user.id))
+
+    async def message_edited(self, event):
+        await self.send(text_data=json.dumps(event))
+
+    async def message_deleted(self, event):
         await self.send(text_data=json.dumps(event))
 
+    async def handle_mutation(self, data):
+        """
+        {"type": "edit", "id": <message id>, "message": "..."} or
+        {"type": "delete", "id": <message id>} on one of your own messages
+        in this chat; both sockets get the resulting delta event.
+        """
+        text = (data.get("message") or "").strip()
+        if not isinstance(data.get("id"), int) or (data['type'] == 'edit' and not text):
+            return
+        message = await self.mutate_message(data['type'], data['id'], text)
+        if message is not None:
+            await self.channel_layer.group_send(self.room_name, messaging.mutation_event(message))
+
+    async def handle_batch(self, items, trace=None):
+        """
+        {"type": "batch", "messages": [{"client_id": "...", "message": "..."}, ...]}
+        is stored with one insert and answered with
+        {"type": "ack", "ids": [[client_id, message_id], ...]}; resent client
+        ids are acked again without being stored or broadcast twice.
+        """
+        items = [
+            (str(item.get("client_id") or "")[:64], (item.get("message") or "").strip())
+            for item in items[:settings.CHAT_MAX_BATCH] if isinstance(item, dict)
+        ]
+        items = [(client_id, text) for client_id, text in items if client_id and text]
+        if not items:
+            return
+
+        chat_obj = await self.get_or_create_chat()
+        tracing.stamp(trace, 'chat')
+        messages, created = await self.save_message_batch(chat_obj, items)
+        tracing.stamp(trace, 'persist')
+        if created:
+            await self.channel_layer.group_send(
+                self.room_name,
+                tracing.traced({
+                    "type": "chat_messages",
+                    "sender_id": str(self.user.id),
+                    "sender_username": self.user.username,
+                    "messages": [
+                        {"id": m.id, "client_id": m.client_id, "message": m.message,
+                         "timestamp": m.timestamp.isoformat()}
+                        for m in created
+                    ],
+                }, trace),
+            )
+            tracing.stamp(trace, 'publish')
+            if await self.other_user_is_bot():
+                await self.enqueue_bot_reply(chat_obj, "\n".join(m.message for m in created))
+        await self.send(**encode_frame(json.dumps({
+            "type": "ack",
+            "ids": [[m.client_id, m.id] for m in messages],
+        }), self.compressed_frames))
+
     async def typing_indicator(self, event):
         # Enhanced typing indicator handling
         try:
@@ -102,46 +191,90 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             print(f"Error handling typing event: {e}")
 
-    @database_sync_to_async
+    async def handle_heartbeat(self):
+        await db_sync_to_async(renew_lease)(self.channel_name)
+        await self.send(text_data=json.dumps({"type": "heartbeat_ack"}))
+
+    @db_sync_to_async
     def get_user_from_token(self, token):
         try:
             return Token.objects.get(key=token).user
         except Token.DoesNotExist:
             return None
 
-    @database_sync_to_async
+    @db_sync_to_async
     def get_or_create_chat(self):
-        return Chat.objects.get_or_create(
-            user1_id=min(self.user.id, self.other_user_id),
-            user2_id=max(self.user.id, self.other_user_id)
-        )[0]
-
-    @database_sync_to_async
-    def save_message(self, chat, message):
-        return Message.objects.create(chat=chat, sender=self.user, message=message)
-
-    @database_sync_to_async
+        return messaging.get_or_create_chat(self.user.id, self.other_user_id)
+
+    @db_sync_to_async
+    def save_message(self, chat, message, attachment_ids=None):
+        saved = messaging.save_message(chat, self.user, message, attachment_ids)
+        # Keep this client's REST reads on the primary so it sees its message
+        pin_token_to_primary(self.token)
+        return saved
+
+    @db_sync_to_async
+    def save_message_batch(self, chat, items):
+        result = messaging.save_message_batch(chat, self.user, items)
+        pin_token_to_primary(self.token)
+        return result
+
+    @db_sync_to_async
+    def mutate_message(self, kind, message_id, text):
+        user_ids = sorted([self.user.id, self.other_user_id])
+        message = Message.objects.select_related('chat').filter(
+            pk=message_id, sender=self.user, deleted_at__isnull=True,
+            chat__user1_id=user_ids[0], chat__user2_id=user_ids[1],
+        ).first()
+        if message is None:
+            return None
+        if kind == 'edit':
+            message = messaging.edit_message(message, text)
+        else:
+            message = messaging.delete_message(message)
+        if message is not None:
+            pin_token_to_primary(self.token)
+        return message
+
+    @db_sync_to_async
+    def other_user_is_bot(self):
+        if not hasattr(self, '_other_is_bot'):
+            self._other_is_bot = bot.is_bot(self.other_user_id)
+        return self._other_is_bot
+
+    @db_sync_to_async
+    def enqueue_bot_reply(self, chat, message):
+        bot.enqueue(self.user, message, chat=chat)
+
+    @db_sync_to_async
     def user_connect(self):
         prev_status = self.user.is_online
-        self.user.active_connections = F('active_connections') + 1
-        self.user.save()
-        self.user.refresh_from_db()
-        if self.user.active_connections == 1:
-            self.user.is_online = True
-            self.user.last_online = None
+        with presence_lock(self.user.id):
+            acquire_lease(self.channel_name, self.user.id)
+            self.user.active_connections = F('active_connections') + 1
             self.user.save()
+            self.user.refresh_from_db()
+            if self.user.active_connections == 1:
+                self.user.is_online = True
+                self.user.last_online = None
+                self.user.save()
         return prev_status != self.user.is_online
 
-    @database_sync_to_async
+    @db_sync_to_async
     def user_disconnect(self):
         prev_status = self.user.is_online
-        self.user.active_connections = F('active_connections') - 1
-        self.user.save()
-        self.user.refresh_from_db()
-        if self.user.active_connections == 0:
-            self.user.is_online = False
-            self.user.last_online = datetime.now()
+        with presence_lock(self.user.id):
+            # The reaper already reconciled this socket if its lease expired
+            if not release_lease(self.channel_name):
+                self.user.refresh_from_db()
+                return prev_status != self.user.is_online
+            self.user.active_connections = F('active_connections') - 1
             self.user.save()
+            self.user.refresh_from_db()
+            if self.user.active_connections == 0:
+                self.user.is_online = False
+                self.user.last_online = datetime.now()
+                self.user.save()
         return prev_status != self.user.is_online
 
     async def broadcast_status(self):
@@ -156,7 +289,7 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
                 }
             )
 
-    @database_sync_to_async
+    @db_sync_to_async
     def get_chat_partners(self):
         return list(User.objects.filter(
             Q(chat_user1__user2=self.user) | Q(chat_user2__user1=self.user)
@@ -197,7 +330,13 @@ class ChatListConsumer(AsyncWebsocketConsumer):
     async def friend_typing(self, event):
         await self.send(text_data=json.dumps(event))
 
-    @database_sync_to_async
+    async def friend_update(self, event):
+        await self.send(text_data=json.dumps(event))
+
+    async def friend_updates(self, event):
+        await self.send(text_data=json.dumps(event))
+
+    @db_sync_to_async
     def get_user_from_token(self, token):
         try:
             return Token.objects.get(key=token).user
@@ -214,10 +353,12 @@ class OnlineStatusConsumer(AsyncWebsocketConsumer):
                 await self.close()
                 return
 
-            self.user = await database_sync_to_async(Token.objects.get)(key=token).user
+            token_obj = await db_sync_to_async(Token.objects.select_related('user').get)(key=token)
+            self.user = token_obj.user
             self.status_group = f"status_{self.user.id}"
             await self.channel_layer.group_add(self.status_group, self.channel_name)
             await self.user_connect()
+            lease_keeper.ensure_running()
         except Exception as e:
             print(f"Status connection error: {e}")
             await self.close()
@@ -228,21 +369,33 @@ class OnlineStatusConsumer(AsyncWebsocketConsumer):
         if hasattr(self, 'user'):
             await self.user_disconnect()
 
+    @profiled
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        if data.get('type') == 'heartbeat':
+            await db_sync_to_async(renew_lease)(self.channel_name)
+            await self.send(text_data=json.dumps({"type": "heartbeat_ack"}))
+
     async def user_status(self, event):
         await self.send(text_data=json.dumps(event))
 
-    @database_sync_to_async
+    @db_sync_to_async
     def user_connect(self):
-        self.user.active_connections += 1
-        if self.user.active_connections == 1:
-            self.user.is_online = True
-            self.user.last_online = None
-        self.user.save()
+        with presence_lock(self.user.id):
+            acquire_lease(self.channel_name, self.user.id)
+            self.user.active_connections += 1
+            if self.user.active_connections == 1:
+                self.user.is_online = True
+                self.user.last_online = None
+            self.user.save()
 
-    @database_sync_to_async
+    @db_sync_to_async
     def user_disconnect(self):
-        self.user.active_connections = max(0, self.user.active_connections - 1)
-        if self.user.active_connections == 0:
-            self.user.is_online = False
-            self.user.last_online = datetime.now()
-        self.user.save()
\ No newline at end of file
+        with presence_lock(self.user.id):
+            if not release_lease(self.channel_name):
+                return
+            self.user.active_connections = max(0, self.user.active_connections - 1)
+            if self.user.active_connections == 0:
+                self.user.is_online = False
+                self.user.last_online = datetime.now()
+            self.user.save()
\ No newline at end of file
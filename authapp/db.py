@@ -0,0 +1,77 @@
+# db.py
+"""
+Dedicated thread pool for the consumers' ORM calls.
+
+`database_sync_to_async` runs on asgiref's default executor, which the
+consumers share with everything else in the process. `db_sync_to_async`
+is a drop-in replacement that runs on a sized executor of its own, so the
+number of threads (and therefore database connections) used for WebSocket
+work is bounded by CONSUMER_DB_THREADS, and reports queue depth and wait
+time to `authapp.metrics`. Queries run for a profiled handler are timed
+into its profile (see `authapp.profiling`).
+"""
+
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    def submit(self, fn, /, *args, **kwargs):
+        queued_at = time.monotonic()
+        metrics.gauge('consumer_db.queue_depth').inc()
+
+        def run():
+            metrics.gauge('consumer_db.queue_depth').dec()
+            metrics.histogram('consumer_db.wait_ms').observe((time.monotonic() - queued_at) * 1000)
+            metrics.gauge('consumer_db.busy_threads').inc()
+            started_at = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.gauge('consumer_db.busy_threads').dec()
+                metrics.histogram('consumer_db.run_ms').observe((time.monotonic() - started_at) * 1000)
+
+        return super().submit(run)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_db_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = InstrumentedThreadPoolExecutor(
+                    max_workers=getattr(settings, 'CONSUMER_DB_THREADS', 8),
+                    thread_name_prefix='consumer-db',
+                )
+    return _executor
+
+
+def db_sync_to_async(func):
+    """Like `database_sync_to_async`, but runs on the consumer DB executor."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        # Runs with a copy of the caller's context, so its queries are timed
+        # into the caller's active profile
+        runner = DatabaseSyncToAsync(func, thread_sensitive=False, executor=get_db_executor())
+        return await runner(*args, **kwargs)
+    return wrapper
+
+
+def pool_stats(alias='default'):
+    """psycopg pool statistics for `alias`, or None when pooling is off."""
+    pool = getattr(connections[alias], 'pool', None)
+    if pool is None:
+        return None
+    return pool.get_stats()
@@ -0,0 +1,76 @@
+# langflow.py
+"""Client for the Langflow flow behind the chat bot."""
+
+import json
+import logging
+import os
+from typing import Optional
+
+# Access environment variables
+BASE_API_URL = os.getenv("BASE_API_URL")
+LANGFLOW_ID = os.getenv("LANGFLOW_ID")
+FLOW_ID = os.getenv("FLOW_ID")
+APPLICATION_TOKEN = os.getenv("APPLICATION_TOKEN")
+ENDPOINT = os.getenv("ENDPOINT", "")  # You can set a specific endpoint name in the flow settings
+
+logger = logging.getLogger(__name__)
+
+TWEAKS = {
+    "ChatInput-H8D4c": {},
+    "ChatOutput-lbpA5": {},
+    "File-PPYW6": {},
+    "CustomComponent-c79R6": {},
+    "HuggingFaceModel-wsmU0": {}
+}
+
+
+def run_langflow(message: str, tweaks: Optional[dict] = None, application_token: Optional[str] = None,
+                 timeout: Optional[float] = None) -> dict:
+    """
+    Run the LangFlow API with the provided message and optional tweaks.
+
+    :param message: The message to send to the LangFlow API.
+    :param tweaks: Optional dictionary of tweaks to customize the flow.
+    :param application_token: The application token for authentication.
+    :param timeout: Seconds to wait for the upstream response (None waits forever).
+    :return: The response JSON from LangFlow API, or {"error": ...}.
+    """
+    # Imported here: requests is slow to import and only bot workers and the
+    # chat/ view call Langflow, not the WebSocket workers that import this
+    import requests
+
+    api_url = f"{BASE_API_URL}/lf/{LANGFLOW_ID}/api/v1/run/{ENDPOINT or FLOW_ID}"
+
+    payload = {
+        "input_value": message,
+        "output_type": "chat",
+        "input_type": "chat",
+        "tweaks": tweaks if tweaks else TWEAKS
+    }
+
+    headers = {"Authorization": f"Bearer {application_token or APPLICATION_TOKEN}", "Content-Type": "application/json"}
+
+    # Sizes only: the payload and response carry users' messages
+    logger.debug("Langflow request to %s (%d chars)", api_url, len(message))
+
+    try:
+        response = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
+        logger.debug("Langflow response %s (%d bytes)", response.status_code, len(response.content))
+
+        response.raise_for_status()  # Raises HTTPError for bad responses
+        return response.json()
+
+    except requests.exceptions.HTTPError as errh:
+        logger.warning("Langflow HTTP error: %s", errh)
+        return {"error": f"HTTP Error: {errh}"}
+    except requests.exceptions.RequestException as err:
+        logger.warning("Langflow request error: %s", err)
+        return {"error": f"Request Error: {err}"}
+
+
+def extract_reply(response: dict) -> str:
+    """The bot's chat text from a Langflow run response."""
+    try:
+        return response["outputs"][0]["outputs"][0]["results"]["message"]["text"]
+    except (KeyError, IndexError, TypeError):
+        return json.dumps(response)
@@ -0,0 +1,470 @@
+# layers.py
+"""
+Channel layer that fans group messages out in-process where it can.
+
+Both sockets of a 1:1 chat are often on the same worker, yet every
+`chat_message` used to make a round trip through Redis to reach them.
+`HybridChannelLayer` wraps the configured layer (the "inner" layer):
+
+- group members on this worker get group_send messages straight from
+  memory;
+- the worker joins each inner group through a per-worker channel rather
+  than once per socket. A group_send is published to the inner layer
+  once, and each other worker fans it out to its own members. The copy
+  that comes back to the sending worker is dropped. The membership is
+  renewed on every local join and every `group_refresh` seconds, so it
+  never reaches the inner layer's group_expiry while sockets remain;
+- a send() to a socket of this worker skips the inner layer. Every socket
+  still receives from the inner layer too, so sends from other processes
+  reach it.
+
+    CHANNEL_LAYERS = {"default": {
+        "BACKEND": "authapp.layers.HybridChannelLayer",
+        "CONFIG": {"inner": {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {...}}},
+    }}
+
+The worker channel (`hybrid.*`) carries the group traffic of all of a
+worker's sockets, so give it a channel_capacity on the inner layer well
+above the default 100: group_send drops messages for a full channel.
+
+Local delivery, remote publishes and dropped own copies are counted in
+`authapp.metrics` under channel_layer.*.
+
+`ShardedChannelLayer` spreads groups over several layers (one per Redis
+node) with consistent hashing, and is meant to be the inner layer of
+`HybridChannelLayer`; see its docstring for adding or removing shards.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import itertools
+import re
+import uuid
+from collections import Counter, defaultdict
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+FANOUT_TYPE = 'hybrid.fanout'
+
+
+def build_layer(config):
+    """A layer instance from a {"BACKEND": ..., "CONFIG": {...}} dict, or `config` itself."""
+    if isinstance(config, dict):
+        return import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+    return config
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, inner, expiry=60, capacity=100, channel_capacity=None, group_refresh=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.inner = build_layer(inner)
+        # Default: twice per inner group_expiry (channels_redis and the in-memory layer: a day)
+        self.group_refresh = group_refresh or getattr(self.inner, 'group_expiry', 86400) / 2
+        self.worker_id = uuid.uuid4().hex
+        self._queues = {}  # channel -> asyncio.Queue, for channels received on by this worker
+        self._receiving = Counter()  # channel -> pending receive() calls
+        self._remote = {}  # channel -> pending inner receive
+        self._groups = defaultdict(set)  # group -> local channels
+        self._memberships = defaultdict(set)  # local channel -> groups
+        self._joined = set()  # groups the worker channel is in on the inner layer
+        self._membership_lock = asyncio.Lock()
+        self._worker_channel = None
+        self._fan_in_task = None
+        self._refresh_task = None
+
+    def __getattr__(self, name):
+        # Anything else (close_pools, ...) is the inner layer's
+        if name == 'inner':
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    async def new_channel(self, prefix="specific."):
+        return await self.inner.new_channel(prefix)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        queue = self._queues.get(channel)
+        if queue is None:
+            await self.inner.send(channel, message)
+            return
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait(deepcopy(message))
+        metrics.counter('channel_layer.local_deliveries').inc()
+
+    async def receive(self, channel):
+        """The next message for `channel` from this worker or the inner layer."""
+        assert self.valid_channel_name(channel)
+        queue = self._queues.setdefault(channel, asyncio.Queue())
+        remote = self._remote.get(channel)
+        if not queue.empty():
+            message = queue.get_nowait()
+        elif remote is not None and remote.done():
+            del self._remote[channel]
+            message = remote.result()
+        else:
+            message = None
+        if message is not None:
+            self._release(channel)
+            return message
+
+        # The inner receive outlives this call when a local message wins,
+        # so the next call picks up where it left off
+        if remote is None:
+            remote = self._remote[channel] = asyncio.ensure_future(self.inner.receive(channel))
+        self._receiving[channel] += 1
+        local = asyncio.ensure_future(queue.get())
+        try:
+            done, _ = await asyncio.wait((local, remote), return_when=asyncio.FIRST_COMPLETED)
+            if local in done:
+                return local.result()
+            del self._remote[channel]
+            return remote.result()
+        finally:
+            local.cancel()
+            self._receiving[channel] -= 1
+            if not self._receiving[channel]:
+                del self._receiving[channel]
+            self._release(channel)
+
+    def _release(self, channel):
+        """Forget a channel nothing waits on and no group reaches."""
+        if channel in self._receiving or self._memberships.get(channel):
+            return
+        remote = self._remote.get(channel)
+        if remote is not None and not remote.done():
+            remote.cancel()
+            del self._remote[channel]
+        queue = self._queues.get(channel)
+        if queue is not None and queue.empty() and channel not in self._remote:
+            del self._queues[channel]
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self._queues.setdefault(channel, asyncio.Queue())
+        self._memberships[channel].add(group)
+        self._groups[group].add(channel)
+        await self._sync_group(group, refresh=True)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        members = self._groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self._groups[group]
+        groups = self._memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self._memberships[channel]
+        self._release(channel)
+        await self._sync_group(group)
+
+    async def _sync_group(self, group, refresh=False):
+        """
+        Keep the worker channel in `group` on the inner layer while it has
+        local members; `refresh` renews the membership's expiry.
+        """
+        async with self._membership_lock:
+            if group in self._groups and (refresh or group not in self._joined):
+                await self.inner.group_add(group, await self._ensure_fan_in())
+                self._joined.add(group)
+            elif group not in self._groups and group in self._joined:
+                await self.inner.group_discard(group, self._worker_channel)
+                self._joined.discard(group)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        self._deliver(group, message)
+        await self.inner.group_send(
+            group, {'type': FANOUT_TYPE, 'origin': self.worker_id, 'group': group, 'message': message}
+        )
+        metrics.counter('channel_layer.remote_publishes').inc()
+
+    def _deliver(self, group, message):
+        for channel in self._groups.get(group, ()):
+            queue = self._queues.get(channel)
+            # Full channels miss the message, like with any group_send
+            if queue is not None and queue.qsize() < self.get_capacity(channel):
+                queue.put_nowait(deepcopy(message))
+                metrics.counter('channel_layer.local_deliveries').inc()
+
+    async def _ensure_fan_in(self):
+        """Start receiving this worker's inner group messages; returns the worker channel."""
+        if self._worker_channel is None:
+            self._worker_channel = await self.inner.new_channel('hybrid.')
+        loop = asyncio.get_running_loop()
+        if self._fan_in_task is None or self._fan_in_task.done() or self._fan_in_task.get_loop() is not loop:
+            self._fan_in_task = loop.create_task(self._fan_in())
+        if self._refresh_task is None or self._refresh_task.done() or self._refresh_task.get_loop() is not loop:
+            self._refresh_task = loop.create_task(self._refresh_groups())
+        return self._worker_channel
+
+    async def _refresh_groups(self):
+        """Renew the worker channel's inner memberships before they expire."""
+        while True:
+            await asyncio.sleep(self.group_refresh)
+            for group in list(self._joined):
+                try:
+                    await self._sync_group(group, refresh=True)
+                except Exception as e:
+                    print(f"Channel layer group refresh error: {e}")
+
+    async def _fan_in(self):
+        while True:
+            try:
+                event = await self.inner.receive(self._worker_channel)
+            except Exception as e:
+                print(f"Channel layer fan-in error: {e}")
+                await asyncio.sleep(1)
+                continue
+            if event.get('type') != FANOUT_TYPE:
+                continue
+            if event['origin'] == self.worker_id:
+                # Already delivered by group_send
+                metrics.counter('channel_layer.own_copies_dropped').inc()
+                continue
+            self._deliver(event['group'], event['message'])
+
+    # Flush extension
+
+    async def flush(self):
+        self._queues.clear()
+        self._receiving.clear()
+        for remote in self._remote.values():
+            remote.cancel()
+        self._remote.clear()
+        self._groups.clear()
+        self._memberships.clear()
+        self._joined.clear()
+        for task in (self._fan_in_task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+        self._fan_in_task = self._refresh_task = None
+        await self.inner.flush()
+
+
+class HashRing:
+    """Consistent hashing of keys onto named nodes."""
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = list(nodes)
+        points = sorted((self.hash(f"{node}:{i}"), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def node_for(self, key):
+        return self._nodes[bisect.bisect(self._hashes, self.hash(key)) % len(self._hashes)]
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """
+    Groups spread over several layers by consistent hashing of their name.
+
+        "CONFIG": {
+            "shards": {"a": {"BACKEND": ..., "CONFIG": ...}, "b": {...}},
+            "ring": ["a", "b"],  # shards owning groups, default all
+            "migration": {"from": ["a"], "phase": "dual"},  # while rebalancing
+        }
+
+    A channel lives on a home shard, named in the channel name
+    (`<shard>.<inner name>`), which receives its direct sends. When it
+    joins a group owned by another shard it gets an alias channel there,
+    and receive() listens on all of them.
+
+    Changing the ring moves ~1/N of the groups. Roll it out in three
+    deploys so that no worker misses a member, whichever config it runs:
+    "dual" (joins go to the old and new owner, sends to the old one),
+    "cutover" (joins to both, sends to the new owner), then the new ring
+    without "migration". A shard leaving the ring stays in "shards" until
+    the channels homed on it are gone.
+    """
+
+    extensions = ['groups', 'flush']
+    shard_name_regex = re.compile(r"^[a-zA-Z\d\-_]+$")
+
+    def __init__(self, shards, ring=None, migration=None, replicas=64, expiry=60, capacity=100,
+                 channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        assert all(self.shard_name_regex.match(name) for name in shards), "Invalid shard name"
+        self.shards = {name: build_layer(config) for name, config in shards.items()}
+        self.ring = HashRing(ring or list(self.shards), replicas)
+        self.previous_ring = HashRing(migration['from'], replicas) if migration else None
+        self.send_to_previous = bool(migration) and migration.get('phase', 'dual') == 'dual'
+        assert set(self.ring.nodes) <= set(self.shards), "Ring names an unknown shard"
+        assert not migration or set(migration['from']) <= set(self.shards), "Migration names an unknown shard"
+        self._homes = itertools.cycle(self.ring.nodes)
+        self._aliases = {}  # channel -> {shard: channel name on that shard}
+        self._pending = defaultdict(dict)  # channel -> {shard: pending receive}
+        self._aliases_changed = {}  # channel -> asyncio.Event
+        self._receiving = Counter()  # channel -> pending receive() calls
+        self._memberships = defaultdict(set)  # channel -> groups
+
+    def _split(self, channel):
+        """(home shard, name on it) of a channel from new_channel(), else (None, channel)."""
+        home, _, inner = channel.partition('.')
+        if '!' in channel and home in self.shards:
+            return home, inner
+        return None, channel
+
+    def owners(self, group):
+        """Shards that hold `group`'s members."""
+        owners = {self.ring.node_for(group)}
+        if self.previous_ring is not None:
+            owners.add(self.previous_ring.node_for(group))
+        return owners
+
+    def sender(self, group):
+        """The shard a group_send to `group` goes to."""
+        return (self.previous_ring if self.send_to_previous else self.ring).node_for(group)
+
+    async def new_channel(self, prefix="specific."):
+        home = next(self._homes)
+        inner = await self.shards[home].new_channel(prefix)
+        channel = f"{home}.{inner}"
+        self._aliases[channel] = {home: inner}
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        home, inner = self._split(channel)
+        await self.shards[home or self.ring.node_for(channel)].send(inner, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        aliases = self._aliases.get(channel)
+        if aliases is None:
+            home, inner = self._split(channel)
+            return await self.shards[home or self.ring.node_for(channel)].receive(inner)
+
+        pending = self._pending[channel]
+        changed = self._aliases_changed.setdefault(channel, asyncio.Event())
+        self._receiving[channel] += 1
+        try:
+            while True:
+                for shard, inner in aliases.items():
+                    if shard not in pending:
+                        pending[shard] = asyncio.ensure_future(self.shards[shard].receive(inner))
+                # Wake up too when group_add gives the channel a new alias
+                woken = asyncio.ensure_future(changed.wait())
+                try:
+                    done, _ = await asyncio.wait((*pending.values(), woken), return_when=asyncio.FIRST_COMPLETED)
+                except asyncio.CancelledError:
+                    for shard, task in list(pending.items()):
+                        if not task.done():
+                            task.cancel()
+                            del pending[shard]
+                    raise
+                finally:
+                    woken.cancel()
+                changed.clear()
+                for shard, task in pending.items():
+                    if task in done:
+                        del pending[shard]
+                        return task.result()
+        finally:
+            self._receiving[channel] -= 1
+            if not self._receiving[channel]:
+                del self._receiving[channel]
+            self._release(channel)
+
+    def _release(self, channel):
+        """
+        Forget the aliases of a channel nothing waits on and no group
+        reaches. Direct sends still find it on its home shard.
+        """
+        if channel in self._receiving or self._memberships.get(channel):
+            return
+        pending = self._pending.get(channel, {})
+        if any(task.done() for task in pending.values()):
+            # A message the next receive() returns
+            return
+        for task in pending.values():
+            task.cancel()
+        self._pending.pop(channel, None)
+        self._aliases.pop(channel, None)
+        self._aliases_changed.pop(channel, None)
+
+    async def _alias(self, channel, shard):
+        """The name of `channel` on `shard`, created on first use."""
+        aliases = self._aliases.get(channel)
+        if aliases is None:
+            home, inner = self._split(channel)
+            if home is None:
+                # Not from new_channel(): only reachable under its own name
+                return inner
+            # Released while it had no groups, see _release()
+            aliases = self._aliases[channel] = {home: inner}
+        if shard not in aliases:
+            # Same prefix as on the home shard, for channel_capacity patterns
+            home_name = next(iter(aliases.values()))
+            prefix = home_name.split('.', 1)[0] + '.' if '.' in home_name else 'specific.'
+            aliases[shard] = await self.shards[shard].new_channel(prefix)
+            self._aliases_changed.setdefault(channel, asyncio.Event()).set()
+        return aliases[shard]
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if self._split(channel)[0] is not None:
+            self._memberships[channel].add(group)
+        for shard in self.owners(group):
+            await self.shards[shard].group_add(group, await self._alias(channel, shard))
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        for shard in self.owners(group):
+            aliases = self._aliases.get(channel)
+            if aliases is None:
+                await self.shards[shard].group_discard(group, self._split(channel)[1])
+            elif shard in aliases:
+                await self.shards[shard].group_discard(group, aliases[shard])
+        groups = self._memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self._memberships[channel]
+        self._release(channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        await self.shards[self.sender(group)].group_send(group, message)
+
+    # Flush extension
+
+    async def flush(self):
+        for pending in self._pending.values():
+            for task in pending.values():
+                task.cancel()
+        self._pending.clear()
+        self._aliases.clear()
+        self._aliases_changed.clear()
+        self._receiving.clear()
+        self._memberships.clear()
+        for layer in self.shards.values():
+            await layer.flush()
@@ -0,0 +1,39 @@
+"""Shared helpers for the bench_* management commands."""
+
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+@contextmanager
+def throwaway_database():
+    """
+    Run the benchmark against a freshly migrated test database, like the
+    test runner does, so seeding never touches real data.
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def timed(fn, runs=5):
+    """Median wall time of `fn()` in milliseconds over `runs` runs."""
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def seed_users(count, prefix='bench'):
+    from authapp.models import CustomUser
+    CustomUser.objects.bulk_create([
+        CustomUser(username=f"{prefix}{i:06d}", password='!') for i in range(count)
+    ], batch_size=2000)
+    return list(CustomUser.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
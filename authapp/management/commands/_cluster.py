@@ -0,0 +1,240 @@
+"""
+Pieces of the bench_cluster harness, importable by its worker processes.
+
+A stand-in layer node is an in-memory channel layer served over TCP with
+newline-delimited JSON, and `NodeChannelLayer` is its client. Like Redis,
+it is shared by every worker that connects to it. It is only meant for
+the harness: messages must be JSON-serializable, and a receive cancelled
+while its reply is on the wire loses that message.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from collections import Counter
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+
+NODE_OPS = {'send', 'receive', 'group_add', 'group_discard', 'group_send', 'flush'}
+# Per-channel capacity of a node; high so the harness counts lost messages, not full queues
+NODE_CAPACITY = 100000
+
+
+def serve_node(ports):
+    """Run a layer node on a free port, reported on `ports`, until killed."""
+    async def main():
+        layer = InMemoryChannelLayer(capacity=NODE_CAPACITY)
+        server = await asyncio.start_server(lambda r, w: handle_client(layer, r, w), '127.0.0.1', 0)
+        ports.put(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+async def handle_client(layer, reader, writer):
+    tasks = {}
+
+    async def run(request):
+        try:
+            response = {'id': request['id'], 'result': await getattr(layer, request['op'])(*request['args'])}
+        except Exception as e:
+            response = {'id': request['id'], 'error': f"{type(e).__name__}: {e}"}
+        finally:
+            tasks.pop(request['id'], None)
+        writer.write(json.dumps(response).encode() + b"\n")
+
+    try:
+        async for line in reader:
+            request = json.loads(line)
+            if request['op'] == 'cancel':
+                task = tasks.pop(request['id'], None)
+                if task is not None:
+                    task.cancel()
+            elif request['op'] in NODE_OPS:
+                tasks[request['id']] = asyncio.create_task(run(request))
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        writer.close()
+
+
+class NodeChannelLayer(BaseChannelLayer):
+    """Client of a stand-in layer node; one connection per event loop."""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, host='127.0.0.1', port=None, **kwargs):
+        super().__init__(**kwargs)
+        self.host, self.port = host, port
+        self._ids = itertools.count()
+        self._futures = {}
+        self._connection = None  # (loop, task opening the connection)
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        if self._connection is None or self._connection[0] is not loop:
+            self._connection = (loop, loop.create_task(self._connect()))
+        return await asyncio.shield(self._connection[1])
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        asyncio.get_running_loop().create_task(self._read(reader))
+        return writer
+
+    async def _read(self, reader):
+        async for line in reader:
+            response = json.loads(line)
+            future = self._futures.pop(response['id'], None)
+            if future is None or future.done():
+                continue
+            if 'error' in response:
+                future.set_exception(RuntimeError(response['error']))
+            else:
+                future.set_result(response['result'])
+
+    async def _call(self, op, *args):
+        writer = await self._writer()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[request_id] = future
+        writer.write(json.dumps({'id': request_id, 'op': op, 'args': args}).encode() + b"\n")
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self._futures.pop(request_id, None)
+            writer.write(json.dumps({'id': request_id, 'op': 'cancel'}).encode() + b"\n")
+            raise
+
+    async def new_channel(self, prefix="specific."):
+        return f"{prefix}node!{uuid.uuid4().hex[:12]}"
+
+    async def send(self, channel, message):
+        await self._call('send', channel, message)
+
+    async def receive(self, channel):
+        return await self._call('receive', channel)
+
+    async def group_add(self, group, channel):
+        await self._call('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        await self._call('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        await self._call('group_send', group, message)
+
+    async def flush(self):
+        await self._call('flush')
+
+
+def cluster_layers(ports):
+    """CHANNEL_LAYERS of a worker: the production stack over the given nodes."""
+    return {
+        'default': {
+            'BACKEND': 'authapp.layers.HybridChannelLayer',
+            'CONFIG': {'inner': {
+                'BACKEND': 'authapp.layers.ShardedChannelLayer',
+                'CONFIG': {'shards': {
+                    f"node{index}": {
+                        'BACKEND': 'authapp.management.commands._cluster.NodeChannelLayer',
+                        'CONFIG': {'port': port},
+                    }
+                    for index, port in enumerate(ports)
+                }},
+            }},
+        },
+    }
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """PrivateChatConsumer's messaging path without the database."""
+
+    async def connect(self):
+        self.group = self.scope['group']
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        await self.channel_layer.group_send(self.group, {'type': 'chat_message', 'text': text_data})
+
+    async def chat_message(self, event):
+        await self.send(text_data=event['text'])
+
+
+class Socket:
+    """A WebSocket connection driven straight through the ASGI interface."""
+
+    def __init__(self, app, group):
+        self.inbox, self.outbox = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'websocket', 'path': '/ws/cluster/', 'query_string': b'', 'headers': [], 'group': group}
+        self.task = asyncio.create_task(app(scope, self.inbox.get, self.outbox.put))
+        self.received = Counter()
+        self.last_received_at = None
+
+    async def connect(self):
+        await self.inbox.put({'type': 'websocket.connect'})
+        assert (await self.outbox.get())['type'] == 'websocket.accept'
+
+    def send(self, text):
+        self.inbox.put_nowait({'type': 'websocket.receive', 'text': text})
+
+    async def collect(self, expected, done):
+        while sum(self.received.values()) < expected:
+            event = await self.outbox.get()
+            if event['type'] == 'websocket.send':
+                self.received[event['text']] += 1
+                self.last_received_at = time.perf_counter()
+        done.release()
+
+
+def run_worker(ports, sockets, messages, barrier, results, timeout):
+    """
+    Serve `sockets` [(chat, sends)] on a fresh channel layer stack, send
+    `messages` messages on each socket with sends=True once every worker
+    is connected, and report what arrived.
+    """
+    import django
+    django.setup()
+    from django.conf import settings
+    settings.CHANNEL_LAYERS = cluster_layers(ports)
+    results.put(asyncio.run(_worker(sockets, messages, barrier, timeout)))
+
+
+async def _worker(plan, messages, barrier, timeout):
+    app = ChatConsumer.as_asgi()
+    sockets = [(Socket(app, f"chat_{chat}"), chat, sends) for chat, sends in plan]
+    for socket, _, _ in sockets:
+        await socket.connect()
+    await asyncio.to_thread(barrier.wait)
+
+    started = time.perf_counter()
+    done = asyncio.Semaphore(0)
+    collectors = [asyncio.create_task(socket.collect(messages, done)) for socket, _, _ in sockets]
+    for socket, chat, sends in sockets:
+        if sends:
+            for n in range(messages):
+                socket.send(f"{chat}:{n}")
+    try:
+        await asyncio.wait_for(asyncio.gather(*(done.acquire() for _ in sockets)), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+    missing = duplicates = delivered = 0
+    for socket, chat, _ in sockets:
+        for n in range(messages):
+            count = socket.received[f"{chat}:{n}"]
+            delivered += min(count, 1)
+            missing += count == 0
+            duplicates += max(count - 1, 0)
+    finished = [s.last_received_at for s, _, _ in sockets if s.last_received_at is not None]
+    for task in collectors:
+        task.cancel()
+    return {
+        'delivered': delivered,
+        'missing': missing,
+        'duplicates': duplicates,
+        'elapsed': (max(finished) - started) if finished else 0,
+    }
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from authapp.retention import POLICIES, purge_user, run_policy
+
+
+class Command(BaseCommand):
+    help = "Delete expired rows in small, throttled, resumable batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--policy', action='append', choices=sorted(POLICIES),
+                            help="Only run these policies (default: all configured).")
+        parser.add_argument('--purge-user', type=int, metavar='USER_ID',
+                            help="Delete this user and their chats in batches instead.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report how many rows would go.")
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--sleep', type=float, default=None, help="Seconds to pause between batches.")
+
+    def handle(self, *args, **options):
+        verb = "would delete" if options['dry_run'] else "deleted"
+        log = None if options['dry_run'] or options['verbosity'] < 2 else self.stdout.write
+        kwargs = dict(dry_run=options['dry_run'], batch_size=options['batch_size'], sleep=options['sleep'], log=log)
+
+        if options['purge_user'] is not None:
+            counts = purge_user(options['purge_user'], **kwargs)
+            if not options['dry_run'] and not counts['users']:
+                raise CommandError(f"User {options['purge_user']} does not exist.")
+            for table, rows in counts.items():
+                self.stdout.write(f"{table}: {verb} {rows}")
+            return
+
+        for name in options['policy'] or sorted(POLICIES):
+            policy = POLICIES[name]
+            if policy.max_age() is None:
+                self.stdout.write(f"{name}: disabled")
+                continue
+            rows = run_policy(policy, **kwargs)
+            self.stdout.write(f"{name}: {verb} {rows} row(s) older than {policy.max_age().days} days")
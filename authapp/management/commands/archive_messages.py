@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authapp.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = "Move messages older than the archive age into compressed per-chat segment files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+                            help="Archive messages older than this many days.")
+        parser.add_argument('--block-size', type=int, default=settings.MESSAGE_ARCHIVE_BLOCK_SIZE,
+                            help="Messages per compressed block.")
+
+    def handle(self, *args, **options):
+        moved = archive_messages(timedelta(days=options['days']), options['block_size'])
+        self.stdout.write(f"Archived {moved} message(s) to {settings.MESSAGE_ARCHIVE_DIR}")
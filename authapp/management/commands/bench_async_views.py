@@ -0,0 +1,135 @@
+import asyncio
+import statistics
+import threading
+import time
+
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+from django.urls import reverse
+
+from authapp import messaging
+from authapp.models import FriendRequest, Message
+
+from ._bench import seed_users, throwaway_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent requests at the sync and async read endpoints through the ASGI "
+        "application and compare throughput, latency and threads in use."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,10,50,200', help="Requests in flight at once.")
+        parser.add_argument('--requests', type=int, default=400, help="Requests per run.")
+        parser.add_argument('--db-latency-ms', type=float, default=20,
+                            help="Delay added to every query, standing in for a busy or distant database.")
+        parser.add_argument('--messages', type=int, default=50, help="Messages in the history page.")
+
+    def handle(self, *args, **options):
+        latency = options['db_latency_ms'] / 1000
+
+        def slow_query(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def add_latency(sender, connection, **kwargs):
+            connection.execute_wrappers.append(slow_query)
+
+        with throwaway_database():
+            me, friend = seed_users(2)
+            FriendRequest.objects.create(from_user_id=me, to_user_id=friend, status='accepted')
+            chat = messaging.get_or_create_chat(me, friend)
+            Message.objects.bulk_create([
+                Message(chat=chat, sender_id=me if i % 2 else friend, message=f"message {i}")
+                for i in range(options['messages'])
+            ])
+            from rest_framework.authtoken.models import Token
+            headers = [(b'authorization', f"Token {Token.objects.create(user_id=me).key}".encode()),
+                       (b'host', b'localhost')]
+            endpoints = [
+                ('history', reverse('message-history', args=[friend]),
+                 reverse('async-message-history', args=[friend])),
+                ('chat list', reverse('user-list'), reverse('async-user-list')),
+                ('status', reverse('user-status', args=[friend]), reverse('async-user-status', args=[friend])),
+            ]
+
+            connection_created.connect(add_latency)
+            try:
+                app = get_asgi_application()
+                self.stdout.write(
+                    f"{options['requests']} requests per run, {options['db_latency_ms']:g} ms added per query"
+                )
+                self.stdout.write(
+                    f"{'endpoint':<10} {'view':<6} {'in flight':>9} {'req/s':>8} {'p50 ms':>8} "
+                    f"{'p99 ms':>8} {'threads':>8}"
+                )
+                for name, sync_path, async_path in endpoints:
+                    for concurrency in [int(n) for n in options['concurrency'].split(',')]:
+                        for view, path in (('sync', sync_path), ('async', async_path)):
+                            result = asyncio.run(self.run(app, path, headers, concurrency, options['requests']))
+                            self.stdout.write(
+                                f"{name:<10} {view:<6} {concurrency:>9} {result['rate']:>8.0f} "
+                                f"{result['p50']:>8.1f} {result['p99']:>8.1f} {result['threads']:>8}"
+                            )
+            finally:
+                connection_created.disconnect(add_latency)
+
+    async def run(self, app, path, headers, concurrency, total):
+        latencies, statuses = [], set()
+        remaining = iter(range(total))
+        peak_threads = threading.active_count()
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while True:
+                peak_threads = max(peak_threads, threading.active_count())
+                await asyncio.sleep(0.005)
+
+        async def client():
+            for _ in remaining:
+                started = time.perf_counter()
+                statuses.add(await request(app, path, headers))
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        sampler = asyncio.create_task(sample_threads())
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+        assert statuses == {200}, statuses
+        latencies.sort()
+        return {
+            'rate': total / elapsed,
+            'p50': statistics.median(latencies),
+            'p99': latencies[int(len(latencies) * 0.99)],
+            'threads': peak_threads,
+        }
+
+
+async def request(app, path, headers):
+    """One GET through the ASGI interface; returns the status code."""
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': headers, 'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+    }
+    sent = asyncio.Event()
+    status = None
+
+    async def receive():
+        if not sent.is_set():
+            sent.set()
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client stays connected until the response is done
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from authapp.layers import HybridChannelLayer
+
+
+class CountingLayer:
+    """Wraps the inner layer and counts the messages that travel through it."""
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.messages = 0
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    async def receive(self, channel):
+        message = await self.layer.receive(channel)
+        self.messages += 1
+        return message
+
+
+class Command(BaseCommand):
+    help = "Compare group_send latency and inner-layer traffic with and without the hybrid layer."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=10, help="Messages per chat.")
+        parser.add_argument('--remote-shares', default='0,0.5,1',
+                            help="Shares of chats whose two sockets are on different workers.")
+        parser.add_argument('--inner', default='channels.layers.InMemoryChannelLayer',
+                            help="Backend standing in for Redis, e.g. channels_redis.core.RedisChannelLayer.")
+        parser.add_argument('--inner-config', default='{}', help="JSON config for --inner.")
+
+    def handle(self, *args, **options):
+        backend = import_string(options['inner'])
+        config = json.loads(options['inner_config'])
+        self.stdout.write(
+            f"{options['chats']} chats x {options['messages']} messages, two sockets per chat, "
+            f"inner layer {options['inner']}"
+        )
+        self.stdout.write(
+            f"{'remote share':<13} {'layer':<8} {'p50 ms':>8} {'p99 ms':>8} {'inner msgs/send':>16}"
+        )
+        for share in [float(s) for s in options['remote_shares'].split(',')]:
+            for name in ('inner', 'hybrid'):
+                inner = CountingLayer(backend(**config))
+                if name == 'inner':
+                    workers = (inner, inner)
+                else:
+                    workers = (HybridChannelLayer(inner), HybridChannelLayer(inner))
+                latencies = asyncio.run(self.run(workers, options['chats'], options['messages'], share))
+                sends = options['chats'] * options['messages']
+                latencies.sort()
+                self.stdout.write(
+                    f"{share:<13} {name:<8} {statistics.median(latencies):>8.3f} "
+                    f"{latencies[int(len(latencies) * 0.99)]:>8.3f} {inner.messages / sends:>16.2f}"
+                )
+
+    async def run(self, workers, chats, messages, remote_share):
+        arrivals = asyncio.Queue()
+        latencies = []
+
+        async def reader(layer, channel):
+            while True:
+                message = await layer.receive(channel)
+                latencies.append((time.perf_counter() - message['sent_at']) * 1000)
+                arrivals.put_nowait(None)
+
+        groups, readers = [], []
+        for i in range(chats):
+            group = f"chat_{i}"
+            remote = i < chats * remote_share
+            for layer in (workers[0], workers[1] if remote else workers[0]):
+                channel = await layer.new_channel()
+                await layer.group_add(group, channel)
+                readers.append(asyncio.create_task(reader(layer, channel)))
+            groups.append(group)
+
+        for _ in range(messages):
+            for group in groups:
+                await workers[0].group_send(group, {'type': 'chat_message', 'sent_at': time.perf_counter()})
+                for _ in range(2):
+                    await asyncio.wait_for(arrivals.get(), 5)
+        for task in readers:
+            task.cancel()
+        return latencies
@@ -0,0 +1,80 @@
+import multiprocessing
+import os
+import random
+
+from django.core.management.base import BaseCommand
+
+from ._cluster import run_worker, serve_node
+
+
+class Command(BaseCommand):
+    help = (
+        "Run N ASGI chat workers against M stand-in channel layer nodes, check that every "
+        "message reaches both sockets of its chat exactly once, and report throughput."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,2,4', help="Worker counts to try.")
+        parser.add_argument('--shards', default='1,2,4', help="Layer node counts to try.")
+        parser.add_argument('--chats', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=20, help="Messages sent per chat.")
+        parser.add_argument('--timeout', type=float, default=60)
+
+    def handle(self, *args, **options):
+        self.context = multiprocessing.get_context('spawn')
+        self.stdout.write(
+            f"{options['chats']} chats with two sockets each, {options['messages']} messages per chat, "
+            f"{os.cpu_count()} CPUs"
+        )
+        self.stdout.write(f"{'shards':>6} {'workers':>7} {'delivered':>12} {'missing':>8} {'dupes':>6} {'msg/s':>9}")
+        failed = False
+        for shards in [int(n) for n in options['shards'].split(',')]:
+            for workers in [int(n) for n in options['workers'].split(',')]:
+                result = self.run(shards, workers, options)
+                expected = options['chats'] * 2 * options['messages']
+                failed |= result['missing'] > 0 or result['duplicates'] > 0
+                self.stdout.write(
+                    f"{shards:>6} {workers:>7} {result['delivered']:>6}/{expected:<5} {result['missing']:>8} "
+                    f"{result['duplicates']:>6} {result['delivered'] / result['elapsed']:>9.0f}"
+                )
+        if failed:
+            self.stderr.write("Some messages were lost or duplicated.")
+
+    def run(self, shards, workers, options):
+        ports = self.context.Queue()
+        nodes = [self.context.Process(target=serve_node, args=(ports,), daemon=True) for _ in range(shards)]
+        for node in nodes:
+            node.start()
+        node_ports = [ports.get(timeout=30) for _ in nodes]
+
+        # Both sockets of a chat land on random workers, so some chats are
+        # local to one worker and others span two
+        rng = random.Random(0)
+        plans = [[] for _ in range(workers)]
+        for chat in range(options['chats']):
+            plans[rng.randrange(workers)].append((chat, True))
+            plans[rng.randrange(workers)].append((chat, False))
+
+        barrier = self.context.Barrier(workers)
+        results = self.context.Queue()
+        processes = [
+            self.context.Process(
+                target=run_worker,
+                args=(node_ports, plan, options['messages'], barrier, results, options['timeout']),
+            )
+            for plan in plans
+        ]
+        try:
+            for process in processes:
+                process.start()
+            reports = [results.get(timeout=options['timeout'] + 60) for _ in processes]
+        finally:
+            for process in processes + nodes:
+                process.terminate()
+                process.join()
+        return {
+            'delivered': sum(r['delivered'] for r in reports),
+            'missing': sum(r['missing'] for r in reports),
+            'duplicates': sum(r['duplicates'] for r in reports),
+            'elapsed': max(r['elapsed'] for r in reports) or 1e-9,
+        }
@@ -0,0 +1,91 @@
+import gzip
+import json
+import random
+import zlib
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from authapp import compression, rows
+from authapp.models import Chat, Message
+
+from ._bench import seed_users, throwaway_database, timed
+
+WORDS = (
+    "ok yes no sure thanks lol haha see you tomorrow tonight later meeting lunch dinner coffee call me "
+    "when are we leaving I think that sounds good maybe next week can't make it running late almost there "
+    "did you see the game the build is broken again deploy finished review my PR please what time works "
+    "for you let me check great idea sorry just saw this"
+).split()
+EMOJI = ["👍", "😂", "🎉", "🙏", "❤️", "😅"]
+
+
+def chat_text(rng):
+    """Short messages mostly, now and then a paragraph, a link or an emoji."""
+    length = min(int(rng.expovariate(1 / 9)) + 1, 120)
+    words = [rng.choice(WORDS) for _ in range(length)]
+    if rng.random() < 0.1:
+        words.append(f"https://example.com/{rng.getrandbits(40):x}")
+    if rng.random() < 0.2:
+        words.append(rng.choice(EMOJI))
+    return " ".join(words)
+
+
+class Command(BaseCommand):
+    help = "Measure bytes saved and CPU spent compressing history pages and WebSocket batch frames."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', default='50,200,1000', help="History page sizes (messages).")
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        sizes = [int(n) for n in options['pages'].split(',')]
+        codecs = [
+            ('gzip-1', lambda b: gzip.compress(b, 1, mtime=0), gzip.decompress),
+            ('gzip-6', lambda b: gzip.compress(b, 6, mtime=0), gzip.decompress),
+            ('gzip-9', lambda b: gzip.compress(b, 9, mtime=0), gzip.decompress),
+            ('zlib-6 (ws)', lambda b: zlib.compress(b, 6), zlib.decompress),
+        ]
+        if compression.brotli is not None:
+            brotli = compression.brotli
+            codecs += [
+                (f'br-{q}', lambda b, q=q: brotli.compress(b, quality=q), brotli.decompress) for q in (1, 4, 11)
+            ]
+        else:
+            self.stdout.write("brotli is not installed, gzip/zlib only")
+
+        with throwaway_database():
+            me, friend = seed_users(2)
+            chat = Chat.objects.create(user1_id=me, user2_id=friend)
+            rng = random.Random(0)
+            Message.objects.bulk_create([
+                Message(chat=chat, sender_id=rng.choice((me, friend)), message=chat_text(rng))
+                for _ in range(max(sizes))
+            ], batch_size=2000)
+
+            payloads = []
+            for size in sizes:
+                page = rows.message_rows(Message.objects.filter(chat=chat).order_by('-id')[:size])[::-1]
+                payloads.append((f"history {size}", JSONRenderer().render(page)))
+            batch = [
+                {"id": m['id'], "client_id": f"c{m['id']}", "message": m['message'], "timestamp": m['timestamp']}
+                for m in rows.message_rows(Message.objects.filter(chat=chat).order_by('id')[:100])
+            ]
+            payloads.append(("ws batch 100", json.dumps({"type": "chat_messages", "messages": batch}).encode()))
+
+        self.stdout.write(f"median of {options['runs']} runs")
+        self.stdout.write(
+            f"{'payload':<14} {'codec':<12} {'raw KB':>8} {'sent KB':>8} {'saved':>6} "
+            f"{'compress ms':>12} {'MB/s':>7} {'inflate ms':>11}"
+        )
+        for name, body in payloads:
+            for codec, compress, decompress in codecs:
+                packed = compress(body)
+                assert decompress(packed) == body
+                compress_ms = timed(lambda: compress(body), options['runs'])
+                inflate_ms = timed(lambda: decompress(packed), options['runs'])
+                self.stdout.write(
+                    f"{name:<14} {codec:<12} {len(body) / 1024:>8.1f} {len(packed) / 1024:>8.1f} "
+                    f"{1 - len(packed) / len(body):>6.0%} {compress_ms:>12.2f} "
+                    f"{len(body) / 1e6 / (compress_ms / 1000):>7.0f} {inflate_ms:>11.2f}"
+                )
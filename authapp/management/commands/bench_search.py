@@ -0,0 +1,58 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from authapp import search
+from authapp.models import Chat, CustomUser, Message
+
+from ._bench import seed_users, throwaway_database, timed
+
+WORDS = (
+    "hello there lunch meeting tomorrow project deadline coffee weekend movie "
+    "train station photos budget review ticket invoice birthday party football"
+).split()
+
+
+class Command(BaseCommand):
+    help = "Show that message search time stays flat as the total message count grows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000',
+                            help="Comma-separated total message counts to test.")
+        parser.add_argument('--own-messages', type=int, default=1000,
+                            help="Messages in the searching user's own chats (constant).")
+        parser.add_argument('--query', default='lunch meeting')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        with throwaway_database():
+            self.stdout.write(f"{'messages':>10} {'ms/query':>10} {'hits':>6}")
+            user_ids = seed_users(1000)
+            me = CustomUser.objects.get(id=user_ids[0])
+            own_chats = Chat.objects.bulk_create([Chat(user1_id=me.id, user2_id=uid) for uid in user_ids[1:21]])
+            other_chats = Chat.objects.bulk_create([
+                Chat(user1_id=user_ids[i], user2_id=user_ids[i + 1]) for i in range(21, len(user_ids) - 1, 2)
+            ])
+            self.add_messages(own_chats, options['own_messages'])
+
+            total = options['own_messages']
+            rng = random.Random(0)
+            for size in sizes:
+                if size > total:
+                    self.add_messages(other_chats, size - total, rng)
+                    total = size
+                results, _ = search.search_messages(me, options['query'], limit=20)
+                ms = timed(lambda: search.search_messages(me, options['query'], limit=20))
+                self.stdout.write(f"{total:>10} {ms:>10.2f} {len(results):>6}")
+
+    def add_messages(self, chats, count, rng=None):
+        rng = rng or random.Random(1)
+        for start in range(0, count, 5000):
+            batch = []
+            for _ in range(min(5000, count - start)):
+                chat = rng.choice(chats)
+                batch.append(Message(
+                    chat=chat, sender_id=chat.user1_id,
+                    message=" ".join(rng.choice(WORDS) for _ in range(8)),
+                ))
+            search.index_messages(Message.objects.bulk_create(batch))
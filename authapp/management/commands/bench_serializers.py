@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Case, CharField, F, IntegerField, OuterRef, Q, Subquery, When
+
+from authapp import rows
+from authapp.models import Chat, CustomUser, FriendRequest, Message
+from authapp.serializers import ChatListSerializer, FriendRequestSerializer, MessageSerializer
+
+from ._bench import seed_users, throwaway_database, timed
+
+
+class Command(BaseCommand):
+    help = "Compare the per-row cost of the DRF serializers with the values()-based rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help="Rows per payload.")
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        count, runs = options['rows'], options['runs']
+        with throwaway_database():
+            user_ids = seed_users(count + 1)
+            me = CustomUser.objects.get(id=user_ids[0])
+            chats = Chat.objects.bulk_create(
+                [Chat(user1_id=me.id, user2_id=uid) for uid in user_ids[1:]], batch_size=2000
+            )
+            Message.objects.bulk_create(
+                [Message(chat=chats[0], sender_id=me.id, message=f"message {i}") for i in range(count)],
+                batch_size=2000,
+            )
+            Message.objects.bulk_create(
+                [Message(chat=chat, sender_id=chat.user2_id, message="hi") for chat in chats], batch_size=2000
+            )
+            FriendRequest.objects.bulk_create(
+                [FriendRequest(from_user_id=uid, to_user=me) for uid in user_ids[1:]], batch_size=2000
+            )
+
+            messages = Message.objects.filter(chat=chats[0], sender=me).order_by('timestamp')
+            requests = FriendRequest.objects.filter(to_user=me, status='pending')
+            chat_list = self.chat_list(me)
+            cases = [
+                ('messages',
+                 lambda: MessageSerializer(messages.select_related('sender').prefetch_related('attachments__file'),
+                                           many=True).data,
+                 lambda: rows.message_rows(messages)),
+                ('friend requests',
+                 lambda: FriendRequestSerializer(requests.select_related('from_user', 'to_user'), many=True).data,
+                 lambda: rows.friend_request_rows(requests)),
+                ('chat list',
+                 lambda: ChatListSerializer(chat_list.all(), many=True).data,
+                 lambda: rows.chat_rows(chat_list.all())),
+            ]
+
+            self.stdout.write(f"{count} rows per payload, query included, median of {runs} runs")
+            self.stdout.write(f"{'payload':<16} {'serializer us/row':>18} {'rows us/row':>12} {'speedup':>8}")
+            for name, slow, fast in cases:
+                assert len(slow()) == len(fast()) == count
+                slow_ms, fast_ms = timed(slow, runs), timed(fast, runs)
+                self.stdout.write(
+                    f"{name:<16} {slow_ms * 1000 / count:>18.2f} {fast_ms * 1000 / count:>12.2f} "
+                    f"{slow_ms / fast_ms:>7.1f}x"
+                )
+
+    def chat_list(self, me):
+        # Same annotations as UserListAPI.get_queryset
+        latest_message = Message.objects.filter(chat=OuterRef('pk')).order_by('-timestamp')
+        return Chat.objects.filter(Q(user1=me) | Q(user2=me)).annotate(
+            other_user_id=Case(
+                When(user1=me, then=F('user2')), When(user2=me, then=F('user1')), output_field=IntegerField()
+            ),
+            other_user_username=Case(
+                When(user1=me, then=F('user2__username')), When(user2=me, then=F('user1__username')),
+                output_field=CharField()
+            ),
+            latest_message_content=Subquery(latest_message.values('message')[:1]),
+            latest_message_time=Subquery(latest_message.values('timestamp')[:1]),
+        ).order_by('-latest_message_time')
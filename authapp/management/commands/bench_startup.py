@@ -0,0 +1,74 @@
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# "import time: <self us> | <cumulative us> | <indent><module>"
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+class Command(BaseCommand):
+    help = "Compare the cold import time of the ASGI entry points, per module."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entry', action='append',
+                            help="Module to import, repeatable (default backend.asgi and backend.ws_asgi).")
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--top', type=int, default=15, help="Modules listed per entry point.")
+
+    def handle(self, *args, **options):
+        entries = options['entry'] or ['backend.asgi', 'backend.ws_asgi']
+        self.stdout.write(f"median of {options['runs']} cold imports, python -X importtime")
+        for entry in entries:
+            runs = [self.import_times(entry) for _ in range(options['runs'])]
+            total = statistics.median(run[entry][1] for run in runs) / 1000
+            self.stdout.write(f"\n{entry}: {total:.1f} ms, {len(runs[0])} modules")
+
+            cumulative = defaultdict(list)
+            self_times = defaultdict(list)
+            for run in runs:
+                for module, (self_us, cumulative_us, _) in run.items():
+                    cumulative[module].append(cumulative_us)
+                    self_times[module].append(self_us)
+            # The entry point's imports and theirs
+            ranked = sorted(
+                (module for module, (_, _, depth) in runs[0].items() if 1 <= depth <= 2),
+                key=lambda module: statistics.median(cumulative[module]),
+                reverse=True,
+            )
+            self.stdout.write(f"  {'module':<40} {'cumulative ms':>14} {'self ms':>8}")
+            for module in ranked[:options['top']]:
+                self.stdout.write(
+                    f"  {module:<40} {statistics.median(cumulative[module]) / 1000:>14.1f} "
+                    f"{statistics.median(self_times[module]) / 1000:>8.1f}"
+                )
+
+    def import_times(self, entry):
+        """{module: (self us, cumulative us, depth)} of one cold `import entry`."""
+        env = dict(os.environ)
+        # Let each entry point pick its own settings module
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f"import {entry}"],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        )
+        # Modules are listed after their dependencies, so the entry's own
+        # imports are the lines since the previous top-level one
+        times = {}
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if not match:
+                continue
+            self_us, cumulative_us, indent, module = match.groups()
+            depth = len(indent) // 2
+            times[module] = (int(self_us), int(cumulative_us), depth)
+            if depth == 0:
+                if module == entry:
+                    return times
+                times = {}
+        raise RuntimeError(f"{entry} missing from the -X importtime output")
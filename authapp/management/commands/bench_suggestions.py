@@ -0,0 +1,91 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from authapp import suggestions
+from authapp.models import CustomUser, FriendRequest, FriendSuggestion
+
+from ._bench import seed_users, throwaway_database, timed
+
+# Mutual-friend counts computed per request with a self-join, for comparison
+SELF_JOIN_SQL = """
+    WITH friends AS (
+        SELECT to_user_id AS id FROM authapp_friendrequest WHERE from_user_id = %(me)s AND status = 'accepted'
+        UNION
+        SELECT from_user_id FROM authapp_friendrequest WHERE to_user_id = %(me)s AND status = 'accepted'
+    ), fof AS (
+        SELECT fr.to_user_id AS id FROM friends JOIN authapp_friendrequest fr
+            ON fr.from_user_id = friends.id AND fr.status = 'accepted'
+        UNION ALL
+        SELECT fr.from_user_id FROM friends JOIN authapp_friendrequest fr
+            ON fr.to_user_id = friends.id AND fr.status = 'accepted'
+    )
+    SELECT id, COUNT(*) AS mutual FROM fof
+    WHERE id <> %(me)s AND id NOT IN (SELECT id FROM friends)
+    GROUP BY id
+    ORDER BY mutual DESC, id
+    LIMIT 20
+"""
+
+
+class Command(BaseCommand):
+    help = "Time friend suggestions on a synthetic friendship graph."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--degree', type=int, default=8,
+                            help="Friendships started per user (average friend count is twice this).")
+        parser.add_argument('--samples', type=int, default=50, help="Users sampled for the read timings.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        with throwaway_database():
+            user_ids = seed_users(options['users'])
+            self.seed_graph(user_ids, options['degree'], rng)
+
+            started = time.perf_counter()
+            suggestions.rebuild()
+            self.stdout.write(
+                f"full rebuild: {time.perf_counter() - started:.1f}s, "
+                f"{FriendSuggestion.objects.count()} suggestions for {len(user_ids)} users"
+            )
+
+            sample = [CustomUser.objects.get(id=uid) for uid in rng.sample(user_ids, options['samples'])]
+            stored_ms = timed(lambda: [suggestions.suggestions_for(user) for user in sample], 3) / len(sample)
+            join_ms = timed(lambda: [self.self_join(user.id) for user in sample], 3) / len(sample)
+            self.stdout.write(f"read, precomputed: {stored_ms:.2f} ms/request")
+            self.stdout.write(f"read, self-join:   {join_ms:.2f} ms/request")
+
+            timings = []
+            for _ in range(options['samples']):
+                a, b = rng.sample(user_ids, 2)
+                if FriendRequest.objects.filter(from_user_id__in=(a, b), to_user_id__in=(a, b)).exists():
+                    continue
+                FriendRequest.objects.create(from_user_id=a, to_user_id=b, status='accepted')
+                started = time.perf_counter()
+                suggestions.friendship_added(a, b)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            self.stdout.write(f"incremental update per new friendship: {timings[len(timings) // 2]:.2f} ms median")
+
+    def seed_graph(self, user_ids, degree, rng):
+        edges = set()
+        for i, uid in enumerate(user_ids):
+            for _ in range(degree):
+                # Mostly local friendships, so friends of friends overlap
+                if rng.random() < 0.8:
+                    other = user_ids[min(len(user_ids) - 1, max(0, i + rng.randint(-200, 200)))]
+                else:
+                    other = rng.choice(user_ids)
+                if other != uid and (other, uid) not in edges:
+                    edges.add((uid, other))
+        FriendRequest.objects.bulk_create(
+            [FriendRequest(from_user_id=a, to_user_id=b, status='accepted') for a, b in edges], batch_size=5000
+        )
+
+    def self_join(self, user_id):
+        with connection.cursor() as cursor:
+            cursor.execute(SELF_JOIN_SQL, {'me': user_id})
+            return cursor.fetchall()
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authapp.attachments import delete_orphaned_files, expire_uploads
+
+
+class Command(BaseCommand):
+    help = "Discard abandoned uploads and delete stored files no attachment refers to."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=settings.ATTACHMENT_UPLOAD_EXPIRY_HOURS,
+                            help="Discard uploads idle, and unreferenced files older, than this.")
+
+    def handle(self, *args, **options):
+        older_than = timedelta(hours=options['hours'])
+        uploads, upload_bytes = expire_uploads(older_than)
+        files, file_bytes = delete_orphaned_files(older_than)
+        self.stdout.write(
+            f"Discarded {uploads} upload(s) ({upload_bytes} bytes) and {files} orphaned file(s) ({file_bytes} bytes)"
+        )
@@ -0,0 +1,45 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from authapp.models import User
+from authapp.presence import heartbeat_interval, reap_stale_connections
+
+
+class Command(BaseCommand):
+    help = "Expire stale connection leases and reconcile user presence from the live ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run a single pass and exit.")
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Seconds between passes (defaults to PRESENCE_HEARTBEAT_INTERVAL).")
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or heartbeat_interval()
+        while True:
+            went_offline = reap_stale_connections()
+            for user_id in went_offline:
+                self.broadcast_offline(user_id)
+            if went_offline:
+                self.stdout.write(f"Marked {len(went_offline)} user(s) offline: {went_offline}")
+            if options['once']:
+                return
+            time.sleep(interval)
+
+    def broadcast_offline(self, user_id):
+        channel_layer = get_channel_layer()
+        partners = User.objects.filter(
+            Q(chat_user1__user2_id=user_id) | Q(chat_user2__user1_id=user_id)
+        ).values_list('id', flat=True)
+        for partner_id in partners:
+            async_to_sync(channel_layer.group_send)(
+                f"chatlist_{partner_id}",
+                {
+                    "type": "status",
+                    "user_id": str(user_id),
+                    "status": "offline"
+                }
+            )
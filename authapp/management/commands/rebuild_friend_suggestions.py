@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from authapp import suggestions
+
+
+class Command(BaseCommand):
+    help = "Recompute every user's friend suggestions from the accepted friendships."
+
+    def handle(self, *args, **options):
+        suggestions.rebuild(log=self.stdout.write)
@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authapp.analytics import roll_up, sample_sockets
+
+
+class Command(BaseCommand):
+    help = "Fold new messages and the live socket count into the analytics rollups."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Catch up once and exit.")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Messages per transaction (defaults to ANALYTICS_BATCH_SIZE).")
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Seconds between passes (defaults to ANALYTICS_INTERVAL).")
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or settings.ANALYTICS_INTERVAL
+        while True:
+            folded = 0
+            while n := roll_up(options['batch_size']):
+                folded += n
+            sockets = sample_sockets()
+            if folded:
+                self.stdout.write(f"Rolled up {folded} message(s), {sockets} live socket(s)")
+            if options['once']:
+                return
+            time.sleep(interval)
@@ -0,0 +1,21 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from authapp.bot import BotWorkerPool
+
+
+class Command(BaseCommand):
+    help = "Answer queued bot jobs with a bounded pool of workers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help="Jobs handled at once (defaults to BOT_WORKERS).")
+
+    def handle(self, *args, **options):
+        pool = BotWorkerPool(concurrency=options['concurrency'])
+        self.stdout.write(f"Running {pool.concurrency} bot worker(s)")
+        try:
+            asyncio.run(pool.run())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,25 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authapp.notifications import send_due_digests
+
+
+class Command(BaseCommand):
+    help = "Send one digest per offline user whose missed messages are due."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run a single pass and exit.")
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Seconds between passes (defaults to NOTIFICATION_POLL_INTERVAL).")
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or settings.NOTIFICATION_POLL_INTERVAL
+        while True:
+            # Drain the backlog before sleeping
+            while sent := send_due_digests():
+                self.stdout.write(f"Sent {sent} digest(s)")
+            if options['once']:
+                return
+            time.sleep(interval)
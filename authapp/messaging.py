@@ -0,0 +1,191 @@
+# messaging.py
+"""
+Write path for chats and chat messages. Everything that creates either
+goes through here so the per-chat bookkeeping and the change feed stay
+in one place.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import attachments, changes, notifications, search
+from .models import Attachment, Chat, Message
+
+
+def chat_group(chat):
+    """Channel layer group of the chat's sockets."""
+    return f"chat_{chat.user1_id}_{chat.user2_id}"
+
+
+def chat_message_event(message):
+    """
+    Chat group event for a new `message` (with its sender loaded). It
+    carries the change feed payload, so clients can match the two by id.
+    """
+    return {
+        'type': 'chat_message',
+        **changes.message_payload(message),
+        'sender_id': str(message.sender_id),
+        'attachments': [attachments.attachment_payload(a) for a in getattr(message, 'attachment_list', [])],
+    }
+
+
+def get_or_create_chat(user_a_id, user_b_id):
+    chat, created = Chat.objects.get_or_create(
+        user1_id=min(user_a_id, user_b_id),
+        user2_id=max(user_a_id, user_b_id),
+    )
+    if created:
+        changes.chats_created([chat])
+    return chat
+
+
+def create_missing_chats(user_id, other_user_ids):
+    """Create chats between `user_id` and each of `other_user_ids` that lacks one."""
+    if not other_user_ids:
+        return []
+    # Read on the primary even inside a replica-routed request: a lagging
+    # replica would miss a chat created moments ago
+    existing = set()
+    for user1_id, user2_id in Chat.objects.using('default').filter(
+        Q(user1_id=user_id, user2_id__in=other_user_ids) |
+        Q(user2_id=user_id, user1_id__in=other_user_ids)
+    ).values_list('user1_id', 'user2_id'):
+        existing.add(user2_id if user1_id == user_id else user1_id)
+    missing = set(other_user_ids) - existing
+    if not missing:
+        return []
+    try:
+        with transaction.atomic():
+            chats = Chat.objects.bulk_create([
+                Chat(user1_id=min(user_id, other_id), user2_id=max(user_id, other_id))
+                for other_id in sorted(missing)
+            ])
+    except IntegrityError:
+        # A concurrent request created some of them first
+        return [get_or_create_chat(user_id, other_id) for other_id in sorted(missing)]
+    changes.chats_created(chats)
+    return chats
+
+
+def save_message(chat, sender, text, attachment_ids=None):
+    # One transaction, so a message is never stored without its change
+    # event, search tokens or notification
+    with transaction.atomic():
+        message = Message.objects.create(chat=chat, sender=sender, message=text)
+        message.attachment_list = attachments.attach(message, attachment_ids)
+        record_messages(chat, [message])
+    return message
+
+
+def save_message_batch(chat, sender, items):
+    """
+    Store `items` ((client_id, text) pairs) with one insert. Items whose
+    client id this sender already used in this chat are not stored again. Returns
+    (messages, created) where `messages` holds one message per distinct
+    client id, in order, and `created` the ones that are new.
+    """
+    wanted = list(dict(items).items())
+    client_ids = [client_id for client_id, _ in wanted]
+
+    found = {
+        m.client_id: m for m in Message.objects.filter(chat=chat, sender=sender, client_id__in=client_ids)
+    }
+    new = [
+        Message(chat=chat, sender=sender, client_id=client_id, message=text)
+        for client_id, text in wanted if client_id not in found
+    ]
+    created = []
+    if new:
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    created = Message.objects.bulk_create(new)
+            except IntegrityError:
+                # A concurrent resend won the race for some of the ids: fall
+                # back to inserting one by one and keep whichever row exists
+                created = []
+                for message in new:
+                    try:
+                        with transaction.atomic():
+                            message.save()
+                        created.append(message)
+                    except IntegrityError:
+                        found[message.client_id] = Message.objects.get(
+                            chat=chat, sender=sender, client_id=message.client_id,
+                        )
+            record_messages(chat, created)
+        found.update({m.client_id: m for m in created})
+    return [found[client_id] for client_id in client_ids], created
+
+
+def record_messages(chat, messages):
+    """Bookkeeping after `messages` were inserted into `chat`."""
+    if not messages:
+        return
+    newest = max(messages, key=lambda m: m.id)
+    # Only move forward, concurrent writers may finish out of order
+    Chat.objects.filter(pk=chat.pk).filter(
+        Q(last_message__isnull=True) | Q(last_message_id__lt=newest.id)
+    ).update(last_message=newest)
+    changes.messages_changed(chat, messages)
+    search.index_messages(messages)
+    notifications.messages_saved(chat, messages)
+
+
+def edit_message(message, text):
+    """
+    Replace the text of `message` (fetched with its chat). Returns it with
+    its new version, or None if it was deleted in the meantime.
+    """
+    with transaction.atomic():
+        if not _lock_live(message):
+            return None
+        message.message = text
+        message.edited_at = timezone.now()
+        _record_mutation(message, ['message', 'edited_at'])
+    return message
+
+
+def delete_message(message):
+    """
+    Turn `message` (fetched with its chat) into a tombstone: the row keeps
+    its id and place in the history but loses its text and attachments.
+    Returns None if it was already deleted in the meantime.
+    """
+    with transaction.atomic():
+        if not _lock_live(message):
+            return None
+        Attachment.objects.filter(message=message).delete()
+        message.message = ''
+        message.deleted_at = timezone.now()
+        _record_mutation(message, ['message', 'deleted_at'])
+    return message
+
+
+def mutation_event(message):
+    """Channel layer event of an edit or delete, handled by PrivateChatConsumer."""
+    return {"type": changes.mutation_kind(message), **changes.mutation_payload(message)}
+
+
+def _lock_live(message):
+    """
+    Lock the row of `message` for the rest of the transaction. False if
+    it is a tombstone by now: an edit racing a delete must not write its
+    text back into it.
+    """
+    return Message.objects.select_for_update().filter(
+        pk=message.pk, deleted_at__isnull=True,
+    ).values_list('pk', flat=True).first() is not None
+
+
+def _record_mutation(message, fields):
+    # The update holds the chat row until commit, so versions are handed
+    # out one at a time per chat
+    Chat.objects.filter(pk=message.chat_id).update(version=F('version') + 1)
+    message.version = Chat.objects.filter(pk=message.chat_id).values_list('version', flat=True).get()
+    message.chat.version = message.version
+    message.save(update_fields=fields + ['version'])
+    changes.message_mutated(message.chat, message)
+    search.reindex_message(message)
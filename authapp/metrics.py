@@ -0,0 +1,101 @@
+# metrics.py
+"""
+Minimal in-process metrics. Each worker keeps its own registry and
+`snapshot()` returns it as plain dicts for the admin metrics endpoint.
+"""
+
+import bisect
+import threading
+
+DEFAULT_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Gauge:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+        self.max = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+            self.max = max(self.max, self.value)
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+            self.max = max(self.max, value)
+
+    def snapshot(self):
+        return {'value': self.value, 'max': self.max}
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {str(bound): n for bound, n in zip(self.buckets, self.counts)}
+            buckets['+Inf'] = self.counts[-1]
+            return {
+                'count': self.count,
+                'sum': round(self.sum, 3),
+                'avg': round(self.sum / self.count, 3) if self.count else 0,
+                'buckets': buckets,
+            }
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _get(name, factory):
+    metric = _registry.get(name)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.setdefault(name, factory())
+    return metric
+
+
+def gauge(name):
+    return _get(name, Gauge)
+
+
+def counter(name):
+    return _get(name, Counter)
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS_MS):
+    return _get(name, lambda: Histogram(buckets))
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in sorted(_registry.items())}
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.5 on 2026-10-19 03:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0005_customuser_active_connections'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConnectionLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel_name', models.CharField(max_length=255, unique=True)),
+                ('worker_id', models.CharField(db_index=True, max_length=255)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='connection_leases', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.5 on 2026-10-19 03:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_last_message(apps, schema_editor):
+    Chat = apps.get_model('authapp', 'Chat')
+    Message = apps.get_model('authapp', 'Message')
+    newest = Message.objects.filter(chat=models.OuterRef('pk')).order_by('-id').values('id')[:1]
+    Chat.objects.update(last_message=models.Subquery(newest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0006_connectionlease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='authapp.message'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.1.5 on 2026-10-19 03:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+POSTGRES_FORWARD = [
+    "ALTER TABLE authapp_message ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    "UPDATE authapp_message SET search_vector = to_tsvector('english', coalesce(message, ''))",
+    "CREATE INDEX IF NOT EXISTS authapp_message_search_idx ON authapp_message USING GIN (search_vector)",
+    """
+    CREATE OR REPLACE FUNCTION authapp_message_search_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := to_tsvector('english', coalesce(NEW.message, ''));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS authapp_message_search_update ON authapp_message",
+    """
+    CREATE TRIGGER authapp_message_search_update
+    BEFORE INSERT OR UPDATE OF message ON authapp_message
+    FOR EACH ROW EXECUTE FUNCTION authapp_message_search_update()
+    """,
+]
+
+POSTGRES_REVERSE = [
+    "DROP TRIGGER IF EXISTS authapp_message_search_update ON authapp_message",
+    "DROP FUNCTION IF EXISTS authapp_message_search_update()",
+    "DROP INDEX IF EXISTS authapp_message_search_idx",
+    "ALTER TABLE authapp_message DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def add_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_FORWARD:
+            schema_editor.execute(statement)
+        return
+
+    from authapp.search import tokenize
+    Message = apps.get_model('authapp', 'Message')
+    MessageToken = apps.get_model('authapp', 'MessageToken')
+    batch = []
+    for message in Message.objects.values('id', 'chat_id', 'message').iterator(chunk_size=2000):
+        for term, count in tokenize(message['message']).items():
+            batch.append(MessageToken(term=term, message_id=message['id'], chat_id=message['chat_id'], count=count))
+        if len(batch) >= 5000:
+            MessageToken.objects.bulk_create(batch)
+            batch = []
+    MessageToken.objects.bulk_create(batch)
+
+
+def remove_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_REVERSE:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0008_changeevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('count', models.PositiveSmallIntegerField(default=1)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='authapp.chat')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='authapp.message')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'chat'], name='messagetoken_term_chat_idx')],
+            },
+        ),
+        migrations.RunPython(add_search_index, remove_search_index),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.5 on 2026-10-19 03:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0009_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='archived_through',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ArchivedBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(max_length=255)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.IntegerField()),
+                ('count', models.IntegerField()),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_blocks', to='authapp.chat')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat', 'first_message_id'], name='archivedblock_chat_first_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.5 on 2026-10-19 03:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0010_message_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetentionProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('policy', models.CharField(max_length=64, unique=True)),
+                ('last_pk', models.BigIntegerField(default=0)),
+                ('horizon_pk', models.BigIntegerField(default=0)),
+                ('deleted', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.5 on 2026-10-19 05:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0016_pendingnotification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('day', models.DateField(primary_key=True, serialize=False)),
+                ('messages', models.BigIntegerField(default=0)),
+                ('active_chats', models.IntegerField(default=0)),
+                ('active_users', models.IntegerField(default=0)),
+                ('peak_sockets', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('last_pk', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChatDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('messages', models.IntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='authapp.chat')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day', '-messages'], name='chatdailystats_busiest_idx')],
+                'constraints': [models.UniqueConstraint(fields=('chat', 'day'), name='chatdailystats_chat_day_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyActiveUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'user'), name='dailyactiveuser_day_user_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.5 on 2026-10-19 05:29
+
+from django.db import migrations
+from django.db.models import Count, F, Max, Min
+
+
+def merge_duplicate_chats(apps, schema_editor):
+    """Fold every extra chat of a user pair into the pair's oldest chat."""
+    Chat = apps.get_model('authapp', 'Chat')
+    ChatDailyStats = apps.get_model('authapp', 'ChatDailyStats')
+    moved = [
+        apps.get_model('authapp', name)
+        for name in ('Message', 'MessageToken', 'ArchivedBlock', 'BotJob', 'Attachment')
+    ]
+    pairs = (
+        Chat.objects.values('user1_id', 'user2_id')
+        .annotate(n=Count('id'), keep=Min('id')).filter(n__gt=1)
+    )
+    for pair in pairs:
+        chats = Chat.objects.filter(user1_id=pair['user1_id'], user2_id=pair['user2_id'])
+        extra = list(chats.exclude(id=pair['keep']).values_list('id', flat=True))
+        for model in moved:
+            model.objects.filter(chat_id__in=extra).update(chat_id=pair['keep'])
+        for row in ChatDailyStats.objects.filter(chat_id__in=extra):
+            updated = ChatDailyStats.objects.filter(chat_id=pair['keep'], day=row.day).update(
+                messages=F('messages') + row.messages,
+            )
+            if updated:
+                row.delete()
+            else:
+                ChatDailyStats.objects.filter(id=row.id).update(chat_id=pair['keep'])
+        merged = chats.aggregate(
+            last_message=Max('last_message'), archived_through=Max('archived_through'), version=Max('version'),
+        )
+        chats.filter(id=pair['keep']).update(
+            last_message_id=merged['last_message'],
+            archived_through=merged['archived_through'],
+            version=merged['version'],
+        )
+        Chat.objects.filter(id__in=extra).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0018_message_edits'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_chats, migrations.RunPython.noop),
+    ]
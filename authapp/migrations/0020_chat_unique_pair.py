@@ -0,0 +1,20 @@
+# Generated by Django 5.1.5 on 2026-10-19 05:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Separate from the merge in 0019: PostgreSQL refuses to alter a table
+    # with pending trigger events in the same transaction
+
+    dependencies = [
+        ('authapp', '0019_merge_duplicate_chats'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(fields=('user1', 'user2'), name='chat_user1_user2_uniq'),
+        ),
+    ]
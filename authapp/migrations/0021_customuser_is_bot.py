@@ -0,0 +1,26 @@
+# Generated by Django 5.1.5 on 2026-10-19 05:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def flag_bot_account(apps, schema_editor):
+    """The account bot.get_bot_user created by name: BOT_USERNAME without a usable password."""
+    CustomUser = apps.get_model('authapp', 'CustomUser')
+    CustomUser.objects.filter(username=settings.BOT_USERNAME, password__startswith='!').update(is_bot=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0020_chat_unique_pair'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='is_bot',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(flag_bot_account, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.5 on 2026-10-19 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0021_customuser_is_bot'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='message_sender_client_id_uniq',
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_id__isnull', False)), fields=('chat', 'sender', 'client_id'), name='message_chat_sender_client_id_uniq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authapp', '0022_message_client_id_per_chat'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='changeevent',
+            name='kind',
+            field=models.CharField(choices=[('message', 'Message'), ('message_edited', 'Message edited'), ('message_deleted', 'Message deleted'), ('chat', 'Chat'), ('friend_request', 'Friend request')], max_length=32),
+        ),
+    ]
@@ -28,6 +28,8 @@ class CustomUser(AbstractUser):
     is_online = models.BooleanField(default=False)
     last_online = models.DateTimeField(null=True, blank=True)
     active_connections = models.IntegerField(default=0)
+    # The Langflow bot's account, see bot.get_bot_user
+    is_bot = models.BooleanField(default=False)
 
 
 
@@ -50,6 +52,8 @@ def user_disconnect(self):
 
 
 # models.py
+import uuid
+
 from django.db import models
 from django.contrib.auth import get_user_model
 
@@ -63,6 +67,22 @@ class Chat(models.Model):
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_user1')
     user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_user2')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Newest message in the chat, maintained by `messaging.record_messages`.
+    # Doubles as the chat's cache validator (ETag) for history requests.
+    last_message = models.ForeignKey(
+        'Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    # Id of the newest message moved to the archive, None if nothing is archived
+    archived_through = models.BigIntegerField(null=True, blank=True)
+    # Bumped by every edit or delete in the chat, see messaging.py. Clients
+    # that know a version only fetch the messages changed after it.
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # user1 is always the lower id, see messaging.get_or_create_chat
+            models.UniqueConstraint(fields=['user1', 'user2'], name='chat_user1_user2_uniq'),
+        ]
 
     def __str__(self):
         return f"Chat between {self.user1.username} and {self.user2.username}"
@@ -72,6 +92,28 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Id the sending client gave the message; makes resends idempotent
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+    # Chat version of the last edit or delete, 0 if never changed
+    version = models.BigIntegerField(default=0)
+    edited_at = models.DateTimeField(null=True, blank=True)
+    # Set on deleted messages, which stay as tombstones without text
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # Client ids are only unique per chat, see messaging.save_message_batch
+            models.UniqueConstraint(
+                fields=['chat', 'sender', 'client_id'], condition=models.Q(client_id__isnull=False),
+                name='message_chat_sender_client_id_uniq',
+            ),
+        ]
+        indexes = [
+            # Only changed messages are looked up by version
+            models.Index(
+                fields=['chat', 'version'], condition=models.Q(version__gt=0), name='message_chat_version_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.message[:20]}"
@@ -96,3 +138,260 @@ class FriendRequest(models.Model):
         return f"{self.from_user.username} → {self.to_user.username} ({self.status})"
     
 
+
+
+class ConnectionLease(models.Model):
+    """
+    One row per open WebSocket that counts towards a user's presence.
+    Leases are renewed by the worker that owns the socket; if the worker
+    dies the lease expires and the presence reaper reconciles the user.
+    """
+    channel_name = models.CharField(max_length=255, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='connection_leases')
+    worker_id = models.CharField(max_length=255, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user_id} @ {self.worker_id} (until {self.expires_at})"
+
+
+class ChangeEvent(models.Model):
+    """
+    Append-only, per-user feed of changes (new, edited and deleted messages,
+    chats and friend request updates). Clients keep the id of the last event they applied
+    and catch up with a single indexed range scan.
+    """
+    KIND_CHOICES = [
+        ('message', 'Message'),
+        ('message_edited', 'Message edited'),
+        ('message_deleted', 'Message deleted'),
+        ('chat', 'Chat'),
+        ('friend_request', 'Friend request'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='change_events')
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'id'], name='changeevent_user_id_idx')]
+
+    def __str__(self):
+        return f"#{self.id} {self.kind} for {self.user_id}"
+
+
+class MessageToken(models.Model):
+    """
+    Inverted index over message text for databases without full-text
+    search (SQLite test runs). PostgreSQL uses the `search_vector` column
+    and GIN index added in migration 0009 instead.
+    """
+    term = models.CharField(max_length=64)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='tokens')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        indexes = [models.Index(fields=['term', 'chat'], name='messagetoken_term_chat_idx')]
+
+    def __str__(self):
+        return f"{self.term} -> {self.message_id}"
+
+
+class ArchivedBlock(models.Model):
+    """
+    Offset index into a chat's append-only archive segment. Each block is a
+    zlib-compressed JSON list of serialized messages (see archive.py).
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='archived_blocks')
+    segment = models.CharField(max_length=255)  # path relative to MESSAGE_ARCHIVE_DIR
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+    count = models.IntegerField()
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['chat', 'first_message_id'], name='archivedblock_chat_first_idx')]
+
+    def __str__(self):
+        return f"{self.segment}@{self.offset} ({self.first_message_id}-{self.last_message_id})"
+
+
+class RetentionProgress(models.Model):
+    """Resume point of a retention policy, see retention.py."""
+    policy = models.CharField(max_length=64, unique=True)
+    last_pk = models.BigIntegerField(default=0)
+    # Highest primary key ever deleted by this policy
+    horizon_pk = models.BigIntegerField(default=0)
+    deleted = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.policy} at {self.last_pk}"
+
+
+class BotJob(models.Model):
+    """
+    A message waiting for a reply from the Langflow bot. Jobs are claimed
+    by the bot workers (run_bot_workers) and retried with backoff until
+    they succeed, run out of attempts or pass their deadline.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    requester = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bot_jobs')
+    # Chat the reply is posted in; None for jobs that are only polled
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    message = models.TextField()
+    tweaks = models.JSONField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField()
+    deadline = models.DateTimeField()
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    reply = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'available_at'], name='botjob_status_available_idx')]
+
+    def __str__(self):
+        return f"#{self.id} {self.status} for {self.requester_id}"
+
+
+class StoredFile(models.Model):
+    """Uploaded content, stored once per SHA-256 however often it is attached."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    name = models.CharField(max_length=255)  # name in the attachment storage
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
+class UploadSession(models.Model):
+    """A resumable chunked upload, see attachments.py."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} {self.received}/{self.size}"
+
+
+class Attachment(models.Model):
+    """
+    A file as uploaded by one user; linked to a chat and message once it
+    is sent. It stays with the chat when the message is archived.
+    """
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='attachments')
+    file = models.ForeignKey(StoredFile, on_delete=models.PROTECT, related_name='attachments')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255)
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, null=True, blank=True, related_name='attachments')
+    message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='attachments')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.filename
+
+
+class FriendSuggestion(models.Model):
+    """A non-friend `candidate` sharing `mutual_count` friends with `user`, see suggestions.py."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friend_suggestions')
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    mutual_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'candidate'], name='friendsuggestion_user_candidate_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-mutual_count', 'candidate'], name='friendsuggestion_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.candidate_id} for {self.user_id} ({self.mutual_count} mutual)"
+
+
+class PendingNotification(models.Model):
+    """
+    A user who missed messages while offline and is owed a digest of them,
+    see notifications.py. One row per user however many messages arrive.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='pending_notification')
+    # First missed message; the digest covers it and everything after
+    since_message_id = models.BigIntegerField()
+    due_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"digest for {self.user_id} due {self.due_at}"
+
+
+class DailyStats(models.Model):
+    """Per-day totals kept by analytics.py; days are UTC."""
+    day = models.DateField(primary_key=True)
+    messages = models.BigIntegerField(default=0)
+    active_chats = models.IntegerField(default=0)
+    active_users = models.IntegerField(default=0)
+    # Most live WebSocket leases seen by an aggregator pass that day
+    peak_sockets = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.day}: {self.messages} messages"
+
+
+class ChatDailyStats(models.Model):
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='daily_stats')
+    day = models.DateField()
+    messages = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'day'], name='chatdailystats_chat_day_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['day', '-messages'], name='chatdailystats_busiest_idx'),
+        ]
+
+    def __str__(self):
+        return f"chat {self.chat_id} on {self.day}: {self.messages}"
+
+
+class DailyActiveUser(models.Model):
+    """A user who sent at least one message on `day`; counted into DailyStats.active_users once."""
+    day = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'user'], name='dailyactiveuser_day_user_uniq'),
+        ]
+
+
+class RollupProgress(models.Model):
+    """Newest message folded into the rollups, see analytics.py."""
+    name = models.CharField(max_length=64, unique=True)
+    last_pk = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at {self.last_pk}"
@@ -0,0 +1,251 @@
+# notifications.py
+"""
+Digests of the messages a user missed while offline.
+
+Saving a message for an offline recipient only makes sure the recipient
+has a `PendingNotification` row, due NOTIFICATION_DIGEST_WINDOW seconds
+after the first missed message. `python manage.py send_notification_digests`
+picks up due rows, summarizes everything the user received since then per
+chat and hands one digest per user to NOTIFICATION_SINK. A burst of 50
+messages is one row and one notification. Users who came back online
+before their digest was due are skipped, they have seen the messages.
+
+A pass leases the rows it claims for NOTIFICATION_CLAIM_LEASE seconds and
+deletes them only once the sink accepted their digests, so a sender that
+crashes in between loses nothing: the rows come due again when the lease
+runs out. Delivery is at least once - a crash right after the sink
+accepted a digest sends it again.
+"""
+
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import Message, PendingNotification, User
+
+PREVIEW_LENGTH = 140
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryFailed(Exception):
+    """Raised by a sink that delivered only the first `delivered` digests."""
+
+    def __init__(self, delivered, error):
+        super().__init__(str(error))
+        self.delivered = delivered
+
+
+class NotificationSink:
+    """Interface of a digest destination."""
+
+    def deliver(self, digests):
+        """
+        Send `digests` (JSON-serializable dicts). Raise DeliveryFailed when
+        only some went out; any other exception keeps them all pending.
+        """
+        raise NotImplementedError
+
+
+class FileSink(NotificationSink):
+    """Appends digests as JSON lines to NOTIFICATION_FILE."""
+
+    def __init__(self, path=None):
+        self.path = path or settings.NOTIFICATION_FILE
+
+    def deliver(self, digests):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as f:
+            for sent, digest in enumerate(digests):
+                try:
+                    f.write(json.dumps(digest) + "\n")
+                    f.flush()
+                except OSError as e:
+                    raise DeliveryFailed(sent, e) from e
+
+
+class WebhookSink(NotificationSink):
+    """POSTs each digest as JSON to NOTIFICATION_WEBHOOK_URL."""
+
+    def __init__(self, url=None, timeout=None):
+        self.url = url or settings.NOTIFICATION_WEBHOOK_URL
+        self.timeout = timeout or settings.NOTIFICATION_WEBHOOK_TIMEOUT
+
+    def deliver(self, digests):
+        import requests
+
+        with requests.Session() as session:
+            for sent, digest in enumerate(digests):
+                try:
+                    session.post(self.url, json=digest, timeout=self.timeout).raise_for_status()
+                except requests.RequestException as e:
+                    raise DeliveryFailed(sent, e) from e
+
+
+class MemorySink(NotificationSink):
+    """Keeps delivered digests in `MemorySink.delivered`, for tests."""
+
+    delivered = []
+
+    def deliver(self, digests):
+        self.delivered.extend(digests)
+
+
+_sink = None
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        _sink = import_string(settings.NOTIFICATION_SINK)()
+    return _sink
+
+
+def digest_window():
+    return timedelta(seconds=settings.NOTIFICATION_DIGEST_WINDOW)
+
+
+def messages_saved(chat, messages):
+    """Owe the recipient of `messages` a digest if they are offline."""
+    if not messages or not settings.NOTIFICATION_DIGESTS:
+        return
+    first = min(messages, key=lambda m: m.id)
+    recipient_id = chat.user2_id if first.sender_id == chat.user1_id else chat.user1_id
+    # The bot has no socket, it is never online and never reads digests
+    if User.objects.filter(Q(is_online=True) | Q(is_bot=True), id=recipient_id).exists():
+        return
+    # Later messages of the burst find the row and change nothing
+    PendingNotification.objects.bulk_create(
+        [PendingNotification(user_id=recipient_id, since_message_id=first.id,
+                             due_at=timezone.now() + digest_window())],
+        ignore_conflicts=True,
+    )
+
+
+def build_digest(user, since_message_id, until_message_id):
+    """What `user` received in messages since_message_id..until_message_id, per chat and sender."""
+    missed = Message.objects.filter(
+        Q(chat__user1=user) | Q(chat__user2=user),
+        id__gte=since_message_id, id__lte=until_message_id,
+    ).exclude(sender=user)
+    if user.last_online:
+        missed = missed.filter(timestamp__gte=user.last_online)
+    groups = list(
+        missed.values('chat_id', 'sender_id', 'sender__username')
+        .annotate(count=Count('id'), last_id=Max('id'))
+        .order_by('-last_id')
+    )
+    if not groups:
+        return None
+    previews = dict(
+        Message.objects.filter(id__in=[g['last_id'] for g in groups]).values_list('id', 'message')
+    )
+    return {
+        'user_id': user.id,
+        'username': user.username,
+        'count': sum(g['count'] for g in groups),
+        'chats': [
+            {
+                'chat_id': g['chat_id'],
+                'sender_id': g['sender_id'],
+                'sender_username': g['sender__username'],
+                'count': g['count'],
+                'last_message': previews[g['last_id']][:PREVIEW_LENGTH],
+            }
+            for g in groups
+        ],
+    }
+
+
+def claim_due(now=None, limit=None):
+    """
+    Lease the due rows for NOTIFICATION_CLAIM_LEASE seconds and return
+    (pending, until) pairs with the newest message id each digest may
+    include. The rows stay until `finish` or `restore`.
+    """
+    now = now or timezone.now()
+    limit = limit or settings.NOTIFICATION_BATCH_SIZE
+    with transaction.atomic():
+        pending = list(
+            PendingNotification.objects.select_for_update(skip_locked=True)
+            .filter(due_at__lte=now).select_related('user').order_by('due_at')[:limit]
+        )
+        if not pending:
+            return []
+        until = Message.objects.aggregate(newest=Max('id'))['newest']
+        PendingNotification.objects.filter(id__in=[p.id for p in pending]).update(
+            due_at=now + timedelta(seconds=settings.NOTIFICATION_CLAIM_LEASE)
+        )
+    return [(p, until) for p in pending]
+
+
+def finish(pending, until, now=None):
+    """
+    Drop the rows whose digest went out (or was not needed). Users sent
+    messages after `until` meanwhile get a new row starting there, so
+    nothing is reported twice or dropped.
+    """
+    if not pending:
+        return
+    now = now or timezone.now()
+    user_ids = {p.user_id for p in pending}
+    with transaction.atomic():
+        PendingNotification.objects.filter(id__in=[p.id for p in pending]).delete()
+        first_missed = {}
+        for user1_id, user2_id, sender_id, message_id in Message.objects.filter(
+            Q(chat__user1_id__in=user_ids) | Q(chat__user2_id__in=user_ids), id__gt=until,
+        ).order_by('id').values_list('chat__user1_id', 'chat__user2_id', 'sender_id', 'id'):
+            recipient_id = user2_id if sender_id == user1_id else user1_id
+            if recipient_id in user_ids:
+                first_missed.setdefault(recipient_id, message_id)
+        PendingNotification.objects.bulk_create(
+            [PendingNotification(user_id=user_id, since_message_id=message_id, due_at=now + digest_window())
+             for user_id, message_id in first_missed.items()],
+            ignore_conflicts=True,
+        )
+
+
+def restore(pending, now=None):
+    """Release rows whose digest could not be delivered, retried a window later."""
+    now = now or timezone.now()
+    PendingNotification.objects.filter(id__in=[p.id for p in pending]).update(due_at=now + digest_window())
+
+
+def send_due_digests(sink=None, now=None):
+    """Deliver one digest per due user. Returns the number delivered."""
+    sink = sink or get_sink()
+    claimed = claim_due(now)
+    if not claimed:
+        return 0
+    until = claimed[0][1]
+    digests, owners, skipped = [], [], []
+    for pending, _ in claimed:
+        # Back online since: they saw the messages themselves
+        digest = None if pending.user.is_online else build_digest(pending.user, pending.since_message_id, until)
+        if digest:
+            digests.append(digest)
+            owners.append(pending)
+        else:
+            skipped.append(pending)
+    delivered = len(digests)
+    if digests:
+        try:
+            sink.deliver(digests)
+        except Exception as e:
+            logger.warning("Notification delivery error: %s", e)
+            # Only the digests that did not go out are sent again
+            delivered = e.delivered if isinstance(e, DeliveryFailed) else 0
+            restore(owners[delivered:], now)
+            metrics.counter('notifications.delivery_failures').inc()
+    finish(skipped + owners[:delivered], until, now)
+    if delivered:
+        metrics.counter('notifications.digests_sent').inc(delivered)
+        metrics.counter('notifications.messages_digested').inc(sum(d['count'] for d in digests[:delivered]))
+    return delivered
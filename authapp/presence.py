@@ -0,0 +1,228 @@
+# presence.py
+"""
+Connection leases for user presence.
+
+`CustomUser.active_connections` is only decremented when a consumer's
+`disconnect` runs, which never happens when a worker crashes. Every socket
+that counts towards presence therefore also holds a lease that its worker
+keeps renewing. The reaper expires leases whose worker stopped renewing and
+recomputes the affected users' counts from the leases that are still live.
+"""
+
+import asyncio
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .db import db_sync_to_async
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_ttl():
+    return timedelta(seconds=getattr(settings, 'PRESENCE_LEASE_TTL', 90))
+
+
+def heartbeat_interval():
+    return getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 30)
+
+
+class DatabaseLeaseStore:
+    """Leases stored in the `ConnectionLease` table, shared by all workers."""
+
+    def acquire(self, channel_name, user_id, worker_id, expires_at):
+        from .models import ConnectionLease
+        ConnectionLease.objects.update_or_create(
+            channel_name=channel_name,
+            defaults={'user_id': user_id, 'worker_id': worker_id, 'expires_at': expires_at},
+        )
+
+    def renew(self, channel_name, expires_at):
+        from .models import ConnectionLease
+        return ConnectionLease.objects.filter(channel_name=channel_name).update(expires_at=expires_at) > 0
+
+    def renew_worker(self, worker_id, expires_at):
+        from .models import ConnectionLease
+        return ConnectionLease.objects.filter(worker_id=worker_id).update(expires_at=expires_at)
+
+    def release(self, channel_name):
+        from .models import ConnectionLease
+        return ConnectionLease.objects.filter(channel_name=channel_name).delete()[0] > 0
+
+    def expire(self, now):
+        from .models import ConnectionLease
+        stale = ConnectionLease.objects.filter(expires_at__lte=now)
+        user_ids = set(stale.values_list('user_id', flat=True))
+        if user_ids:
+            stale.delete()
+        return user_ids
+
+    def live_counts(self, user_ids, now):
+        from .models import ConnectionLease
+        rows = (
+            ConnectionLease.objects.filter(user_id__in=user_ids, expires_at__gt=now)
+            .values('user_id')
+            .annotate(n=Count('id'))
+        )
+        return {row['user_id']: row['n'] for row in rows}
+
+    def count_live(self, now):
+        from .models import ConnectionLease
+        return ConnectionLease.objects.filter(expires_at__gt=now).count()
+
+
+class InMemoryLeaseStore:
+    """Process-local stand-in for `DatabaseLeaseStore`, used by tests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}  # channel_name -> [user_id, worker_id, expires_at]
+
+    def acquire(self, channel_name, user_id, worker_id, expires_at):
+        with self._lock:
+            self._leases[channel_name] = [user_id, worker_id, expires_at]
+
+    def renew(self, channel_name, expires_at):
+        with self._lock:
+            lease = self._leases.get(channel_name)
+            if lease is None:
+                return False
+            lease[2] = expires_at
+            return True
+
+    def renew_worker(self, worker_id, expires_at):
+        with self._lock:
+            renewed = 0
+            for lease in self._leases.values():
+                if lease[1] == worker_id:
+                    lease[2] = expires_at
+                    renewed += 1
+            return renewed
+
+    def release(self, channel_name):
+        with self._lock:
+            return self._leases.pop(channel_name, None) is not None
+
+    def expire(self, now):
+        with self._lock:
+            stale = [name for name, lease in self._leases.items() if lease[2] <= now]
+            return {self._leases.pop(name)[0] for name in stale}
+
+    def live_counts(self, user_ids, now):
+        with self._lock:
+            counts = {}
+            for user_id, _, expires_at in self._leases.values():
+                if user_id in user_ids and expires_at > now:
+                    counts[user_id] = counts.get(user_id, 0) + 1
+            return counts
+
+    def count_live(self, now):
+        with self._lock:
+            return sum(1 for lease in self._leases.values() if lease[2] > now)
+
+
+_store = None
+
+
+def get_lease_store():
+    global _store
+    if _store is None:
+        path = getattr(settings, 'PRESENCE_LEASE_STORE', 'authapp.presence.DatabaseLeaseStore')
+        _store = import_string(path)()
+    return _store
+
+
+def acquire_lease(channel_name, user_id):
+    get_lease_store().acquire(channel_name, user_id, WORKER_ID, timezone.now() + lease_ttl())
+
+
+def renew_lease(channel_name):
+    return get_lease_store().renew(channel_name, timezone.now() + lease_ttl())
+
+
+def release_lease(channel_name):
+    return get_lease_store().release(channel_name)
+
+
+@contextmanager
+def presence_lock(user_id):
+    """
+    Hold the user's row while a socket takes or gives back its lease and
+    moves `active_connections`, so the reaper's recount never lands
+    between the two.
+    """
+    from .models import CustomUser
+
+    with transaction.atomic():
+        list(CustomUser.objects.select_for_update().filter(id=user_id).values_list('id', flat=True))
+        yield
+
+
+def reap_stale_connections(store=None, now=None):
+    """
+    Expire leases that were not renewed in time and reconcile the owners'
+    presence from the leases that are still live. Only users that actually
+    lost a lease are touched. Returns the ids of users that went offline.
+    """
+    from .models import CustomUser
+
+    store = store or get_lease_store()
+    now = now or timezone.now()
+    affected = store.expire(now)
+    if not affected:
+        return []
+
+    went_offline = []
+    with transaction.atomic():
+        # Sockets connecting or closing meanwhile wait in presence_lock()
+        users = list(
+            CustomUser.objects.select_for_update().filter(id__in=affected).order_by('id')
+            .only('id', 'is_online', 'active_connections')
+        )
+        counts = store.live_counts(affected, now)
+        for user in users:
+            live = counts.get(user.id, 0)
+            if live:
+                CustomUser.objects.filter(id=user.id).update(active_connections=live, is_online=True)
+            else:
+                CustomUser.objects.filter(id=user.id).update(active_connections=0, is_online=False, last_online=now)
+                if user.is_online:
+                    went_offline.append(user.id)
+    return went_offline
+
+
+class LeaseKeeper:
+    """
+    Renews every lease owned by this worker with a single query per tick.
+    Started lazily by the first consumer that connects on an event loop.
+    """
+
+    def __init__(self):
+        self._task = None
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(heartbeat_interval())
+            try:
+                await db_sync_to_async(get_lease_store().renew_worker)(
+                    WORKER_ID, timezone.now() + lease_ttl()
+                )
+            except Exception as e:
+                print(f"Lease renewal error: {e}")
+
+
+lease_keeper = LeaseKeeper()
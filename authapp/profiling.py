@@ -0,0 +1,274 @@
+# profiling.py
+"""
+Opt-in profiling of HTTP requests and WebSocket handlers.
+
+A request is profiled when it carries `X-Profile: <PROFILING_TOKEN>` (a
+WebSocket: `?profile=<PROFILING_TOKEN>` in its URL) or is picked by
+PROFILING_SAMPLE_RATE. While it runs, cProfile records every call, a
+sampler thread snapshots the stack every PROFILING_SAMPLE_INTERVAL_MS,
+and every SQL query run on its behalf is timed - including those that
+views and consumers run in executor threads. Each profile is written to PROFILING_DIR as
+
+    <id>.prof    cProfile data (pstats, snakeviz, ...)
+    <id>.folded  sampled stacks in collapsed format (flamegraph.pl, speedscope)
+    <id>.svg     flame graph of the sampled stacks
+    <id>.txt     summary: wall time, slowest SQL, top functions
+
+and the oldest profiles are deleted once the directory exceeds
+PROFILING_MAX_BYTES. Only one profile runs at a time per process.
+"""
+
+import contextvars
+import cProfile
+import functools
+import hmac
+import io
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from html import escape
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+_active = contextvars.ContextVar('active_profile', default=None)
+_busy = threading.Lock()
+
+
+def enabled():
+    return bool(settings.PROFILING_TOKEN) or settings.PROFILING_SAMPLE_RATE > 0
+
+
+def wanted(token):
+    """Whether to profile something that presented `token` (may be None)."""
+    if settings.PROFILING_TOKEN and token and hmac.compare_digest(str(token), settings.PROFILING_TOKEN):
+        return True
+    return random.random() < settings.PROFILING_SAMPLE_RATE
+
+
+class StackSampler(threading.Thread):
+    """Collects the stacks of one thread in collapsed form: 'a;b;c' -> samples."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True, name='profiling-sampler')
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Profile:
+    def __init__(self, label):
+        self.label = label
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.queries = []  # (ms, sql)
+        self._lock = threading.Lock()
+
+    def record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.queries.append(((time.perf_counter() - started) * 1000, sql))
+
+    def __enter__(self):
+        self._token = _active.set(self)
+        for alias in connections:
+            install_sql_timing(connections[alias])
+        self.sampler = StackSampler(threading.get_ident(), settings.PROFILING_SAMPLE_INTERVAL_MS / 1000)
+        self.profiler = cProfile.Profile()
+        self.started = time.perf_counter()
+        self.sampler.start()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.wall_ms = (time.perf_counter() - self.started) * 1000
+        self.sampler.stop()
+        _active.reset(self._token)
+        try:
+            self.write()
+        except Exception as e:
+            print(f"Profile write error: {e}")
+        return False
+
+    def write(self):
+        directory = Path(settings.PROFILING_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        base = directory / self.id
+        self.profiler.dump_stats(f"{base}.prof")
+        folded = "".join(f"{stack} {count}\n" for stack, count in self.sampler.stacks.most_common())
+        Path(f"{base}.folded").write_text(folded)
+        Path(f"{base}.svg").write_text(flamegraph_svg(self.sampler.stacks, f"{self.label} ({self.wall_ms:.1f} ms)"))
+        Path(f"{base}.txt").write_text(self.summary())
+        enforce_size_cap(directory, settings.PROFILING_MAX_BYTES)
+
+    def summary(self):
+        sql_ms = sum(ms for ms, _ in self.queries)
+        out = io.StringIO()
+        out.write(f"{self.label}\nwall: {self.wall_ms:.2f} ms\n")
+        out.write(f"sql: {len(self.queries)} queries, {sql_ms:.2f} ms\n\nslowest queries:\n")
+        for ms, sql in sorted(self.queries, key=lambda q: q[0], reverse=True)[:20]:
+            out.write(f"  {ms:8.2f} ms  {sql[:300]}\n")
+        out.write("\n")
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        return out.getvalue()
+
+
+def active():
+    return _active.get()
+
+
+def _time_query(execute, sql, params, many, context):
+    profile = _active.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    return profile.record_query(execute, sql, params, many, context)
+
+
+def install_sql_timing(connection, **kwargs):
+    """
+    Time the queries `connection` runs for the active profile. Installed on
+    every connection as it is created, because sync views, the async ORM
+    and `db_sync_to_async` run queries in executor threads; those see the
+    profile through the context asgiref copies into them.
+    """
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+connection_created.connect(install_sql_timing)
+
+
+@contextmanager
+def profile(label, token=None):
+    """Profile the block if `token` or sampling asks for it; yields the Profile or None."""
+    if not enabled() or not wanted(token) or not _busy.acquire(blocking=False):
+        yield None
+        return
+    try:
+        with Profile(label) as p:
+            yield p
+    finally:
+        _busy.release()
+
+
+def enforce_size_cap(directory, max_bytes):
+    """Delete the oldest profiles until `directory` holds at most `max_bytes`."""
+    files = sorted((p for p in Path(directory).iterdir() if p.is_file()), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in files)
+    for path in files:
+        if total <= max_bytes:
+            break
+        total -= path.stat().st_size
+        path.unlink(missing_ok=True)
+
+
+def flamegraph_svg(stacks, title, width=1200, row_height=16):
+    """A static flame graph of collapsed `stacks`, widest frames at the bottom."""
+    root = {'count': 0, 'children': {}}
+    for stack, count in stacks.items():
+        node = root
+        node['count'] += count
+        for name in stack.split(";"):
+            node = node['children'].setdefault(name, {'count': 0, 'children': {}})
+            node['count'] += count
+
+    rects, max_depth = [], 0
+
+    def walk(node, x, depth):
+        nonlocal max_depth
+        max_depth = max(max_depth, depth)
+        for name, child in sorted(node['children'].items()):
+            w = child['count'] / root['count'] * width
+            if w >= 0.5:
+                rects.append((x, depth, w, name, child['count']))
+                walk(child, x, depth + 1)
+            x += w
+
+    if root['count']:
+        walk(root, 0, 0)
+    height = (max_depth + 2) * row_height + 24
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+        f'<text x="4" y="14">{escape(title)} - {root["count"]} samples</text>',
+    ]
+    for x, depth, w, name, count in rects:
+        y = height - (depth + 1) * row_height
+        hue = 20 + hash(name) % 40
+        label = escape(name[: int(w // 7)]) if w > 28 else ""
+        parts.append(
+            f'<g><title>{escape(name)} ({count} samples)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+            f'<text x="{x + 2:.1f}" y="{y + 12}">{label}</text></g>'
+        )
+    parts.append('</svg>')
+    return "\n".join(parts)
+
+
+class ProfilingMiddleware:
+    """Profiles requests that send X-Profile: <PROFILING_TOKEN>, or a sampled share of them."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with profile(f"{request.method} {request.path}", request.headers.get('X-Profile')) as p:
+            response = self.get_response(request)
+        if p is not None:
+            response['X-Profile-Id'] = p.id
+        return response
+
+    async def __acall__(self, request):
+        # The profilers follow the event loop thread, so concurrent
+        # requests on this worker show up in the profile too
+        with profile(f"{request.method} {request.path}", request.headers.get('X-Profile')) as p:
+            response = await self.get_response(request)
+        if p is not None:
+            response['X-Profile-Id'] = p.id
+        return response
+
+
+def profiled(handler):
+    """Profile an async consumer handler, see the module docstring."""
+    @functools.wraps(handler)
+    async def wrapper(self, *args, **kwargs):
+        if not enabled():
+            return await handler(self, *args, **kwargs)
+        token = parse_qs(self.scope.get("query_string", b"").decode()).get("profile", [None])[0]
+        label = f"ws {type(self).__name__}.{handler.__name__} {self.scope.get('path', '')}"
+        with profile(label, token):
+            return await handler(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,122 @@
+# retention.py
+"""
+Batched retention.
+
+Each policy deletes rows older than its configured age in small batches
+walked in primary-key order, one short transaction per batch, with a pause
+in between so cleanup never holds long locks or floods replication. The
+position is saved after every batch in `RetentionProgress`, so an
+interrupted run resumes where it stopped.
+"""
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChangeEvent, Chat, FriendRequest, Message, RetentionProgress, User
+
+
+class RetentionPolicy:
+    def __init__(self, name, model, date_field, extra_filter=None):
+        self.name = name
+        self.model = model
+        self.date_field = date_field
+        self.extra_filter = extra_filter or Q()
+
+    def max_age(self):
+        days = getattr(settings, 'RETENTION_POLICIES', {}).get(self.name)
+        return None if days is None else timedelta(days=days)
+
+    def expired(self, now):
+        cutoff = now - self.max_age()
+        return self.model.objects.filter(self.extra_filter, **{f"{self.date_field}__lt": cutoff})
+
+
+POLICIES = {
+    policy.name: policy for policy in [
+        RetentionPolicy('messages', Message, 'timestamp'),
+        RetentionPolicy('rejected_friend_requests', FriendRequest, 'timestamp', Q(status='rejected')),
+        RetentionPolicy('change_events', ChangeEvent, 'created_at'),
+    ]
+}
+
+
+def delete_in_batches(queryset, batch_size, sleep, progress=None, log=None):
+    """
+    Delete `queryset` in primary-key order, `batch_size` rows per
+    transaction. Returns the number of rows deleted.
+    """
+    last_pk = progress.last_pk if progress else 0
+    deleted = 0
+    while True:
+        pks = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        with transaction.atomic():
+            queryset.model.objects.filter(pk__in=pks).delete()
+            last_pk = pks[-1]
+            if progress:
+                progress.last_pk = last_pk
+                progress.horizon_pk = max(progress.horizon_pk, last_pk)
+                progress.deleted += len(pks)
+                progress.save()
+        deleted += len(pks)
+        if log:
+            log(f"  deleted {len(pks)} (up to pk {last_pk})")
+        if sleep:
+            time.sleep(sleep)
+    if progress:
+        # Finished: the next run starts from the beginning again
+        progress.last_pk = 0
+        progress.save(update_fields=['last_pk', 'updated_at'])
+    return deleted
+
+
+def run_policy(policy, dry_run=False, batch_size=None, sleep=None, now=None, log=None):
+    """Apply one policy. Returns the number of rows deleted (or eligible when dry-running)."""
+    if policy.max_age() is None:
+        return 0
+    expired = policy.expired(now or timezone.now())
+    if dry_run:
+        return expired.count()
+    progress, _ = RetentionProgress.objects.get_or_create(policy=policy.name)
+    return delete_in_batches(
+        expired,
+        batch_size or settings.RETENTION_BATCH_SIZE,
+        settings.RETENTION_BATCH_SLEEP if sleep is None else sleep,
+        progress=progress,
+        log=log,
+    )
+
+
+def purge_user(user_id, dry_run=False, batch_size=None, sleep=None, log=None):
+    """
+    Delete a user the slow way: their chats' messages, change events and
+    chats in bounded batches first, so the final cascade is small.
+    Returns {table: rows}.
+    """
+    batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+    sleep = settings.RETENTION_BATCH_SLEEP if sleep is None else sleep
+    chats = Chat.objects.filter(Q(user1_id=user_id) | Q(user2_id=user_id))
+    steps = [
+        ('messages', Message.objects.filter(Q(chat__in=chats.values('id')) | Q(sender_id=user_id))),
+        ('change_events', ChangeEvent.objects.filter(user_id=user_id)),
+        ('friend_requests', FriendRequest.objects.filter(Q(from_user_id=user_id) | Q(to_user_id=user_id))),
+        ('chats', chats),
+        ('users', User.objects.filter(id=user_id)),
+    ]
+    counts = {}
+    for name, queryset in steps:
+        if log:
+            log(f"{name}:")
+        counts[name] = queryset.count() if dry_run else delete_in_batches(queryset, batch_size, sleep, log=log)
+    return counts
+
+
+def change_feed_horizon():
+    """Highest change event id ever pruned; older sync cursors are stale."""
+    return RetentionProgress.objects.filter(policy='change_events').values_list('horizon_pk', flat=True).first() or 0
@@ -0,0 +1,170 @@
+# rows.py
+"""
+values()-based serialization for the hot list endpoints.
+
+Each function reads only the columns a response needs with values_list()
+and maps the tuples straight to output dicts: no model instances and no
+per-field serializer calls. The output is the same as the matching
+serializer in serializers.py (the tests compare both), which remain in
+use for writes and for anything not on a hot path.
+"""
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Attachment
+
+
+def datetime_formatter():
+    """Formats datetimes the way DRF's DateTimeField does with ISO 8601 output."""
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+
+    def format_datetime(value):
+        if value is None:
+            return None
+        if tz is not None and timezone.is_aware(value):
+            value = value.astimezone(tz)
+        value = value.isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+
+    return format_datetime
+
+
+# Message ids per attachment query, well below every backend's parameter limit
+ID_BATCH_SIZE = 5000
+
+
+def attachments_by_message(message_ids):
+    """{message_id: [attachment dicts]}, one query per ID_BATCH_SIZE messages."""
+    grouped = defaultdict(list)
+    for start in range(0, len(message_ids), ID_BATCH_SIZE):
+        _add_attachments(grouped, _attachment_query(message_ids[start:start + ID_BATCH_SIZE]))
+    return grouped
+
+
+async def aattachments_by_message(message_ids):
+    """`attachments_by_message` with the async ORM."""
+    grouped = defaultdict(list)
+    for start in range(0, len(message_ids), ID_BATCH_SIZE):
+        query = _attachment_query(message_ids[start:start + ID_BATCH_SIZE])
+        _add_attachments(grouped, [row async for row in query])
+    return grouped
+
+
+def _attachment_query(message_ids):
+    return (
+        Attachment.objects.filter(message_id__in=message_ids)
+        .order_by('id')
+        .values_list('id', 'filename', 'content_type', 'file__size', 'message_id')
+    )
+
+
+def _add_attachments(grouped, rows):
+    for attachment_id, filename, content_type, size, message_id in rows:
+        grouped[message_id].append({
+            'id': attachment_id,
+            'filename': filename,
+            'content_type': content_type,
+            'size': size,
+            'url': reverse('attachment', args=[attachment_id]),
+        })
+
+
+MESSAGE_COLUMNS = ('id', 'message', 'sender__username', 'timestamp', 'sender_id', 'version', 'edited_at', 'deleted_at')
+
+
+def message_rows(queryset):
+    """Rows of `MessageSerializer`."""
+    rows = list(queryset.select_related(None).prefetch_related(None).values_list(*MESSAGE_COLUMNS))
+    return _format_messages(rows, attachments_by_message([row[0] for row in rows]))
+
+
+async def amessage_rows(queryset):
+    """`message_rows` with the async ORM."""
+    rows = [row async for row in queryset.select_related(None).prefetch_related(None).values_list(*MESSAGE_COLUMNS)]
+    return _format_messages(rows, await aattachments_by_message([row[0] for row in rows]))
+
+
+def _format_messages(rows, attachments):
+    format_datetime = datetime_formatter()
+    return [
+        {
+            'id': message_id,
+            'message': message,
+            'sender_username': sender_username,
+            'timestamp': format_datetime(timestamp),
+            'sender': sender_id,
+            'attachments': attachments.get(message_id, []),
+            'version': version,
+            'edited_at': format_datetime(edited_at),
+            'deleted': deleted_at is not None,
+        }
+        for message_id, message, sender_username, timestamp, sender_id, version, edited_at, deleted_at in rows
+    ]
+
+
+CHAT_COLUMNS = ('other_user_id', 'other_user_username', 'latest_message_content', 'latest_message_time')
+
+
+def chat_rows(queryset):
+    """Rows of `ChatListSerializer`; `queryset` carries its annotations."""
+    return _format_chats(queryset.values_list(*CHAT_COLUMNS))
+
+
+async def achat_rows(queryset):
+    """`chat_rows` with the async ORM."""
+    return _format_chats([row async for row in queryset.values_list(*CHAT_COLUMNS)])
+
+
+def _format_chats(rows):
+    format_datetime = datetime_formatter()
+    return [
+        {
+            'other_user_id': other_user_id,
+            'other_user_username': other_user_username,
+            'latest_message_content': latest_message_content,
+            'latest_message_time': format_datetime(latest_message_time),
+        }
+        for other_user_id, other_user_username, latest_message_content, latest_message_time in rows
+    ]
+
+
+def friend_request_rows(queryset):
+    """Rows of `FriendRequestSerializer`."""
+    format_datetime = datetime_formatter()
+    return [
+        {
+            'id': request_id,
+            'from_user': {'id': from_id, 'username': from_username},
+            'to_user': {'id': to_id, 'username': to_username},
+            'status': status,
+            'timestamp': format_datetime(timestamp),
+        }
+        for request_id, from_id, from_username, to_id, to_username, status, timestamp in (
+            queryset.select_related(None).values_list(
+                'id', 'from_user_id', 'from_user__username', 'to_user_id', 'to_user__username',
+                'status', 'timestamp',
+            )
+        )
+    ]
+
+
+def user_search_rows(queryset):
+    """Rows of `UserSearchAPI`; `queryset` carries the friendship annotations."""
+    return [
+        {
+            'id': user_id,
+            'username': username,
+            'is_friend': is_friend,
+            'has_pending_request_sent': sent,
+            'has_pending_request_received': received,
+        }
+        for user_id, username, is_friend, sent, received in queryset.values_list(
+            'id', 'username', 'is_friend', 'has_pending_request_sent', 'has_pending_request_received'
+        )
+    ]
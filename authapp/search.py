@@ -0,0 +1,160 @@
+# search.py
+"""
+Full-text search over the messages of the current user's chats.
+
+On PostgreSQL, messages carry a `search_vector` tsvector kept current by a
+trigger and indexed with GIN (migration 0009); results are ranked with
+`ts_rank` and highlighted with `ts_headline`. Other databases use the
+`MessageToken` inverted index, written alongside every message.
+
+Results are ordered by (rank, id) descending and paginated with an opaque
+keyset cursor, so later pages cost the same as the first one.
+"""
+
+import base64
+import json
+import re
+from collections import Counter
+
+from django.db import connection
+from django.db.models import Count, Q, Sum
+from django.utils.html import escape
+
+from .models import Chat, Message, MessageToken
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+MAX_TERM_LENGTH = 64
+# Markers survive ts_headline untouched and are swapped for <mark> tags
+# after the snippet has been HTML-escaped.
+START_MARK, STOP_MARK = "\ue000", "\ue001"
+
+
+def tokenize(text):
+    """Lower-cased terms of `text` with their occurrence counts."""
+    return Counter(
+        word[:MAX_TERM_LENGTH] for word in WORD_RE.findall((text or "").lower()) if len(word) > 1
+    )
+
+
+def uses_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def index_messages(messages):
+    """Add `messages` to the fallback index. PostgreSQL indexes via trigger."""
+    if uses_postgres():
+        return
+    MessageToken.objects.bulk_create([
+        MessageToken(term=term, message_id=message.id, chat_id=message.chat_id, count=count)
+        for message in messages
+        for term, count in tokenize(message.message).items()
+    ])
+
+
+def reindex_message(message):
+    if uses_postgres():
+        return
+    MessageToken.objects.filter(message_id=message.id).delete()
+    index_messages([message])
+
+
+def encode_cursor(rank, message_id):
+    raw = json.dumps([rank, message_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns (rank, id) or raises ValueError."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        rank, message_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(rank), int(message_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor.") from e
+
+
+def _mark(snippet):
+    return escape(snippet).replace(escape(START_MARK), "<mark>").replace(escape(STOP_MARK), "</mark>")
+
+
+def _highlight(text, terms):
+    pattern = re.compile(r"\b(" + "|".join(re.escape(t) for t in terms) + r")\b", re.IGNORECASE)
+    return _mark(pattern.sub(lambda m: f"{START_MARK}{m.group(0)}{STOP_MARK}", text))
+
+
+def search_messages(user, query, limit=20, cursor=None):
+    """
+    Returns (results, next_cursor). Each result has the message fields,
+    its `rank` and an HTML-safe `snippet` with matches wrapped in <mark>.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    if uses_postgres():
+        rows = _search_postgres(user, query, limit + 1, after)
+    else:
+        rows = _search_fallback(user, query, limit + 1, after)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['rank'], rows[-1]['id']) if has_more else None
+    return rows, next_cursor
+
+
+def _search_postgres(user, query, limit, after):
+    keyset, params = "", []
+    if after:
+        keyset = "AND (rank, id) < (%s, %s)"
+        params = list(after)
+    sql = f"""
+        SELECT page.id, page.chat_id, page.sender_id, u.username, page.timestamp, page.rank,
+               ts_headline('english', page.message, page.q,
+                           'StartSel={START_MARK}, StopSel={STOP_MARK}, MaxFragments=2, MaxWords=20')
+        FROM (
+            SELECT m.id, m.chat_id, m.sender_id, m.message, m.timestamp, q,
+                   ts_rank(m.search_vector, q)::float8 AS rank
+            FROM authapp_message m
+            JOIN authapp_chat c ON c.id = m.chat_id,
+                 websearch_to_tsquery('english', %s) q
+            WHERE m.search_vector @@ q AND (c.user1_id = %s OR c.user2_id = %s)
+        ) page
+        JOIN authapp_customuser u ON u.id = page.sender_id
+        WHERE TRUE {keyset}
+        ORDER BY page.rank DESC, page.id DESC
+        LIMIT %s
+    """
+    with connection.cursor() as cur:
+        cur.execute(sql, [query, user.id, user.id, *params, limit])
+        return [
+            {
+                'id': row[0], 'chat_id': row[1], 'sender': row[2], 'sender_username': row[3],
+                'timestamp': row[4], 'rank': row[5], 'snippet': _mark(row[6]),
+            }
+            for row in cur.fetchall()
+        ]
+
+
+def _search_fallback(user, query, limit, after):
+    terms = list(tokenize(query))
+    if not terms:
+        return []
+    chat_ids = Chat.objects.filter(Q(user1=user) | Q(user2=user)).values('id')
+    hits = (
+        MessageToken.objects.filter(term__in=terms, chat_id__in=chat_ids)
+        .values('message_id')
+        .annotate(matched=Count('term'), rank=Sum('count'))
+        .filter(matched=len(terms))
+    )
+    if after:
+        rank, message_id = after
+        hits = hits.filter(Q(rank__lt=rank) | Q(rank=rank, message_id__lt=message_id))
+    hits = list(hits.order_by('-rank', '-message_id')[:limit])
+
+    messages = Message.objects.select_related('sender').in_bulk([h['message_id'] for h in hits])
+    results = []
+    for hit in hits:
+        message = messages[hit['message_id']]
+        results.append({
+            'id': message.id, 'chat_id': message.chat_id, 'sender': message.sender_id,
+            'sender_username': message.sender.username, 'timestamp': message.timestamp,
+            'rank': float(hit['rank']), 'snippet': _highlight(message.message, terms),
+        })
+    return results
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import authenticate
 from .models import CustomUser
 
@@ -13,6 +14,12 @@ class RegisterSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'email', 'password')
         extra_kwargs = {'password': {'write_only': True}}
 
+    def validate_username(self, value):
+        # Reserved for the bot's account, see bot.get_bot_user
+        if value.lower() == settings.BOT_USERNAME.lower():
+            raise serializers.ValidationError("This username is reserved.")
+        return value
+
     def create(self, validated_data):
         user = CustomUser.objects.create_user(
             username=validated_data['username'],
@@ -33,15 +40,35 @@ class LoginSerializer(serializers.Serializer):
 
 
 # serializers.py
+from django.urls import reverse
 from rest_framework import serializers
-from .models import Message
+from .models import Attachment, Message
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    size = serializers.IntegerField(source='file.size')
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Attachment
+        fields = ['id', 'filename', 'content_type', 'size', 'url']
+
+    def get_url(self, obj):
+        return reverse('attachment', args=[obj.id])
+
 
 class MessageSerializer(serializers.ModelSerializer):
     sender_username = serializers.CharField(source='sender.username')
+    # Callers prefetch 'attachments__file'
+    attachments = AttachmentSerializer(many=True, read_only=True)
+    deleted = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
-        fields = ['message', 'sender_username', 'timestamp', 'sender']
+        fields = ['id', 'message', 'sender_username', 'timestamp', 'sender', 'attachments', 'version', 'edited_at',
+                  'deleted']
+
+    def get_deleted(self, obj):
+        return obj.deleted_at is not None
 
 
 from rest_framework import serializers
@@ -0,0 +1,117 @@
+# storage.py
+"""
+Attachment storage backends.
+
+Uploads arrive in chunks that are appended to a partial file; a completed
+upload is hashed and committed under its SHA-256 so identical files are
+stored once. ATTACHMENT_STORAGE selects the backend class.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+COPY_BUFFER = 1024 * 1024
+
+
+class AttachmentStorage:
+    """Interface of an attachment backend."""
+
+    def append(self, upload_id, offset, chunks):
+        """Write `chunks` (an iterable of bytes) at `offset` of the partial upload; returns its new size."""
+        raise NotImplementedError
+
+    def partial_size(self, upload_id):
+        """Bytes received so far, 0 if nothing was written."""
+        raise NotImplementedError
+
+    def hash_partial(self, upload_id):
+        """SHA-256 hex digest of the partial upload."""
+        raise NotImplementedError
+
+    def commit(self, upload_id, digest):
+        """Move the finished upload to its content address, returns the stored name."""
+        raise NotImplementedError
+
+    def discard(self, upload_id):
+        raise NotImplementedError
+
+    def open(self, name):
+        raise NotImplementedError
+
+    def local_path(self, name):
+        """Filesystem path of a stored file, or None if it has none."""
+        return None
+
+    def delete(self, name):
+        raise NotImplementedError
+
+
+class LocalFileStorage(AttachmentStorage):
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        return Path(self._root or settings.ATTACHMENT_ROOT)
+
+    def _partial(self, upload_id):
+        return self.root / 'partial' / f"{upload_id}.part"
+
+    def local_path(self, name):
+        return self.root / name
+
+    def append(self, upload_id, offset, chunks):
+        path = self._partial(upload_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'r+b' if path.exists() else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def partial_size(self, upload_id):
+        path = self._partial(upload_id)
+        return path.stat().st_size if path.exists() else 0
+
+    def hash_partial(self, upload_id):
+        digest = hashlib.sha256()
+        with open(self._partial(upload_id), 'rb') as f:
+            while block := f.read(COPY_BUFFER):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def commit(self, upload_id, digest):
+        name = f"{digest[:2]}/{digest}"
+        target = self.local_path(name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.exists():
+            self.discard(upload_id)
+        else:
+            os.replace(self._partial(upload_id), target)
+        return name
+
+    def discard(self, upload_id):
+        self._partial(upload_id).unlink(missing_ok=True)
+
+    def open(self, name):
+        return open(self.local_path(name), 'rb')
+
+    def delete(self, name):
+        self.local_path(name).unlink(missing_ok=True)
+
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = import_string(getattr(settings, 'ATTACHMENT_STORAGE', 'authapp.storage.LocalFileStorage'))()
+    return _storage
@@ -0,0 +1,177 @@
+# suggestions.py
+"""
+"People you may know": non-friends ranked by the number of mutual friends.
+
+`FriendSuggestion` holds (user, candidate, mutual_count) and is updated
+incrementally when a friendship is made: every friend of one side gains
+the other side as a candidate (and the other way round), with an atomic
+upsert. The users on both sides are locked first and the new edges must
+still be uncommitted, so two friendships sharing a user (A-B and B-C
+accepted at once) are counted one after the other and the second sees
+the first's edge. Each user keeps at most FRIEND_SUGGESTIONS_PER_USER
+candidates. Trimming can undercount a candidate that later comes back,
+and nothing decrements when a user is deleted; `python manage.py
+rebuild_friend_suggestions` recomputes everything from the graph.
+"""
+
+import heapq
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+
+from .models import CustomUser, FriendRequest, FriendSuggestion
+
+UPSERT_BATCH_SIZE = 5000
+
+
+def friends_of(user_ids):
+    """{user_id: set of friend ids} for `user_ids`, one query."""
+    user_ids = set(user_ids)
+    friends = defaultdict(set)
+    for from_id, to_id in FriendRequest.objects.filter(
+        Q(from_user_id__in=user_ids) | Q(to_user_id__in=user_ids), status='accepted'
+    ).values_list('from_user_id', 'to_user_id'):
+        if from_id in user_ids:
+            friends[from_id].add(to_id)
+        if to_id in user_ids:
+            friends[to_id].add(from_id)
+    return friends
+
+
+def add_counts(counts):
+    """Add {(user_id, candidate_id): n} to the stored mutual counts."""
+    items = list(counts.items())
+    table = FriendSuggestion._meta.db_table
+    batch_size = min(UPSERT_BATCH_SIZE, (connection.features.max_query_params or 3 * UPSERT_BATCH_SIZE) // 3)
+    with connection.cursor() as cursor:
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            values = ", ".join(["(%s, %s, %s)"] * len(batch))
+            cursor.execute(
+                f"INSERT INTO {table} (user_id, candidate_id, mutual_count) VALUES {values} "
+                f"ON CONFLICT (user_id, candidate_id) "
+                f"DO UPDATE SET mutual_count = {table}.mutual_count + excluded.mutual_count",
+                [value for (user_id, candidate_id), n in batch for value in (user_id, candidate_id, n)],
+            )
+
+
+def trim(user_ids):
+    """Keep only the best FRIEND_SUGGESTIONS_PER_USER candidates of each user."""
+    ranked = FriendSuggestion.objects.filter(user_id__in=user_ids).annotate(
+        rank=Window(RowNumber(), partition_by=F('user_id'), order_by=[F('mutual_count').desc(), F('candidate_id')])
+    ).filter(rank__gt=settings.FRIEND_SUGGESTIONS_PER_USER)
+    FriendSuggestion.objects.filter(id__in=list(ranked.values_list('id', flat=True))).delete()
+
+
+def friendships_added(user_id, new_friend_ids):
+    """
+    Update suggestions after `user_id` became friends with each of
+    `new_friend_ids` (saved as accepted in the caller's transaction, not yet
+    committed), e.g. a bulk accept.
+    """
+    new_friend_ids = list(new_friend_ids)
+    with transaction.atomic():
+        # Held until commit: a concurrent accept touching any of these
+        # users reads the graph only once this one's edges are visible
+        list(CustomUser.objects.select_for_update().filter(
+            id__in=[user_id, *new_friend_ids]
+        ).order_by('id').values_list('id', flat=True))
+        _friendships_added(user_id, new_friend_ids)
+
+
+def _friendships_added(user_id, new_friend_ids):
+    graph = friends_of([user_id, *new_friend_ids])
+    counts = Counter()
+    for i, new_friend in enumerate(new_friend_ids):
+        # Replay the friendships one at a time so two of them made
+        # together are not both counted as each other's mutual friend
+        mine = graph[user_id] - set(new_friend_ids[i:])
+        theirs = graph[new_friend] - {user_id}
+        # user_id is now a mutual friend of new_friend and each of its friends...
+        for friend in mine - theirs:
+            counts[(new_friend, friend)] += 1
+            counts[(friend, new_friend)] += 1
+        # ...and new_friend one of user_id and each of new_friend's friends
+        for friend in theirs - mine:
+            counts[(user_id, friend)] += 1
+            counts[(friend, user_id)] += 1
+
+    # Friends are never suggested to each other
+    made = Q(user_id=user_id, candidate_id__in=new_friend_ids) | Q(user_id__in=new_friend_ids, candidate_id=user_id)
+    for pair in [(user_id, f) for f in new_friend_ids] + [(f, user_id) for f in new_friend_ids]:
+        counts.pop(pair, None)
+    FriendSuggestion.objects.filter(made).delete()
+    if counts:
+        add_counts(counts)
+        trim({user for user, _ in counts})
+
+
+def friendship_added(a, b):
+    """Update suggestions after `a` and `b` became friends."""
+    friendships_added(a, [b])
+
+
+def suggestions_for(user, limit=20):
+    """Best candidates for `user` without a pending request either way."""
+    # Plain SQL: building the equivalent queryset costs more than running it
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT s.candidate_id, u.username, s.mutual_count
+            FROM {FriendSuggestion._meta.db_table} s
+            JOIN {CustomUser._meta.db_table} u ON u.id = s.candidate_id
+            WHERE s.user_id = %s AND NOT EXISTS (
+                SELECT 1 FROM {FriendRequest._meta.db_table} r
+                WHERE r.status = 'pending' AND (
+                    (r.from_user_id = %s AND r.to_user_id = s.candidate_id)
+                    OR (r.from_user_id = s.candidate_id AND r.to_user_id = %s)
+                )
+            )
+            ORDER BY s.mutual_count DESC, s.candidate_id
+            LIMIT %s
+            """,
+            [user.id, user.id, user.id, limit],
+        )
+        rows = cursor.fetchall()
+    return [
+        {'id': candidate_id, 'username': username, 'mutual_friends': mutual_count}
+        for candidate_id, username, mutual_count in rows
+    ]
+
+
+def rebuild(batch_size=10000, log=None):
+    """Recompute every user's suggestions from the accepted friendships."""
+    graph = defaultdict(set)
+    for from_id, to_id in FriendRequest.objects.filter(status='accepted').values_list(
+        'from_user_id', 'to_user_id'
+    ).iterator(chunk_size=10000):
+        graph[from_id].add(to_id)
+        graph[to_id].add(from_id)
+
+    limit = settings.FRIEND_SUGGESTIONS_PER_USER
+    insert = (
+        f"INSERT INTO {FriendSuggestion._meta.db_table} (user_id, candidate_id, mutual_count) "
+        f"VALUES (%s, %s, %s)"
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        FriendSuggestion.objects.all().delete()
+        pending = []
+        for user_id, friends in graph.items():
+            mutual = Counter()
+            for friend in friends:
+                mutual.update(graph[friend])
+            mutual.pop(user_id, None)
+            for friend in friends:
+                mutual.pop(friend, None)
+            best = heapq.nsmallest(limit, mutual.items(), key=lambda item: (-item[1], item[0]))
+            pending.extend((user_id, candidate_id, count) for candidate_id, count in best)
+            if len(pending) >= batch_size:
+                cursor.executemany(insert, pending)
+                pending = []
+        if pending:
+            cursor.executemany(insert, pending)
+    if log:
+        log(f"Rebuilt suggestions for {len(graph)} users")
@@ -0,0 +1,90 @@
+# tracing.py
+"""
+Latency tracing for chat messages.
+
+`PrivateChatConsumer.receive` starts a `Trace` for each incoming frame and
+stamps it as the message moves on: parse -> chat -> persist -> publish.
+Those stages are measured with the monotonic clock of the receiving
+process. The trace travels in the group_send event, and each recipient
+consumer calls `delivered()` before forwarding the event. That last leg can
+cross processes, so it is measured against the wall-clock start time.
+
+Every stage's duration goes to the `message_trace.<stage>_ms` histogram,
+and the total to `message_trace.total_ms`. Messages slower than
+MESSAGE_TRACE_SLOW_MS are logged to the `authapp.tracing` logger with
+their full stage breakdown.
+"""
+
+import logging
+import time
+import uuid
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.stages = [('receive', 0.0)]  # (stage, ms since receive)
+
+    def stamp(self, stage):
+        elapsed = (time.monotonic() - self._started) * 1000
+        metrics.histogram(f'message_trace.{stage}_ms').observe(elapsed - self.stages[-1][1])
+        self.stages.append((stage, elapsed))
+
+    def event(self):
+        """The trace as it is carried in a channel layer event."""
+        return {
+            'id': self.id,
+            'started_at': self.started_at,
+            'stages': [[stage, round(ms, 3)] for stage, ms in self.stages],
+        }
+
+
+def start():
+    """A new trace, or None when MESSAGE_TRACING is off."""
+    return Trace() if settings.MESSAGE_TRACING else None
+
+
+def stamp(trace, stage):
+    if trace is not None:
+        trace.stamp(stage)
+
+
+def traced(event, trace):
+    """`event` with `trace` attached, for group_send."""
+    if trace is not None:
+        event['trace'] = trace.event()
+    return event
+
+
+def delivered(event, record=True):
+    """
+    Record the delivery of a traced event and return it without the trace,
+    ready to send to the client. `record=False` only strips the trace.
+    """
+    trace = event.get('trace')
+    if trace is None:
+        return event
+    if not record:
+        return {key: value for key, value in event.items() if key != 'trace'}
+    total = (time.time() - trace['started_at']) * 1000
+    deliver = max(0.0, total - trace['stages'][-1][1])
+    metrics.histogram('message_trace.deliver_ms').observe(deliver)
+    metrics.histogram('message_trace.total_ms').observe(total)
+    slow_ms = settings.MESSAGE_TRACE_SLOW_MS
+    if slow_ms is not None and total >= slow_ms:
+        breakdown = ", ".join(
+            f"{stage} {ms - previous:.1f}ms"
+            for (stage, ms), (_, previous) in zip(trace['stages'][1:], trace['stages'])
+        )
+        logger.warning(
+            "Slow message %s: %.1fms total (%s, deliver %.1fms)", trace['id'], total, breakdown, deliver
+        )
+    return {key: value for key, value in event.items() if key != 'trace'}
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from .views import RegisterAPI, LoginAPI, UserAPI,LangflowAPI,UserListAPI,MessageHistoryAPI,SendFriendRequestAPI, AcceptFriendRequestAPI, RejectFriendRequestAPI,PendingFriendRequestsAPI, UserSearchAPI, LogoutAPI
+from .views import RegisterAPI, LoginAPI, UserAPI,LangflowAPI,UserListAPI,MessageHistoryAPI,SendFriendRequestAPI, AcceptFriendRequestAPI, RejectFriendRequestAPI, BulkFriendRequestAPI,PendingFriendRequestsAPI, UserSearchAPI, LogoutAPI
 from . import views
 
 
@@ -9,14 +9,28 @@ urlpatterns = [
     path('login/', LoginAPI.as_view(), name='login'),
     path('user/', UserAPI.as_view(), name='user'),
     path('chat/', LangflowAPI.as_view(), name='chat-api'),
+    path('chat/jobs/<int:pk>/', views.BotJobAPI.as_view(), name='bot-job'),
     path('users/', UserListAPI.as_view(), name='user-list'),  # New endpoint
     path('messages/<int:other_user_id>/', MessageHistoryAPI.as_view(), name='message-history'),
+    path('messages/search/', views.MessageSearchAPI.as_view(), name='message-search'),
+    path('messages/<int:other_user_id>/<int:pk>/', views.MessageMutationAPI.as_view(), name='message-mutation'),
 
     path('friend-requests/send/', SendFriendRequestAPI.as_view(), name='send-request'),
     path('friend-requests/accept/<int:pk>/', AcceptFriendRequestAPI.as_view(), name='accept-request'),
     path('friend-requests/reject/<int:pk>/', RejectFriendRequestAPI.as_view(), name='reject-request'),
+    path('friend-requests/bulk/', BulkFriendRequestAPI.as_view(), name='bulk-requests'),
     path('friend-requests/pending/', PendingFriendRequestsAPI.as_view(), name='pending-requests'),
+    path('friends/suggestions/', views.FriendSuggestionsAPI.as_view(), name='friend-suggestions'),
     path('users/search/', UserSearchAPI.as_view(), name='user-search'),
     path('users/<int:user_id>/status/', views.user_status, name='user-status'),
+    path('async/users/', views.async_user_list, name='async-user-list'),
+    path('async/messages/<int:other_user_id>/', views.async_message_history, name='async-message-history'),
+    path('async/users/<int:user_id>/status/', views.async_user_status, name='async-user-status'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('stats/', views.stats_view, name='stats'),
+    path('sync/', views.SyncAPI.as_view(), name='sync'),
+    path('attachments/uploads/', views.UploadStartAPI.as_view(), name='upload-start'),
+    path('attachments/uploads/<uuid:pk>/', views.UploadChunkAPI.as_view(), name='upload-chunk'),
+    path('attachments/<int:pk>/', views.attachment_download, name='attachment'),
     
 ]
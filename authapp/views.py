@@ -42,8 +42,66 @@ class UserAPI(generics.RetrieveAPIView):
 from django.db.models import Q, OuterRef, Subquery, Case, When, F
 from rest_framework import generics, permissions
 from .serializers import ChatListSerializer
-from .models import Chat, Message, User
+from .models import BotJob, Chat, Message, User, FriendRequest
 from django.db import models
+from . import archive, changes, messaging, retention, rows, search, suggestions
+
+
+import hashlib
+from django.db.models import Count, Max, Sum
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+
+def chat_list_etag(request, *args, **kwargs):
+    """
+    Version of the user's chat list: number of chats and friendships plus
+    the newest message id and the edit versions across all chats. Two
+    aggregate queries, no join with messages and no per-chat subqueries.
+    """
+    current_user = request.user
+    if not current_user.is_authenticated:
+        return None
+    chats, friends = chat_list_etag_queries(current_user)
+    return format_chat_list_etag(request, chats.aggregate(**CHAT_LIST_AGGREGATES), friends.count())
+
+
+CHAT_LIST_AGGREGATES = {'count': Count('id'), 'last': Max('last_message_id'), 'edits': Sum('version')}
+
+
+def chat_list_etag_queries(current_user):
+    chats = Chat.objects.filter(Q(user1=current_user) | Q(user2=current_user))
+    friends = FriendRequest.objects.filter(Q(from_user=current_user) | Q(to_user=current_user), status='accepted')
+    return chats, friends
+
+
+def format_chat_list_etag(request, chats, friends):
+    search = hashlib.md5(request.GET.get('search', '').strip().encode()).hexdigest()[:8]
+    return f"c{request.user.id}-{chats['count']}-{chats['last'] or 0}-{chats['edits'] or 0}-{friends}-{search}"
+
+
+def message_history_etag(request, other_user_id, *args, **kwargs):
+    """The chat's newest message id and edit version, read from the chat row itself."""
+    current_user = request.user
+    if not current_user.is_authenticated:
+        return None
+    chat = history_chat_query(current_user, other_user_id).first()
+    # Saved for MessageHistoryAPI so the chat is only looked up once
+    request.history_chat = chat
+    return format_history_etag(current_user, other_user_id, chat)
+
+
+def history_chat_query(current_user, other_user_id):
+    return Chat.objects.filter(
+        user1_id=min(current_user.id, other_user_id),
+        user2_id=max(current_user.id, other_user_id),
+    ).values('id', 'last_message_id', 'archived_through', 'version')
+
+
+def format_history_etag(current_user, other_user_id, chat):
+    if chat is None:
+        return f"h{current_user.id}-{other_user_id}-0"
+    return f"h{chat['id']}-{chat['last_message_id'] or 0}-{chat['version']}"
 
 
 # views.py
@@ -51,53 +109,61 @@ class UserListAPI(generics.ListAPIView):
     serializer_class = ChatListSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @method_decorator(condition(etag_func=chat_list_etag))
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
     def get_queryset(self):
         current_user = self.request.user
         search_query = self.request.query_params.get('search', '').strip()
 
-        # Get all friends (accepted requests)
-        accepted_users = User.objects.filter(
-            Q(received_requests__from_user=current_user, received_requests__status='accepted') |
-            Q(sent_requests__to_user=current_user, sent_requests__status='accepted')
-        ).distinct()
-
-        # Get or create chats for accepted friends
-        for user in accepted_users:
-            if current_user.id < user.id:
-                Chat.objects.get_or_create(user1=current_user, user2=user)
-            else:
-                Chat.objects.get_or_create(user1=user, user2=current_user)
-
-        # Subquery to get the latest message in each chat
-        latest_message = Message.objects.filter(
-            chat=OuterRef('pk')
-        ).order_by('-timestamp')
-
-        # Get all chats involving the current user
-        chats = Chat.objects.filter(
-            Q(user1=current_user) | Q(user2=current_user)
-        ).annotate(
-            other_user_id=Case(
-                When(user1=current_user, then=F('user2')),
-                When(user2=current_user, then=F('user1')),
-                output_field=models.IntegerField()
-            ),
-            other_user_username=Case(
-                When(user1=current_user, then=F('user2__username')),
-                When(user2=current_user, then=F('user1__username')),
-                output_field=models.CharField()
-            ),
-            latest_message_content=Subquery(latest_message.values('message')[:1]),
-            latest_message_time=Subquery(latest_message.values('timestamp')[:1])
-        ).order_by('-latest_message_time')
-
-        # Filter by search query
-        if search_query:
-            chats = chats.filter(
-                other_user_username__icontains=search_query
-            )
+        # Create the missing chats for accepted friends in one go
+        messaging.create_missing_chats(current_user.id, set(friend_ids_query(current_user)))
+        return chat_list_queryset(current_user, search_query)
+
+    def list(self, request, *args, **kwargs):
+        return Response(rows.chat_rows(self.get_queryset()))
+
+
+def friend_ids_query(current_user):
+    """Ids of all friends (accepted requests)."""
+    return User.objects.filter(
+        Q(received_requests__from_user=current_user, received_requests__status='accepted') |
+        Q(sent_requests__to_user=current_user, sent_requests__status='accepted')
+    ).values_list('id', flat=True)
+
+
+def chat_list_queryset(current_user, search_query):
+    # Subquery to get the latest message in each chat
+    latest_message = Message.objects.filter(
+        chat=OuterRef('pk')
+    ).order_by('-timestamp')
+
+    # Get all chats involving the current user
+    chats = Chat.objects.filter(
+        Q(user1=current_user) | Q(user2=current_user)
+    ).annotate(
+        other_user_id=Case(
+            When(user1=current_user, then=F('user2')),
+            When(user2=current_user, then=F('user1')),
+            output_field=models.IntegerField()
+        ),
+        other_user_username=Case(
+            When(user1=current_user, then=F('user2__username')),
+            When(user2=current_user, then=F('user1__username')),
+            output_field=models.CharField()
+        ),
+        latest_message_content=Subquery(latest_message.values('message')[:1]),
+        latest_message_time=Subquery(latest_message.values('timestamp')[:1])
+    ).order_by('-latest_message_time')
+
+    # Filter by search query
+    if search_query:
+        chats = chats.filter(
+            other_user_username__icontains=search_query
+        )
 
-        return chats
+    return chats
     
 
 from rest_framework.decorators import api_view, permission_classes
@@ -115,24 +181,94 @@ from rest_framework.views import APIView
 
 # views.py
 class MessageHistoryAPI(generics.ListAPIView):
+    """
+    Chat history, oldest first. With ?before=<id>&limit=<n> only the n
+    messages preceding `before` are returned; pages continue from hot rows
+    into archived segments transparently. With ?since_version=<v> only the
+    messages edited or deleted after chat version v are returned, as
+    {"version": <current>, "mutations": [...]}.
+    """
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @method_decorator(condition(etag_func=message_history_etag))
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_chat(self):
+        if not hasattr(self.request, 'history_chat'):
+            message_history_etag(self.request, self.kwargs['other_user_id'])
+        return self.request.history_chat
+
     def get_queryset(self):
-        other_user_id = self.kwargs['other_user_id']
-        current_user = self.request.user
-        
-        # Get messages in chronological order (oldest first)
-        return Message.objects.filter(
-            Q(chat__user1=current_user, chat__user2=other_user_id) |
-            Q(chat__user2=current_user, chat__user1=other_user_id)
-        ).order_by('timestamp')  # Oldest first
+        return history_queryset(self.get_chat(), None, None)
+
+    def list(self, request, *args, **kwargs):
+        try:
+            before, limit, since_version = parse_history_params(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        chat = self.get_chat()
+        if since_version is not None:
+            mutations = []
+            if chat and chat['version'] > since_version:
+                mutations = rows.message_rows(mutations_queryset(chat, since_version))
+            return Response({"version": chat['version'] if chat else 0, "mutations": mutations})
+
+        data = rows.message_rows(history_queryset(chat, before, limit))
+        if limit is not None:
+            data = data[::-1]
+        if needs_archive(chat, data, limit):
+            data = archived_before(chat, before, limit, data) + data
+        return Response(data)
+
+
+def parse_history_params(params):
+    """(before, limit, since_version) of a history request; ValueError says what is wrong."""
+    try:
+        before = int(params['before']) if 'before' in params else None
+        limit = int(params['limit']) if 'limit' in params else None
+    except ValueError:
+        raise ValueError("'before' and 'limit' must be integers.")
+    if limit is not None and limit < 1:
+        raise ValueError("'limit' must be positive.")
+    try:
+        since_version = int(params['since_version']) if 'since_version' in params else None
+    except ValueError:
+        raise ValueError("'since_version' must be an integer.")
+    return before, limit, since_version
+
+
+def history_queryset(chat, before, limit):
+    """Hot messages of a history page: oldest first, or the `limit` newest ones newest first."""
+    if chat is None:
+        return Message.objects.none()
+    # Get messages in chronological order (oldest first)
+    queryset = Message.objects.filter(chat_id=chat['id']).order_by('timestamp')
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    if limit is not None:
+        queryset = queryset.order_by('-id')[:limit]
+    return queryset
+
+
+def mutations_queryset(chat, since_version):
+    return Message.objects.filter(chat_id=chat['id'], version__gt=since_version).order_by('version')
+
+
+def needs_archive(chat, data, limit):
+    return chat and chat['archived_through'] and (limit is None or len(data) < limit)
+
+
+def archived_before(chat, before, limit, data):
+    return archive.archived_messages(chat['id'], before_id=before, limit=None if limit is None else limit - len(data))
 
 
 from django.db.models import Q
 from rest_framework.views import APIView
 from rest_framework import permissions, status
 from rest_framework.response import Response
+from django.db import transaction
 from .models import FriendRequest, User, Chat
 from .serializers import FriendRequestSerializer
 
@@ -190,6 +326,9 @@ class SendFriendRequestAPI(APIView):
             from_user=request.user, 
             to_user=to_user
         )
+        changes.friend_requests_changed([
+            (friend_request.id, request.user.id, to_user.id, 'pending')
+        ])
         serializer = FriendRequestSerializer(friend_request)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -197,7 +336,7 @@ class SendFriendRequestAPI(APIView):
 
 # views.py
 class AcceptFriendRequestAPI(generics.UpdateAPIView):
-    queryset = FriendRequest.objects.all()
+    queryset = FriendRequest.objects.select_related('from_user', 'to_user')
     serializer_class = FriendRequestSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -206,9 +345,17 @@ class AcceptFriendRequestAPI(generics.UpdateAPIView):
         if friend_request.to_user != request.user:
             return Response({"error": "Unauthorized."}, status=status.HTTP_403_FORBIDDEN)
 
-        # Accept the friend request
-        friend_request.status = 'accepted'
-        friend_request.save()
+        # Accept the friend request. The new edge stays uncommitted until the
+        # suggestions are updated, see suggestions.py
+        was_accepted = friend_request.status == 'accepted'
+        with transaction.atomic():
+            friend_request.status = 'accepted'
+            friend_request.save(update_fields=['status'])
+            changes.friend_requests_changed([
+                (friend_request.id, friend_request.from_user_id, friend_request.to_user_id, 'accepted')
+            ])
+            if not was_accepted:
+                suggestions.friendship_added(friend_request.to_user_id, friend_request.from_user_id)
 
         # Create a chat between the two users if it doesn't exist
         user1 = friend_request.from_user
@@ -218,7 +365,7 @@ class AcceptFriendRequestAPI(generics.UpdateAPIView):
         if user1.id > user2.id:
             user1, user2 = user2, user1
 
-        Chat.objects.get_or_create(user1=user1, user2=user2)
+        messaging.get_or_create_chat(user1.id, user2.id)
 
         # Send WebSocket updates
         from channels.layers import get_channel_layer
@@ -240,7 +387,7 @@ class AcceptFriendRequestAPI(generics.UpdateAPIView):
         return Response({"status": "accepted"})
 
 class RejectFriendRequestAPI(generics.UpdateAPIView):
-    queryset = FriendRequest.objects.all()
+    queryset = FriendRequest.objects.select_related('from_user', 'to_user')
     serializer_class = FriendRequestSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -250,15 +397,116 @@ class RejectFriendRequestAPI(generics.UpdateAPIView):
             return Response({"error": "Unauthorized."}, status=status.HTTP_403_FORBIDDEN)
 
         friend_request.status = 'rejected'
-        friend_request.save()
+        friend_request.save(update_fields=['status'])
+        changes.friend_requests_changed([
+            (friend_request.id, friend_request.from_user_id, friend_request.to_user_id, 'rejected')
+        ])
         return Response({"status": "rejected"})
 
+class FriendSuggestionsAPI(APIView):
+    """People you may know: non-friends ranked by mutual friends, ?limit=<n>."""
+    permission_classes = [permissions.IsAuthenticated]
+    max_limit = 100
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), self.max_limit)
+        except ValueError:
+            return Response({"error": "'limit' must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(suggestions.suggestions_for(request.user, limit))
+
+
+class BulkFriendRequestAPI(APIView):
+    """
+    Accept and/or reject many pending requests at once:
+    {"accept": [ids], "reject": [ids]}. Everything is applied in one
+    transaction and each affected user gets a single WebSocket update
+    once it commits.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            accept_ids = {int(pk) for pk in request.data.get('accept', [])}
+            reject_ids = {int(pk) for pk in request.data.get('reject', [])}
+        except (TypeError, ValueError):
+            return Response({"error": "'accept' and 'reject' must be lists of ids."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if accept_ids & reject_ids:
+            return Response({"error": "A request cannot be both accepted and rejected."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not accept_ids and not reject_ids:
+            return Response({"error": "Nothing to do."}, status=status.HTTP_400_BAD_REQUEST)
+
+        current_user = request.user
+        with transaction.atomic():
+            pending = dict(FriendRequest.objects.select_for_update().filter(
+                id__in=accept_ids | reject_ids, to_user=current_user, status='pending'
+            ).values_list('id', 'from_user_id'))
+            accepted = sorted(pk for pk in accept_ids if pk in pending)
+            rejected = sorted(pk for pk in reject_ids if pk in pending)
+
+            if accepted:
+                FriendRequest.objects.filter(id__in=accepted).update(status='accepted')
+            if rejected:
+                FriendRequest.objects.filter(id__in=rejected).update(status='rejected')
+
+            changes.friend_requests_changed(
+                [(pk, pending[pk], current_user.id, 'accepted') for pk in accepted] +
+                [(pk, pending[pk], current_user.id, 'rejected') for pk in rejected]
+            )
+
+            new_friend_ids = {pending[pk] for pk in accepted}
+            if new_friend_ids:
+                messaging.create_missing_chats(current_user.id, new_friend_ids)
+                suggestions.friendships_added(current_user.id, sorted(new_friend_ids))
+                transaction.on_commit(
+                    lambda: notify_new_friends(current_user.id, sorted(new_friend_ids))
+                )
+
+        return Response({
+            "accepted": accepted,
+            "rejected": rejected,
+            "skipped": sorted((accept_ids | reject_ids) - set(pending)),
+        })
+
+
+def notify_new_friends(user_id, friend_ids):
+    """One coalesced chat-list update for `user_id`, one for each new friend."""
+    from channels.layers import get_channel_layer
+    from asgiref.sync import async_to_sync
+
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        f"chatlist_{user_id}",
+        {
+            "type": "friend_updates",
+            "user_ids": friend_ids,
+            "status": "connected"
+        }
+    )
+    for friend_id in friend_ids:
+        async_to_sync(channel_layer.group_send)(
+            f"chatlist_{friend_id}",
+            {
+                "type": "friend_update",
+                "user_id": user_id,
+                "status": "connected"
+            }
+        )
+
+
 class PendingFriendRequestsAPI(generics.ListAPIView):
     serializer_class = FriendRequestSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return FriendRequest.objects.filter(to_user=self.request.user, status='pending')
+        return FriendRequest.objects.filter(
+            to_user=self.request.user, status='pending'
+        ).select_related('from_user', 'to_user')
+
+    def list(self, request, *args, **kwargs):
+        return Response(rows.friend_request_rows(self.get_queryset()))
     
 
 
@@ -294,15 +542,7 @@ class UserSearchAPI(APIView):
             )
         )
 
-        user_data = []
-        for user in users:
-            user_data.append({
-                'id': user.id,
-                'username': user.username,
-                'is_friend': user.is_friend,
-                'has_pending_request_sent': user.has_pending_request_sent,
-                'has_pending_request_received': user.has_pending_request_received
-            })
+        user_data = rows.user_search_rows(users)
 
         # Add no users found message
         if not user_data:
@@ -414,37 +654,25 @@ def user_status(request, user_id):
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-import requests
-import json
 from typing import Optional
+from django.urls import reverse
 
-import os
-from dotenv import load_dotenv
-import dj_database_url
-
-# Load environment variables from .env file
-load_dotenv()
+import logging
 
+from .langflow import APPLICATION_TOKEN, TWEAKS
+from . import bot, langflow
 
-# Access environment variables
-BASE_API_URL = os.getenv("BASE_API_URL")
-LANGFLOW_ID = os.getenv("LANGFLOW_ID")
-FLOW_ID = os.getenv("FLOW_ID")
-APPLICATION_TOKEN = os.getenv("APPLICATION_TOKEN")
-ENDPOINT = os.getenv("ENDPOINT", "")  # You can set a specific endpoint name in the flow settings
+logger = logging.getLogger(__name__)
 
-TWEAKS = {
-    "ChatInput-H8D4c": {},
-    "ChatOutput-lbpA5": {},
-    "File-PPYW6": {},
-    "CustomComponent-c79R6": {},
-    "HuggingFaceModel-wsmU0": {}
-}
 
 class LangflowAPI(APIView):
     """
     A view to handle the LangFlow chat functionality.
     Accepts a POST request with the message and customizations (optional).
+
+    With "queue": true (or ?mode=queue) the message is handed to the bot
+    workers instead and the response is 202 with the job to poll. With
+    "chat": true the reply is also posted in the user's chat with the bot.
     """
 
     def post(self, request, *args, **kwargs):
@@ -452,13 +680,15 @@ class LangflowAPI(APIView):
         tweaks = request.data.get("tweaks", TWEAKS)
         application_token = request.data.get("application_token", APPLICATION_TOKEN)
 
-        # Debug: Print message and tweaks received in the request
-        print("Received message:", message)
-        print("Received tweaks:", tweaks)
+        # Sizes only: never log what users send the bot
+        logger.debug("Bot request (%d chars, %d tweaks)", len(message), len(tweaks or {}))
 
         if not message:
             return Response({"error": "Message cannot be empty."}, status=status.HTTP_400_BAD_REQUEST)
 
+        if request.data.get("queue") or request.query_params.get("mode") == "queue":
+            return self.enqueue(request, message, tweaks)
+
         # Ensure this method is not called multiple times
         if hasattr(request, '_post_called'):
             return Response({"error": "Duplicate request."}, status=status.HTTP_400_BAD_REQUEST)
@@ -467,53 +697,376 @@ class LangflowAPI(APIView):
         # Run LangFlow API with the given message and optional tweaks
         response = self.run_langflow(message, tweaks, application_token)
 
-        # Debug: Print response from LangFlow API
-        print("Response from LangFlow API:", response)
-
         return Response(response, status=status.HTTP_200_OK)
 
+    def enqueue(self, request, message, tweaks):
+        if not request.user.is_authenticated:
+            return Response({"error": "Authentication required for queued requests."},
+                            status=status.HTTP_401_UNAUTHORIZED)
+        chat = None
+        if request.data.get("chat"):
+            chat = messaging.get_or_create_chat(request.user.id, bot.get_bot_user().id)
+        job = bot.enqueue(request.user, message, tweaks=tweaks, chat=chat)
+        return Response(
+            {"job_id": job.id, "status": job.status, "status_url": reverse('bot-job', args=[job.id])},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
     def run_langflow(self, message: str, tweaks: Optional[dict] = None, application_token: Optional[str] = None) -> dict:
-        """
-        Run the LangFlow API with the provided message and optional tweaks.
-
-        :param message: The message to send to the LangFlow API.
-        :param tweaks: Optional dictionary of tweaks to customize the flow.
-        :param application_token: The application token for authentication.
-        :return: The response JSON from LangFlow API.
-        """
-        api_url = f"{BASE_API_URL}/lf/{LANGFLOW_ID}/api/v1/run/{ENDPOINT or FLOW_ID}"
-
-        payload = {
-            "input_value": message,
-            "output_type": "chat",
-            "input_type": "chat",
-            "tweaks": tweaks if tweaks else TWEAKS
-        }
+        return langflow.run_langflow(message, tweaks, application_token)
 
-        headers = {"Authorization": f"Bearer {application_token}", "Content-Type": "application/json"}
 
-        # Debug: Print the API request URL and payload
-        print("Request URL:", api_url)
-        print("Request Payload:", json.dumps(payload, indent=2))
-        
+class BotJobAPI(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(BotJob, pk=pk, requester=request.user)
+        return Response({
+            "job_id": job.id,
+            "status": job.status,
+            "attempts": job.attempts,
+            "result": job.result,
+            "error": job.error,
+            "reply_message_id": job.reply_id,
+        })
+
+
+
+
+# views.py
+from rest_framework.permissions import IsAdminUser
+from . import analytics, metrics
+from .db import pool_stats
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    return Response({
+        'metrics': metrics.snapshot(),
+        'db_pool': pool_stats(),
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def stats_view(request):
+    """Rolled-up chat activity, see analytics.py. ?days=30&top=10"""
+    try:
+        days = min(max(int(request.query_params.get('days', 30)), 1), 366)
+        top = min(max(int(request.query_params.get('top', 10)), 0), 100)
+    except ValueError:
+        return Response({"error": "'days' and 'top' must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(analytics.stats(days, top))
+
+
+class SyncAPI(APIView):
+    """
+    Everything that changed for the current user since `cursor`: new
+    messages across all chats, new chats and friend request updates, in
+    the order they happened. Without a cursor only the current cursor is
+    returned, so clients can take it before loading their snapshots.
+    `reset` is set when the cursor predates pruned events; the client
+    then reloads its snapshots and continues from the returned cursor.
+    Events show up SYNC_COMMIT_WINDOW seconds after they were written.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    default_limit = 500
+    max_limit = 2000
+
+    def get(self, request, *args, **kwargs):
+        cursor = request.query_params.get('cursor')
+        if cursor is None:
+            return Response({
+                "changes": [], "cursor": changes.latest_cursor(request.user), "has_more": False, "reset": False,
+            })
         try:
-            response = requests.post(api_url, json=payload, headers=headers)
+            cursor = int(cursor)
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({"error": "'cursor' and 'limit' must be integers."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if cursor < retention.change_feed_horizon():
+            # Events after this cursor may have been pruned, start over
+            return Response({
+                "changes": [], "cursor": changes.latest_cursor(request.user), "has_more": False, "reset": True,
+            })
+
+        events, has_more = changes.changes_since(request.user, cursor, max(limit, 1))
+        return Response({
+            "changes": [
+                {"id": e['id'], "kind": e['kind'], "data": e['payload'], "at": e['created_at']}
+                for e in events
+            ],
+            "cursor": events[-1]['id'] if events else cursor,
+            "has_more": has_more,
+            "reset": False,
+        })
+
+
+class MessageSearchAPI(APIView):
+    """
+    Full-text search over the current user's chats:
+    ?q=<words>&limit=<n>&cursor=<next cursor from the previous page>
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    default_limit = 20
+    max_limit = 100
 
-            # Debug: Print raw response status and content before processing
-            print("Raw Response Status:", response.status_code)
-            print("Raw Response Content:", response.text)
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "Query parameter 'q' is required."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', self.default_limit)), 1), self.max_limit)
+            results, next_cursor = search.search_messages(
+                request.user, query, limit=limit, cursor=request.query_params.get('cursor')
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"results": results, "next": next_cursor})
 
-            response.raise_for_status()  # Raises HTTPError for bad responses
-            return response.json()
 
-        except requests.exceptions.HTTPError as errh:
-            print("HTTP Error:", errh)  # Debug: Print error message
-            return {"error": f"HTTP Error: {errh}"}
-        except requests.exceptions.RequestException as err:
-            print("Request Error:", err)  # Debug: Print error message
-            return {"error": f"Request Error: {err}"}
+# views.py
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from . import attachments
+from .models import UploadSession
+from .storage import get_storage
 
 
+class UploadStartAPI(APIView):
+    """POST {"filename", "content_type", "size"} opens a chunked upload."""
+    permission_classes = [permissions.IsAuthenticated]
 
+    def post(self, request, *args, **kwargs):
+        try:
+            upload = attachments.start_upload(
+                request.user,
+                str(request.data.get('filename', '')).strip() or 'file',
+                str(request.data.get('content_type', '')).strip(),
+                int(request.data.get('size', 0)),
+            )
+        except (TypeError, ValueError, attachments.UploadError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            "upload_id": upload.id,
+            "offset": 0,
+            "chunk_size": settings.ATTACHMENT_MAX_CHUNK_SIZE,
+            "url": reverse('upload-chunk', args=[upload.id]),
+        }, status=status.HTTP_201_CREATED)
 
 
+class UploadChunkAPI(APIView):
+    """
+    GET reports the offset to resume from. PUT appends the request body
+    at the position given by its Content-Range header; the response to the
+    last chunk carries the finished attachment.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk, *args, **kwargs):
+        upload = get_object_or_404(UploadSession, pk=pk, owner=request.user)
+        return Response({"offset": upload.received, "size": upload.size})
+
+    def put(self, request, pk, *args, **kwargs):
+        upload = get_object_or_404(UploadSession, pk=pk, owner=request.user)
+        try:
+            start, length = attachments.parse_content_range(request.headers.get('Content-Range'), upload)
+            # Read the raw body stream, never request.data, so the chunk
+            # is copied to storage without being buffered
+            attachment = attachments.write_chunk(upload, start, length, request._request)
+        except attachments.UploadConflict as e:
+            return Response({"error": str(e), "offset": upload.received}, status=status.HTTP_409_CONFLICT)
+        except attachments.UploadError as e:
+            return Response({"error": str(e), "offset": upload.received}, status=status.HTTP_400_BAD_REQUEST)
+        if attachment is None:
+            return Response({"offset": upload.received, "size": upload.size})
+        return Response(attachments.attachment_payload(attachment), status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def attachment_download(request, pk):
+    """
+    Serve an attachment, honouring single-range Range requests. Whole files
+    go through FileResponse (sendfile where the server supports it); with
+    ATTACHMENT_SENDFILE_HEADER set the web server serves the file instead.
+    """
+    attachment = get_object_or_404(
+        attachments.readable_attachments(request.user).select_related('file'), pk=pk
+    )
+    stored = attachment.file
+    storage = get_storage()
+
+    if settings.ATTACHMENT_SENDFILE_HEADER:
+        response = HttpResponse(content_type=attachment.content_type)
+        response[settings.ATTACHMENT_SENDFILE_HEADER] = settings.ATTACHMENT_SENDFILE_PREFIX + stored.name
+    else:
+        try:
+            byte_range = attachments.parse_range(request.headers.get('Range'), stored.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{stored.size}"
+            return response
+        if byte_range is None:
+            response = FileResponse(storage.open(stored.name), content_type=attachment.content_type)
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                attachments.iter_range(storage.open(stored.name), start, end),
+                status=206, content_type=attachment.content_type,
+            )
+            response['Content-Range'] = f"bytes {start}-{end}/{stored.size}"
+            response['Content-Length'] = str(end - start + 1)
+    response['Content-Disposition'] = content_disposition_header(True, attachment.filename)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = f'"{stored.sha256}"'
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+# views.py
+class MessageMutationAPI(APIView):
+    """
+    PATCH {"message": "..."} edits, DELETE tombstones one of your own
+    messages in the chat with `other_user_id`. The change is pushed to the
+    chat's sockets as a compact delta and lands in both users' sync feeds.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_message(self, request, other_user_id, pk):
+        return get_object_or_404(
+            Message.objects.select_related('chat'),
+            pk=pk, sender=request.user, deleted_at__isnull=True,
+            chat__user1_id=min(request.user.id, other_user_id),
+            chat__user2_id=max(request.user.id, other_user_id),
+        )
+
+    def patch(self, request, other_user_id, pk):
+        text = (request.data.get('message') or '').strip()
+        if not text:
+            return Response({"error": "Field 'message' is required."}, status=status.HTTP_400_BAD_REQUEST)
+        message = messaging.edit_message(self.get_message(request, other_user_id, pk), text)
+        return self.respond(request, message)
+
+    def delete(self, request, other_user_id, pk):
+        message = messaging.delete_message(self.get_message(request, other_user_id, pk))
+        return self.respond(request, message)
+
+    def respond(self, request, message):
+        from channels.layers import get_channel_layer
+        from asgiref.sync import async_to_sync
+
+        if message is None:
+            # Deleted by a concurrent request
+            raise Http404
+
+        async_to_sync(get_channel_layer().group_send)(
+            messaging.chat_group(message.chat), messaging.mutation_event(message)
+        )
+        return Response(changes.mutation_payload(message))
+
+
+# views.py
+# Async-native versions of the hot read endpoints, served under async/.
+# DRF views are sync: under an ASGI server each request holds a thread
+# for its whole run. These run on the event loop and only leave it for
+# the queries themselves (Django's async ORM), so one worker can keep
+# many slow reads in flight. Output, ETags and query counts match the
+# sync views.
+import functools
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from rest_framework.authtoken.models import Token
+
+
+async def authenticate_async(request):
+    """The user behind a `Token <key>` header or the session, like DRF's authentication classes."""
+    keyword, _, key = request.headers.get('Authorization', '').partition(' ')
+    if keyword == 'Token' and key.strip():
+        token = await Token.objects.select_related('user').filter(key=key.strip()).afirst()
+        return token.user if token and token.user.is_active else None
+    user = await request.auser()
+    return user if user.is_authenticated else None
+
+
+def json_response(data, status=200):
+    # Same bytes as DRF's JSONRenderer
+    return JsonResponse(data, status=status, safe=False,
+                        json_dumps_params={'separators': (',', ':'), 'ensure_ascii': False})
+
+
+def async_read_view(view):
+    """GET-only, authenticated async view answering JSON like the DRF views."""
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return json_response({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+        user = await authenticate_async(request)
+        if user is None:
+            response = json_response({"detail": "Authentication credentials were not provided."}, status=401)
+            response['WWW-Authenticate'] = 'Token'
+            return response
+        request.user = user
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+@async_read_view
+async def async_message_history(request, other_user_id):
+    try:
+        before, limit, since_version = parse_history_params(request.GET)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    chat = await history_chat_query(request.user, other_user_id).afirst()
+    etag = quote_etag(format_history_etag(request.user, other_user_id, chat))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if since_version is not None:
+            mutations = []
+            if chat and chat['version'] > since_version:
+                mutations = await rows.amessage_rows(mutations_queryset(chat, since_version))
+            data = {"version": chat['version'] if chat else 0, "mutations": mutations}
+        else:
+            data = await rows.amessage_rows(history_queryset(chat, before, limit))
+            if limit is not None:
+                data = data[::-1]
+            if needs_archive(chat, data, limit):
+                data = await sync_to_async(archived_before)(chat, before, limit, data) + data
+        response = json_response(data)
+    response['ETag'] = etag
+    return response
+
+
+@async_read_view
+async def async_user_list(request):
+    current_user = request.user
+    chats, friends = chat_list_etag_queries(current_user)
+    etag = quote_etag(format_chat_list_etag(
+        request, await chats.aaggregate(**CHAT_LIST_AGGREGATES), await friends.acount()
+    ))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        friend_ids = {friend_id async for friend_id in friend_ids_query(current_user)}
+        await sync_to_async(messaging.create_missing_chats)(current_user.id, friend_ids)
+        search_query = request.GET.get('search', '').strip()
+        response = json_response(await rows.achat_rows(chat_list_queryset(current_user, search_query)))
+    response['ETag'] = etag
+    return response
+
+
+@async_read_view
+async def async_user_status(request, user_id):
+    user = await User.objects.filter(id=user_id).values('is_online', 'last_online').afirst()
+    if user is None:
+        return json_response({"detail": f"No {User._meta.object_name} matches the given query."}, status=404)
+    return json_response({
+        'is_online': user['is_online'],
+        'last_online': rows.datetime_formatter()(user['last_online']),
+    })
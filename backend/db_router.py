@@ -0,0 +1,154 @@
+"""
+Read-replica routing.
+
+Requests for the views named in REPLICA_READ_VIEWS run their reads on one
+of REPLICA_DATABASES; everything else, and all writes, use 'default'.
+A client that just wrote something (any successful non-GET request, or a
+chat message over the WebSocket) is pinned to the primary for
+REPLICA_STICKY_SECONDS so it always reads its own writes. Replicas that
+lag more than REPLICA_MAX_LAG_SECONDS are skipped, and when none is
+healthy reads fall back to the primary.
+
+The pin lives in Django's cache; configure a shared cache (e.g. Redis)
+when running more than one worker.
+"""
+
+import contextvars
+import hashlib
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+_use_replica = contextvars.ContextVar('use_replica', default=False)
+
+# Tables that must never be read stale: auth lookups run right after the
+# token or session was created on the primary.
+PRIMARY_ONLY_APPS = {'authtoken', 'sessions', 'admin', 'contenttypes'}
+
+_lag_cache = {}  # alias -> (checked_at, lag_seconds)
+
+
+def replica_aliases():
+    return list(getattr(settings, 'REPLICA_DATABASES', []))
+
+
+def replica_lag(alias):
+    """Replication lag of `alias` in seconds (0 for non-PostgreSQL replicas)."""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+def healthy_replicas():
+    max_lag = getattr(settings, 'REPLICA_MAX_LAG_SECONDS', 2)
+    interval = getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5)
+    now = time.monotonic()
+    healthy = []
+    for alias in replica_aliases():
+        checked_at, lag = _lag_cache.get(alias, (None, None))
+        if checked_at is None or now - checked_at > interval:
+            try:
+                lag = replica_lag(alias)
+            except Exception as e:
+                print(f"Replica {alias} unavailable: {e}")
+                lag = float('inf')
+            _lag_cache[alias] = (now, lag)
+        if lag <= max_lag:
+            healthy.append(alias)
+    return healthy
+
+
+def client_key(request):
+    """Identifies the client behind a request: its token or session."""
+    identity = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not identity:
+        return None
+    return "replica-pin:" + hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+
+def pin_to_primary(key):
+    if key:
+        cache.set(key, 1, getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+
+
+def pin_token_to_primary(token):
+    """Pin a REST client identified by its auth token, e.g. after a WebSocket write."""
+    if replica_aliases():
+        pin_to_primary("replica-pin:" + hashlib.sha256(f"Token {token}".encode()).hexdigest()[:32])
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _use_replica.get() or model._meta.app_label in PRIMARY_ONLY_APPS:
+            return None
+        replicas = healthy_replicas()
+        return random.choice(replicas) if replicas else None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replica_aliases()
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request._replica_token = None
+        try:
+            response = self.get_response(request)
+        finally:
+            if request._replica_token is not None:
+                _use_replica.reset(request._replica_token)
+
+        if self.pins(request, response):
+            pin_to_primary(client_key(request))
+        return response
+
+    async def __acall__(self, request):
+        # process_view sets the flag in this request's own task context
+        # (Django runs it in a thread and copies the change back), so it
+        # ends with the request and needs no reset
+        request._replica_token = None
+        response = await self.get_response(request)
+        if self.pins(request, response):
+            await sync_to_async(pin_to_primary)(client_key(request))
+        return response
+
+    def pins(self, request, response):
+        return request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 and replica_aliases()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ('GET', 'HEAD') or not replica_aliases():
+            return None
+        match = request.resolver_match
+        if match is None or match.url_name not in getattr(settings, 'REPLICA_READ_VIEWS', ()):
+            return None
+        key = client_key(request)
+        if key and cache.get(key):
+            return None
+        request._replica_token = _use_replica.set(True)
+        return None
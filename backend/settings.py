@@ -70,15 +70,61 @@ import os
 
 import os
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+# Each worker's `hybrid.*` channel carries the group traffic of all its
+# sockets (see authapp/layers.py); Redis drops group messages for a
+# channel holding more than its capacity.
+CHANNEL_LAYER_WORKER_CAPACITY = int(os.getenv('CHANNEL_LAYER_WORKER_CAPACITY', 10000))
+REDIS_CHANNEL_CAPACITY = {"hybrid.*": CHANNEL_LAYER_WORKER_CAPACITY}
+REDIS_CHANNEL_LAYER = {
+    "BACKEND": "channels_redis.core.RedisChannelLayer",
+    "CONFIG": {
+        "hosts": [f"rediss://:{os.getenv('REDIS_TOKEN')}@{os.getenv('REDIS_URL')}"],
+        "channel_capacity": REDIS_CHANNEL_CAPACITY,
+    },
+}
+
+# Several Redis nodes: groups are spread over CHANNEL_LAYER_REDIS_URLS by
+# consistent hashing. Shards are named redis0, redis1, ... in URL order, so
+# append new URLs. To rebalance, set CHANNEL_LAYER_RING to the new owners and
+# CHANNEL_LAYER_MIGRATE_FROM to the old ones, deploy with phase "dual", then
+# "cutover", then drop the migration (see ShardedChannelLayer).
+CHANNEL_LAYER_REDIS_URLS = [url for url in os.getenv('CHANNEL_LAYER_REDIS_URLS', '').split(',') if url]
+if CHANNEL_LAYER_REDIS_URLS:
+    REDIS_CHANNEL_LAYER = {
+        "BACKEND": "authapp.layers.ShardedChannelLayer",
         "CONFIG": {
-            "hosts": [f"rediss://:{os.getenv('REDIS_TOKEN')}@{os.getenv('REDIS_URL')}"],
+            "shards": {
+                f"redis{index}": {
+                    "BACKEND": "channels_redis.core.RedisChannelLayer",
+                    "CONFIG": {"hosts": [url], "channel_capacity": REDIS_CHANNEL_CAPACITY},
+                }
+                for index, url in enumerate(CHANNEL_LAYER_REDIS_URLS)
+            },
+            "ring": [name for name in os.getenv('CHANNEL_LAYER_RING', '').split(',') if name] or None,
+            "migration": {
+                "from": os.getenv('CHANNEL_LAYER_MIGRATE_FROM').split(','),
+                "phase": os.getenv('CHANNEL_LAYER_MIGRATION_PHASE', 'dual'),
+            } if os.getenv('CHANNEL_LAYER_MIGRATE_FROM') else None,
         },
-    },
+    }
+
+# Group members on the same worker get messages in-process; Redis only
+# carries them to other workers (see authapp/layers.py).
+CHANNEL_LAYER_LOCAL_FANOUT = os.getenv('CHANNEL_LAYER_LOCAL_FANOUT', 'true').lower() == 'true'
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "authapp.layers.HybridChannelLayer",
+        "CONFIG": {"inner": REDIS_CHANNEL_LAYER},
+    } if CHANNEL_LAYER_LOCAL_FANOUT else REDIS_CHANNEL_LAYER,
 }
 
+# Presence leases: each socket's lease is renewed by its worker every
+# PRESENCE_HEARTBEAT_INTERVAL seconds and expires after PRESENCE_LEASE_TTL.
+# Run `python manage.py reap_presence` to reconcile users of crashed workers.
+PRESENCE_LEASE_STORE = os.getenv('PRESENCE_LEASE_STORE', 'authapp.presence.DatabaseLeaseStore')
+PRESENCE_HEARTBEAT_INTERVAL = int(os.getenv('PRESENCE_HEARTBEAT_INTERVAL', 30))
+PRESENCE_LEASE_TTL = int(os.getenv('PRESENCE_LEASE_TTL', 90))
+
 
 AUTH_USER_MODEL = 'authapp.CustomUser'  # Replace 'authapp' with your app name
 CORS_ALLOW_ALL_ORIGINS = True
@@ -86,6 +132,7 @@ CORS_ALLOW_ALL_ORIGINS = True
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'authapp.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -94,6 +141,8 @@ MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'corsheaders.middleware.CorsMiddleware',  # Add this at the top
     'django.middleware.common.CommonMiddleware',
+    'backend.db_router.ReplicaRoutingMiddleware',
+    'authapp.profiling.ProfilingMiddleware',
 
 ]
 
@@ -148,6 +197,39 @@ DATABASES = {
     )
 }
 
+# Optional read replicas, as a comma-separated list of database URLs.
+# Reads of the views in REPLICA_READ_VIEWS go to a healthy replica (see
+# backend/db_router.py); everything else stays on 'default'.
+REPLICA_DATABASES = []
+for index, url in enumerate(filter(None, os.getenv('DATABASE_REPLICA_URLS', '').split(','))):
+    alias = f'replica_{index}'
+    DATABASES[alias] = dj_database_url.parse(url, conn_max_age=600, ssl_require=True)
+    REPLICA_DATABASES.append(alias)
+
+DATABASE_ROUTERS = ['backend.db_router.ReplicaRouter']
+REPLICA_READ_VIEWS = [
+    'user-list', 'message-history', 'user-search', 'pending-requests', 'user-status',
+    'async-user-list', 'async-message-history', 'async-user-status',
+]
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 5))  # read-your-writes window
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 2))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 5))
+
+# Threads used for the WebSocket consumers' ORM calls (see authapp/db.py).
+# Each thread holds at most one connection, so keep this below DB_POOL_MAX_SIZE.
+CONSUMER_DB_THREADS = int(os.getenv('CONSUMER_DB_THREADS', 8))
+
+# Optional psycopg connection pool. Pooled connections are handed back on
+# close, so persistent connections (CONN_MAX_AGE) have to be turned off.
+DB_POOL_MAX_SIZE = os.getenv('DB_POOL_MAX_SIZE')
+if DB_POOL_MAX_SIZE and DATABASES['default'].get('ENGINE') == 'django.db.backends.postgresql':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(DB_POOL_MAX_SIZE),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),  # seconds to wait for a free connection
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -184,6 +266,107 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# The sync endpoint only serves change events at least this many seconds
+# old. Event ids are taken at insert, so a transaction that commits late
+# can add an event below a cursor a client already moved past; the delay
+# must exceed the longest write transaction plus clock skew between
+# app servers.
+SYNC_COMMIT_WINDOW = float(os.getenv('SYNC_COMMIT_WINDOW', 2))
+
+# Message archive: `python manage.py archive_messages` moves messages older
+# than MESSAGE_ARCHIVE_AFTER_DAYS into compressed per-chat segment files.
+MESSAGE_ARCHIVE_DIR = Path(os.getenv('MESSAGE_ARCHIVE_DIR', BASE_DIR / 'archive'))
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', 180))
+MESSAGE_ARCHIVE_BLOCK_SIZE = int(os.getenv('MESSAGE_ARCHIVE_BLOCK_SIZE', 500))
+
+# Retention: `python manage.py apply_retention` deletes rows older than the
+# given number of days, policy by policy (None disables a policy).
+RETENTION_POLICIES = {
+    'messages': None,
+    'rejected_friend_requests': 30,
+    'change_events': 30,
+}
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 1000))
+RETENTION_BATCH_SLEEP = float(os.getenv('RETENTION_BATCH_SLEEP', 0.2))  # seconds between batches
+
+# Attachments: uploads are chunked and streamed to ATTACHMENT_STORAGE, files
+# are stored once per SHA-256. Set ATTACHMENT_SENDFILE_HEADER (e.g.
+# X-Accel-Redirect with ATTACHMENT_SENDFILE_PREFIX=/protected/attachments/)
+# to let the web server serve downloads. `clean_attachments` discards uploads
+# idle for ATTACHMENT_UPLOAD_EXPIRY_HOURS and unreferenced files older than that.
+ATTACHMENT_STORAGE = os.getenv('ATTACHMENT_STORAGE', 'authapp.storage.LocalFileStorage')
+ATTACHMENT_ROOT = Path(os.getenv('ATTACHMENT_ROOT', BASE_DIR / 'attachments'))
+ATTACHMENT_MAX_SIZE = int(os.getenv('ATTACHMENT_MAX_SIZE', 100 * 1024 * 1024))
+ATTACHMENT_MAX_CHUNK_SIZE = int(os.getenv('ATTACHMENT_MAX_CHUNK_SIZE', 8 * 1024 * 1024))
+ATTACHMENT_COPY_BUFFER = 64 * 1024
+ATTACHMENT_SENDFILE_HEADER = os.getenv('ATTACHMENT_SENDFILE_HEADER', '')
+ATTACHMENT_SENDFILE_PREFIX = os.getenv('ATTACHMENT_SENDFILE_PREFIX', '/protected/attachments/')
+ATTACHMENT_UPLOAD_EXPIRY_HOURS = int(os.getenv('ATTACHMENT_UPLOAD_EXPIRY_HOURS', 24))
+
+# Profiling: a request sending `X-Profile: <PROFILING_TOKEN>` (a WebSocket:
+# `?profile=<PROFILING_TOKEN>`), or a PROFILING_SAMPLE_RATE share of all of
+# them, is profiled into PROFILING_DIR. Off while both are unset.
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0))
+PROFILING_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILING_SAMPLE_INTERVAL_MS', 5))
+PROFILING_DIR = Path(os.getenv('PROFILING_DIR', BASE_DIR / 'profiles'))
+PROFILING_MAX_BYTES = int(os.getenv('PROFILING_MAX_BYTES', 200 * 1024 * 1024))
+
+# "People you may know" candidates kept per user
+FRIEND_SUGGESTIONS_PER_USER = int(os.getenv('FRIEND_SUGGESTIONS_PER_USER', 100))
+
+# Chat message latency tracing (see authapp/tracing.py). Messages taking at
+# least MESSAGE_TRACE_SLOW_MS from receive to delivery are logged with their
+# stage breakdown; unset disables the log.
+MESSAGE_TRACING = os.getenv('MESSAGE_TRACING', 'true').lower() == 'true'
+MESSAGE_TRACE_SLOW_MS = os.getenv('MESSAGE_TRACE_SLOW_MS')
+MESSAGE_TRACE_SLOW_MS = float(MESSAGE_TRACE_SLOW_MS) if MESSAGE_TRACE_SLOW_MS else None
+
+# Offline notification digests: messages to an offline user are summarized
+# in one digest per NOTIFICATION_DIGEST_WINDOW seconds, sent by
+# `python manage.py send_notification_digests` to NOTIFICATION_SINK
+# (authapp.notifications.FileSink or .WebhookSink). A sender holds the rows it
+# claimed for NOTIFICATION_CLAIM_LEASE seconds; if it dies before finishing,
+# they are sent again after that.
+NOTIFICATION_DIGESTS = os.getenv('NOTIFICATION_DIGESTS', 'true').lower() == 'true'
+NOTIFICATION_DIGEST_WINDOW = int(os.getenv('NOTIFICATION_DIGEST_WINDOW', 300))
+NOTIFICATION_SINK = os.getenv('NOTIFICATION_SINK', 'authapp.notifications.FileSink')
+NOTIFICATION_FILE = Path(os.getenv('NOTIFICATION_FILE', BASE_DIR / 'notifications' / 'digests.jsonl'))
+NOTIFICATION_WEBHOOK_URL = os.getenv('NOTIFICATION_WEBHOOK_URL', '')
+NOTIFICATION_WEBHOOK_TIMEOUT = float(os.getenv('NOTIFICATION_WEBHOOK_TIMEOUT', 10))
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', 500))  # digests per pass
+NOTIFICATION_POLL_INTERVAL = float(os.getenv('NOTIFICATION_POLL_INTERVAL', 10))
+NOTIFICATION_CLAIM_LEASE = int(os.getenv('NOTIFICATION_CLAIM_LEASE', 300))
+
+# Analytics rollups behind the admin stats/ endpoint, maintained by
+# `python manage.py roll_up_analytics` (see authapp/analytics.py).
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', 5000))  # messages per transaction
+ANALYTICS_LAG = int(os.getenv('ANALYTICS_LAG', 60))  # seconds; newer messages wait for the next pass
+ANALYTICS_INTERVAL = float(os.getenv('ANALYTICS_INTERVAL', 60))  # seconds between passes
+
+# Compression (see authapp/compression.py): REST responses of at least
+# COMPRESSION_MIN_BYTES go out as Brotli (with the optional `brotli`
+# package) or gzip; sockets opened with ?compress=deflate get frames of at
+# least WS_COMPRESSION_MIN_BYTES as binary zlib data.
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', 4))
+WS_COMPRESSION_MIN_BYTES = int(os.getenv('WS_COMPRESSION_MIN_BYTES', 4096))
+WS_COMPRESSION_LEVEL = int(os.getenv('WS_COMPRESSION_LEVEL', 1))  # every recipient socket compresses its copy
+
+# Most messages accepted in one {"type": "batch"} WebSocket frame
+CHAT_MAX_BATCH = int(os.getenv('CHAT_MAX_BATCH', 100))
+
+# Langflow bot. Chatting with BOT_USERNAME (or POSTing to chat/ with
+# "queue": true) queues a job for `python manage.py run_bot_workers`.
+BOT_USERNAME = os.getenv('BOT_USERNAME', 'assistant')
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 4))  # concurrent upstream calls per worker process
+BOT_REQUEST_TIMEOUT = float(os.getenv('BOT_REQUEST_TIMEOUT', 60))  # seconds per upstream call
+BOT_MAX_ATTEMPTS = int(os.getenv('BOT_MAX_ATTEMPTS', 3))
+BOT_RETRY_BACKOFF = float(os.getenv('BOT_RETRY_BACKOFF', 2))  # seconds, doubled per attempt
+BOT_JOB_DEADLINE = int(os.getenv('BOT_JOB_DEADLINE', 300))  # seconds from enqueue until a job is given up
+BOT_POLL_INTERVAL = float(os.getenv('BOT_POLL_INTERVAL', 1))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -0,0 +1,40 @@
+"""
+Settings for running the test suite locally:
+
+    python manage.py test --settings=backend.test_settings
+"""
+
+from .settings import *  # noqa: F401,F403
+
+SECRET_KEY = SECRET_KEY or 'test-secret-key'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'test-db.sqlite3',
+    },
+    # Second SQLite database standing in for a read replica. It mirrors
+    # 'default' during tests and is only used when a test enables it
+    # through REPLICA_DATABASES.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'test-replica.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+REPLICA_DATABASES = []
+
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+    },
+}
+
+PRESENCE_LEASE_STORE = 'authapp.presence.InMemoryLeaseStore'
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+NOTIFICATION_SINK = 'authapp.notifications.MemorySink'
+
+# Tests read the change feed right after writing to it
+SYNC_COMMIT_WINDOW = 0
@@ -0,0 +1,26 @@
+"""
+ASGI entry point for WebSocket-only workers:
+
+    daphne backend.ws_asgi:application
+
+It loads backend.ws_settings and the consumers only: no HTTP application,
+views or admin, and only the URLs the consumers link to (backend.ws_urls).
+The consumers authenticate with ?token=, so the session-based
+AuthMiddlewareStack of backend.asgi is left out too. Keep backend.asgi
+for workers that serve HTTP.
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.ws_settings")
+
+import django
+django.setup()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+
+from backend import routing
+
+application = ProtocolTypeRouter({
+    "websocket": URLRouter(routing.websocket_urlpatterns),
+})
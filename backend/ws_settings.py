@@ -0,0 +1,21 @@
+"""
+Settings for WebSocket-only workers, see backend/ws_asgi.py: the full
+settings without the apps and middleware that only HTTP requests use.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import INSTALLED_APPS
+
+HTTP_ONLY_APPS = {
+    'django.contrib.admin',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+    'rest_framework',
+    'corsheaders',
+    'channels',
+}
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in HTTP_ONLY_APPS]
+MIDDLEWARE = []
+# backend.urls mounts the admin, which is not installed here
+ROOT_URLCONF = 'backend.ws_urls'
@@ -0,0 +1,18 @@
+"""
+URLconf of WebSocket-only workers, see backend/ws_settings.py. They serve
+no HTTP, but the consumers still link to HTTP routes (attachment URLs in
+message payloads), so those routes are declared here under the same
+names and paths as in backend.urls, without importing the views.
+"""
+
+from django.http import HttpResponseNotFound
+from django.urls import path
+
+
+def not_served(request, *args, **kwargs):
+    return HttpResponseNotFound()
+
+
+urlpatterns = [
+    path('api/auth/attachments/<int:pk>/', not_served, name='attachment'),
+]